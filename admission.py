@@ -0,0 +1,99 @@
+"""Прием задач генерации в зависимости от задержки очереди (по мотивам CoDel).
+
+Сигнал перегрузки - не длина очереди, а время, которое задачи ждут
+до начала работы. Каждый тип задач сравнивается со своей целью: если
+ожидание изображений держится выше цели дольше интервала, отклоняются
+новые изображения, а текст - только когда долго ждет сам текст. Когда
+ожидание опускается ниже цели или очередь типа опустела, прием этого
+типа восстанавливается.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Целевое время ожидания в очереди для каждого типа задач (секунды)
+TARGET_WAITS = {
+    "text": 2.0,
+    "image": 10.0,
+}
+# Сколько ожидание должно держаться выше (или ниже) цели, чтобы начать (или перестать) отклонять
+ADMISSION_INTERVAL = 5.0
+# Задачи, ждавшие дольше этого, не выполняются: пользователь уже не ждет ответа
+MAX_QUEUE_AGES = {
+    "text": 45.0,
+    "image": 90.0,
+}
+
+
+class _KindState:
+    """Состояние приема одного типа задач"""
+
+    __slots__ = ("shedding", "above_since", "below_since")
+
+    def __init__(self):
+        self.shedding = False
+        self.above_since = None
+        self.below_since = None
+
+
+class AdmissionController:
+    """Отказ в приеме задач по времени ожидания в очереди, отдельно для каждого типа.
+
+    Методы вызываются под блокировкой очереди задач.
+    """
+
+    def __init__(self, targets=None, interval=ADMISSION_INTERVAL):
+        self.targets = targets or TARGET_WAITS
+        self.interval = interval
+        self._states = {kind: _KindState() for kind in self.targets}
+
+    def admit(self, kind):
+        """Принимать ли новую задачу kind"""
+        state = self._states.get(kind)
+        return state is None or not state.shedding
+
+    def shedding(self):
+        """Типы задач, новые задачи которых сейчас отклоняются"""
+        return [kind for kind, state in self._states.items() if state.shedding]
+
+    def observe(self, kind, wait, now):
+        """Учесть время ожидания задачи kind, которая начинает выполняться"""
+        state = self._states.get(kind)
+        if state is None:
+            return
+        if wait >= self.targets[kind]:
+            state.below_since = None
+            if state.shedding:
+                return
+            if state.above_since is None:
+                state.above_since = now
+            elif now - state.above_since >= self.interval:
+                state.shedding = True
+                state.above_since = None
+                logger.warning(
+                    f"Ожидание задач {kind} выше цели {self.targets[kind]:.0f} с дольше "
+                    f"{self.interval:.0f} с, новые задачи {kind} отклоняются"
+                )
+        else:
+            state.above_since = None
+            if not state.shedding:
+                return
+            if state.below_since is None:
+                state.below_since = now
+            elif now - state.below_since >= self.interval:
+                self._recover(kind, state)
+
+    def drained(self, kind):
+        """Очередь задач kind опустела - перегрузки этого типа больше нет"""
+        state = self._states.get(kind)
+        if state is None:
+            return
+        state.above_since = None
+        state.below_since = None
+        if state.shedding:
+            self._recover(kind, state)
+
+    def _recover(self, kind, state):
+        state.shedding = False
+        state.below_since = None
+        logger.info(f"Прием задач {kind} восстанавливается")
@@ -0,0 +1 @@
+"""Нагрузочное тестирование бота без обращения к сети"""
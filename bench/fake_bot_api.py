@@ -0,0 +1,201 @@
+"""Локальный HTTP-сервер, изображающий Telegram Bot API.
+
+Updater подключается к нему через base_url. Сервер отдает входящие
+обновления через getUpdates, запоминает все исходящие вызовы бота и
+раздает тестовое изображение по /files/image.jpg.
+"""
+import email.parser
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs
+
+from PIL import Image
+
+BOT_ID = 1000
+
+
+def make_test_jpeg(width=1024, height=1024):
+    buffer = BytesIO()
+    Image.new("RGB", (width, height), (90, 120, 200)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class Call:
+    """Один вызов Bot API от бота"""
+
+    __slots__ = ("time", "method", "chat_id", "params")
+
+    def __init__(self, method, chat_id, params):
+        self.time = time.monotonic()
+        self.method = method
+        self.chat_id = chat_id
+        self.params = params
+
+
+class FakeBotApi:
+    """Поддельный Bot API с очередью обновлений и журналом вызовов"""
+
+    def __init__(self, host="127.0.0.1", port=0, image_bytes=None):
+        self.image_bytes = image_bytes or make_test_jpeg()
+        self.calls = []
+        self.listeners = []
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-bot-api", daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def base_url(self):
+        return f"{self.url}/bot"
+
+    @property
+    def image_url(self):
+        return f"{self.url}/files/image.jpg"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def next_message_id(self):
+        return next(self._message_ids)
+
+    def push_update(self, update):
+        """Поставить обновление в очередь getUpdates и вернуть его update_id"""
+        with self._cond:
+            update["update_id"] = next(self._update_ids)
+            self._updates.append(update)
+            self._cond.notify_all()
+        return update["update_id"]
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = min(float(params.get("timeout") or 0), 1.0)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # Подтвержденные обновления больше не нужны
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return list(self._updates[:100])
+
+    def _message(self, chat_id, **fields):
+        message = {
+            "message_id": self.next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "bench"},
+        }
+        message.update(fields)
+        return message
+
+    def _photo(self):
+        file_id = f"photo-{next(self._file_ids)}"
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 1024, "height": 1024}]
+
+    def handle(self, method, params):
+        """Ответ на вызов метода Bot API"""
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+        chat_id = params.get("chat_id")
+        call = Call(method, chat_id, params)
+        self.calls.append(call)
+        for listener in self.listeners:
+            listener(call)
+
+        if method == "sendMessage":
+            return self._message(chat_id, text=params.get("text", ""))
+        if method == "editMessageText":
+            return self._message(chat_id, text=params.get("text", ""))
+        if method == "sendPhoto":
+            return self._message(chat_id, photo=self._photo(), caption=params.get("caption"))
+        if method == "sendDocument":
+            file_id = f"doc-{next(self._file_ids)}"
+            return self._message(chat_id, document={"file_id": file_id, "file_unique_id": file_id})
+        if method == "sendMediaGroup":
+            media = params.get("media")
+            count = len(json.loads(media)) if isinstance(media, str) else 1
+            return [self._message(chat_id, photo=self._photo()) for _ in range(count)]
+        return True
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body, content_type="application/json"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.startswith("/files/"):
+                    self._reply(200, api.image_bytes, "image/jpeg")
+                    return
+                self._dispatch({})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                self._dispatch(parse_body(self.headers.get("Content-Type", ""), body))
+
+            def _dispatch(self, params):
+                # Путь вида /bot<token>/<method>
+                method = self.path.rsplit("/", 1)[-1].split("?")[0]
+                try:
+                    result = api.handle(method, params)
+                    payload = {"ok": True, "result": result}
+                except Exception as e:
+                    payload = {"ok": False, "error_code": 400, "description": str(e)}
+                self._reply(200, json.dumps(payload).encode("utf-8"))
+
+        return Handler
+
+
+def parse_body(content_type, body):
+    """Параметры запроса: JSON, форма или multipart (файлы заменяются размером)"""
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return {key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()}
+    if content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser().parsebytes(
+            b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+        )
+        params = {}
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True) or b""
+            if part.get_filename():
+                params[name] = {"filename": part.get_filename(), "size": len(payload)}
+            else:
+                params[name] = payload.decode("utf-8", "replace")
+        return params
+    return {}
@@ -0,0 +1,181 @@
+"""Локальная замена пакета g4f для нагрузочного тестирования без сети.
+
+install(profile) регистрирует в sys.modules модули g4f, g4f.client и
+g4f.models, которые отвечают с заданной задержкой, частотой ошибок и
+формой ответа. Вызывать нужно до импорта tgbot.
+"""
+import json
+import random
+import sys
+import threading
+import time
+import types
+from collections import Counter
+
+# Формы ответа, которые встречаются у настоящих провайдеров
+SHAPE_OBJECT = "object"      # Client: объект с choices[0].message.content
+SHAPE_STREAM = "stream"      # Client: итератор частей несмотря на stream=False
+SHAPE_SSE = "sse"            # Client падает, ChatCompletion отдает строку "data: {...}"
+SHAPE_DICT = "dict"          # Client падает, ChatCompletion отдает словарь
+
+LONG_ANSWER_MARKER = "long"
+
+
+class Call:
+    """Поведение одного вызова: задержка до ответа, ошибка, длина и форма ответа"""
+
+    def __init__(self, delay, failed=False, chars=0, shape=SHAPE_OBJECT, chunk_chars=40, chunk_delay=0.02):
+        self.delay = delay
+        self.failed = failed
+        self.chars = chars
+        self.shape = shape
+        self.chunk_chars = chunk_chars
+        self.chunk_delay = chunk_delay
+
+
+class Profile:
+    """Поведение поддельного провайдера"""
+
+    def __init__(self, latency=0.5, jitter=0.2, error_rate=0.0, shape=SHAPE_OBJECT,
+                 chunk_chars=40, chunk_delay=0.02, answer_chars=400, long_answer_chars=12000,
+                 image_latency=2.0, image_url=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.shape = shape
+        self.chunk_chars = chunk_chars
+        self.chunk_delay = chunk_delay
+        self.answer_chars = answer_chars
+        self.long_answer_chars = long_answer_chars
+        self.image_latency = image_latency
+        self.image_url = image_url
+
+    def plan(self, api, prompt):
+        """Call для вызова api с промптом prompt"""
+        base = self.image_latency if api in ("client.images", "images") else self.latency
+        failed = random.random() < self.error_rate
+        if api == "client.chat" and self.shape in (SHAPE_SSE, SHAPE_DICT):
+            failed = True  # Client не поддерживает такого провайдера
+        chars = self.long_answer_chars if LONG_ANSWER_MARKER in prompt else self.answer_chars
+        return Call(max(0.0, random.gauss(base, self.jitter)), failed, chars, self.shape,
+                    self.chunk_chars, self.chunk_delay)
+
+
+PROFILES = {
+    "fast": Profile(latency=0.2, jitter=0.05, image_latency=0.5),
+    "slow": Profile(latency=3.0, jitter=2.0, image_latency=10.0),
+    "flaky": Profile(latency=1.0, jitter=0.5, error_rate=0.3, image_latency=3.0),
+    "stream": Profile(latency=0.3, shape=SHAPE_STREAM, chunk_delay=0.05),
+    "sse": Profile(latency=0.5, shape=SHAPE_SSE),
+    "dict": Profile(latency=0.5, shape=SHAPE_DICT),
+}
+
+# Сколько раз вызывался каждый метод поддельного g4f
+calls = Counter()
+_calls_lock = threading.Lock()
+
+
+class ProviderError(Exception):
+    pass
+
+
+def _count(name):
+    with _calls_lock:
+        calls[name] += 1
+
+
+def _prompt(messages):
+    return messages[-1]["content"] if messages else ""
+
+
+def _answer(prompt, size):
+    line = f"Ответ на «{prompt[:40]}». "
+    text = (line * (size // len(line) + 1))[:size]
+    # Переносы строк, чтобы разбиение длинных сообщений шло по строкам
+    return "\n".join(text[i:i + 200] for i in range(0, len(text), 200))
+
+
+def _wait(call, timeout=None):
+    if timeout is not None and call.delay > timeout:
+        time.sleep(timeout)
+        raise TimeoutError("provider timeout")
+    time.sleep(call.delay)
+    if call.failed:
+        raise ProviderError("provider error")
+
+
+def _chunks(call, text):
+    for i in range(0, len(text), call.chunk_chars):
+        time.sleep(call.chunk_delay)
+        yield text[i:i + call.chunk_chars]
+
+
+def _ns(**kwargs):
+    return types.SimpleNamespace(**kwargs)
+
+
+def _delta_chunk(content):
+    return _ns(choices=[_ns(delta=_ns(content=content))])
+
+
+def install(profile):
+    """Подменить g4f поддельными модулями с поведением profile"""
+    g4f = types.ModuleType("g4f")
+    client_module = types.ModuleType("g4f.client")
+    models = types.ModuleType("g4f.models")
+
+    models.__all__ = ["gpt-4o-mini", "gpt-4o", "flux"]
+    g4f.models = models
+    g4f.debug = _ns(logging=False)
+    g4f.Provider = _ns()
+
+    def chat_create(model, messages, stream=False, timeout=None, **kwargs):
+        _count("client.chat")
+        call = profile.plan("client.chat", _prompt(messages))
+        _wait(call, timeout)
+        text = _answer(_prompt(messages), call.chars)
+        if stream or call.shape == SHAPE_STREAM:
+            return (_delta_chunk(chunk) for chunk in _chunks(call, text))
+        return _ns(choices=[_ns(message=_ns(content=text))])
+
+    def images_generate(model, prompt, response_format="url", timeout=None, **kwargs):
+        _count("client.images")
+        _wait(profile.plan("client.images", prompt), timeout)
+        return _ns(data=[_ns(url=profile.image_url)])
+
+    class Client:
+        def __init__(self, *args, **kwargs):
+            self.chat = _ns(completions=_ns(create=chat_create))
+            self.images = _ns(generate=images_generate)
+
+    def legacy_create(model, messages, stream=False, timeout=None, **kwargs):
+        _count("chatcompletion")
+        call = profile.plan("chatcompletion", _prompt(messages))
+        _wait(call, timeout)
+        text = _answer(_prompt(messages), call.chars)
+        if stream:
+            return _chunks(call, text)
+        if call.shape == SHAPE_DICT:
+            return {"message": {"content": text}}
+        if call.shape == SHAPE_SSE:
+            # Потоковый ответ, пришедший одной строкой в текстовом формате
+            return "\n".join(
+                "data: " + json.dumps({"content": text[i:i + call.chunk_chars]}, ensure_ascii=False)
+                for i in range(0, len(text), call.chunk_chars)
+            )
+        return text
+
+    def images_create(prompt, model=None, timeout=None, **kwargs):
+        _count("images")
+        _wait(profile.plan("images", prompt), timeout)
+        return profile.image_url
+
+    g4f.ChatCompletion = _ns(create=legacy_create)
+    g4f.images = _ns(create=images_create)
+    client_module.Client = Client
+    g4f.client = client_module
+
+    sys.modules["g4f"] = g4f
+    sys.modules["g4f.client"] = client_module
+    sys.modules["g4f.models"] = models
+    return g4f
@@ -0,0 +1,340 @@
+"""Нагрузочный тест бота без сети.
+
+Запускает поддельный Bot API и поддельный g4f, подключает к ним
+настоящие обработчики tgbot и подает поток сообщений с заданной
+частотой. Пример:
+
+    python -m bench.loadgen --profile slow --requests 200 --rate 20 --image-ratio 0.2
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+from bench import fake_g4f
+from bench.fake_bot_api import FakeBotApi
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_TOKEN = "123456:bench"
+
+PATH_TEXT = "text"
+PATH_LONG = "long"
+PATH_IMAGE = "image"
+PATH_INLINE = "inline"
+# Интервал между нажатиями клавиш при наборе inline-запроса (секунды)
+KEYSTROKE_INTERVAL = 0.15
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Tracker:
+    """Время от подачи обновления до завершения его обработки"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = {}
+        self.paths = {}
+        self.latencies = defaultdict(list)
+        self.rejected = Counter()
+        self.finished = 0
+        self.first_start = None
+        self.last_done = None
+        self.all_done = threading.Event()
+        self.expected = 0
+
+    def start(self, message_id, path):
+        now = time.monotonic()
+        with self._lock:
+            self.started[message_id] = now
+            self.paths[message_id] = path
+            if self.first_start is None:
+                self.first_start = now
+
+    def done(self, message_id, rejected=False):
+        now = time.monotonic()
+        with self._lock:
+            started = self.started.pop(message_id, None)
+            if started is None:
+                return
+            path = self.paths.pop(message_id)
+            if rejected:
+                self.rejected[path] += 1
+            else:
+                self.latencies[path].append(now - started)
+            self.last_done = now
+            self.finished += 1
+            if self.finished >= self.expected:
+                self.all_done.set()
+
+
+class ThreadSampler:
+    """Периодически замеряет число потоков процесса"""
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="thread-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.samples.append(threading.active_count())
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def make_update(api, user_id, text):
+    message_id = api.next_message_id()
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        command = text.split(" ", 1)[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return message_id, {"message": message}
+
+
+def make_inline_query(query_id, user_id, text):
+    return {"inline_query": {
+        "id": query_id,
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        "query": text,
+        "offset": "",
+    }}
+
+
+def type_inline_query(api, tracker, number, user_id, text):
+    """Набрать inline-запрос по буквам: каждое нажатие - новый InlineQuery.
+    Отслеживается только последний запрос"""
+    for length in range(1, len(text) + 1):
+        query_id = f"{number}-{length}"
+        if length == len(text):
+            tracker.start(query_id, PATH_INLINE)
+        api.push_update(make_inline_query(query_id, user_id, text[:length]))
+        time.sleep(KEYSTROKE_INTERVAL)
+
+
+def load_bot(api, args, profile=None):
+    """Импортировать tgbot поверх поддельного g4f и вернуть модуль и Updater"""
+    if profile is None:
+        profile = fake_g4f.PROFILES[args.profile]
+    profile.image_url = api.image_url
+    fake_g4f.install(profile)
+
+    # sessions.db и прочие файлы бота создаются во временном каталоге
+    os.chdir(tempfile.mkdtemp(prefix="tgbot-bench-"))
+    sys.path.insert(0, REPO_ROOT)
+    import tgbot
+    from ratelimit import UserRateLimiter
+
+    if not args.rate_limit:
+        tgbot.rate_limiter = UserRateLimiter(capacity=float("inf"))
+    tgbot.STREAM_REPLIES = not args.no_stream
+    if getattr(args, "record", None):
+        import traffic_log
+        from model_catalog import get_g4f
+        from transport import get_client
+        traffic_log.start(os.path.join(REPO_ROOT, args.record), get_g4f(), get_client())
+
+    updater = tgbot.build_updater(BENCH_TOKEN, base_url=api.base_url, workers=args.dispatcher_workers)
+    return tgbot, updater
+
+
+def instrument(tgbot, tracker):
+    """Отмечать завершение задач генерации и отказы в постановке в очередь"""
+    def track(func):
+        def wrapper(update, context, *args):
+            try:
+                return func(update, context, *args)
+            finally:
+                tracker.done(update.message.message_id)
+        return wrapper
+
+    submit = tgbot.submit_generation
+    notify_stale = tgbot.notify_stale
+
+    def submit_wrapper(update, kind, func, *args, **kwargs):
+        queued = submit(update, kind, func, *args, **kwargs)
+        if not queued:
+            tracker.done(update.message.message_id, rejected=True)
+        return queued
+
+    def stale_wrapper(update):
+        try:
+            notify_stale(update)
+        finally:
+            tracker.done(update.message.message_id, rejected=True)
+
+    answer_inline = tgbot.answer_inline
+    process_inline_query = tgbot.process_inline_query
+    start_inline_generation = tgbot.start_inline_generation
+
+    def answer_inline_wrapper(query, prompt, answer):
+        try:
+            return answer_inline(query, prompt, answer)
+        finally:
+            tracker.done(query.id)
+
+    def inline_wrapper(func):
+        # Запрос, оставшийся без ответа, считается отказом (ответ уже отмечен выше)
+        def wrapper(request):
+            try:
+                return func(request)
+            finally:
+                if not tgbot.inline_debouncer.is_current(request):
+                    tracker.done(request.query.id, rejected=True)
+        return wrapper
+
+    tgbot.process_text_request = track(tgbot.process_text_request)
+    tgbot.process_image_request = track(tgbot.process_image_request)
+    tgbot.process_image_variants = track(tgbot.process_image_variants)
+    tgbot.submit_generation = submit_wrapper
+    tgbot.notify_stale = stale_wrapper
+    tgbot.answer_inline = answer_inline_wrapper
+    tgbot.process_inline_query = inline_wrapper(process_inline_query)
+    tgbot.inline_debouncer.start = inline_wrapper(start_inline_generation)
+    tgbot.drop_stale_inline = inline_wrapper(tgbot.drop_stale_inline)
+
+
+def generate_load(api, tracker, args):
+    rng = random.Random(args.seed)
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    next_at = time.monotonic()
+    for i in range(args.requests):
+        user_id = 10_000 + rng.randrange(args.users)
+        roll = rng.random()
+        if roll < args.inline_ratio:
+            # Inline-запрос набирается параллельно с остальным потоком сообщений. Один
+            # человек не набирает два запроса сразу, поэтому у каждого свой пользователь
+            threading.Thread(target=type_inline_query, args=(api, tracker, i, 30_000 + i, f"вопрос номер {i}"),
+                             daemon=True).start()
+            next_at += interval
+            time.sleep(max(0.0, next_at - time.monotonic()))
+            continue
+        roll -= args.inline_ratio
+        if roll < args.image_ratio:
+            path, text = PATH_IMAGE, f"/image картинка номер {i}"
+        elif roll < args.image_ratio + args.long_ratio:
+            path, text = PATH_LONG, f"{fake_g4f.LONG_ANSWER_MARKER} вопрос номер {i}"
+        else:
+            path, text = PATH_TEXT, f"вопрос номер {i}"
+
+        message_id, update = make_update(api, user_id, text)
+        tracker.start(message_id, path)
+        api.push_update(update)
+
+        next_at += interval
+        delay = next_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def build_report(tracker, sampler, api, elapsed, args):
+    paths = {}
+    for path in (PATH_TEXT, PATH_LONG, PATH_IMAGE, PATH_INLINE):
+        values = tracker.latencies.get(path, [])
+        paths[path] = {
+            "completed": len(values),
+            "rejected": tracker.rejected.get(path, 0),
+            "p50": percentile(values, 0.5),
+            "p99": percentile(values, 0.99),
+            "max": max(values) if values else 0.0,
+        }
+    completed = sum(len(v) for v in tracker.latencies.values())
+    return {
+        "profile": args.profile,
+        "requests": args.requests,
+        "completed": completed,
+        "unfinished": len(tracker.started),
+        "elapsed": elapsed,
+        "throughput": completed / elapsed if elapsed else 0.0,
+        "paths": paths,
+        "threads_peak": max(sampler.samples) if sampler.samples else threading.active_count(),
+        "threads_avg": sum(sampler.samples) / len(sampler.samples) if sampler.samples else 0.0,
+        "provider_calls": dict(fake_g4f.calls),
+        "bot_api_calls": dict(Counter(call.method for call in api.calls)),
+    }
+
+
+def print_report(report):
+    print(f"Профиль: {report['profile']}, запросов: {report['requests']}, "
+          f"выполнено: {report['completed']}, не завершено: {report['unfinished']}")
+    print(f"Время: {report['elapsed']:.1f} с, пропускная способность: {report['throughput']:.2f} запр/с")
+    print(f"{'путь':<8}{'готово':>8}{'отказ':>8}{'p50, с':>10}{'p99, с':>10}{'max, с':>10}")
+    for path, row in report["paths"].items():
+        print(f"{path:<8}{row['completed']:>8}{row['rejected']:>8}{row['p50']:>10.2f}{row['p99']:>10.2f}{row['max']:>10.2f}")
+    print(f"Потоки: пик {report['threads_peak']}, в среднем {report['threads_avg']:.1f}")
+    print(f"Вызовы g4f: {report['provider_calls']}")
+    print(f"Вызовы Bot API: {report['bot_api_calls']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест tgbot без сети")
+    parser.add_argument("--profile", choices=sorted(fake_g4f.PROFILES), default="fast")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=10.0, help="запросов в секунду (0 - все сразу)")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--image-ratio", type=float, default=0.2)
+    parser.add_argument("--long-ratio", type=float, default=0.1)
+    parser.add_argument("--inline-ratio", type=float, default=0.0, help="доля inline-запросов, набираемых по буквам")
+    parser.add_argument("--dispatcher-workers", type=int, default=4)
+    parser.add_argument("--rate-limit", action="store_true", help="не отключать лимиты пользователей")
+    parser.add_argument("--no-stream", action="store_true", help="отправлять ответ целиком, без редактирования")
+    parser.add_argument("--timeout", type=float, default=300.0, help="сколько ждать завершения всех запросов")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить отчет в JSON-файл")
+    parser.add_argument("--record", help="записать журнал трафика для python -m bench.replay")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    api = FakeBotApi().start()
+    tgbot, updater = load_bot(api, args)
+
+    tracker = Tracker()
+    tracker.expected = args.requests
+    instrument(tgbot, tracker)
+
+    sampler = ThreadSampler()
+    sampler.start()
+    updater.start_polling(poll_interval=0.0, timeout=1)
+    try:
+        generate_load(api, tracker, args)
+        tracker.all_done.wait(args.timeout)
+    finally:
+        sampler.stop()
+        updater.stop()
+        tgbot.shutdown()
+        api.stop()
+
+    elapsed = (tracker.last_done or time.monotonic()) - (tracker.first_start or time.monotonic())
+    report = build_report(tracker, sampler, api, elapsed, args)
+    print_report(report)
+    if args.json:
+        with open(os.path.join(REPO_ROOT, args.json) if not os.path.isabs(args.json) else args.json, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Память, занимаемая историей бесед.
+
+Сравнивает байты на сообщение для истории в виде списка словарей
+(как она хранилась раньше и как приходит из JSON сессии) и для
+ConversationWindow без сжатия и со сжатием старых сообщений. Пример:
+
+    python -m bench.memory --users 200 --turns 40
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import context_window  # noqa: E402
+from context_window import ConversationWindow  # noqa: E402
+
+WORDS = ("модель", "ответ", "запрос", "пример", "функция", "данные", "список", "сервер",
+         "python", "telegram", "код", "ошибка", "значение", "строка", "файл", "бот")
+
+
+def make_text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def make_conversation(rng, turns, answer_words):
+    """Сохраненная беседа в виде JSON, как в строке таблицы сессий"""
+    messages = []
+    for i in range(turns):
+        if i % 2 == 0:
+            messages.append({"role": "user", "content": make_text(rng, rng.randint(5, 30))})
+        else:
+            messages.append({"role": "assistant", "content": make_text(rng, rng.randint(answer_words // 2, answer_words))})
+    return json.dumps(messages, ensure_ascii=False)
+
+
+def measure(build, rows):
+    """Сколько байт занимают истории, восстановленные из rows"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    # После json.loads роль и текст - отдельные объекты в каждом сообщении
+    histories = [build(json.loads(row)) for row in rows]
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del histories
+    return used
+
+
+def build_window(messages, compress_after):
+    context_window.COMPRESS_AFTER_TURNS = compress_after
+    window = ConversationWindow(budget=10 ** 9)
+    window.extend(messages)
+    return window
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Память истории бесед")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=40)
+    parser.add_argument("--answer-words", type=int, default=200, help="длина ответа модели в словах")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    compress_after = context_window.COMPRESS_AFTER_TURNS
+    variants = [
+        ("список словарей", lambda messages: messages),
+        ("Turn", lambda messages: build_window(messages, 0)),
+        (f"Turn + zlib после {compress_after}", lambda messages: build_window(messages, compress_after)),
+    ]
+    rng = random.Random(args.seed)
+    rows = [make_conversation(rng, args.turns, args.answer_words) for _ in range(args.users)]
+    total_turns = args.users * args.turns
+
+    print(f"Пользователей: {args.users}, сообщений у каждого: {args.turns}")
+    print(f"{'вариант':<24}{'байт/сообщение':>16}{'МБ всего':>12}")
+    results = {}
+    try:
+        for name, build in variants:
+            used = measure(build, rows)
+            results[name] = used / total_turns
+            print(f"{name:<24}{used / total_turns:>16.0f}{used / 2 ** 20:>12.1f}")
+    finally:
+        context_window.COMPRESS_AFTER_TURNS = compress_after
+    return results
+
+
+if __name__ == "__main__":
+    main()
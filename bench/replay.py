@@ -0,0 +1,308 @@
+"""Воспроизведение журнала трафика (traffic_log.py) без сети.
+
+Обновления подаются боту в записанном порядке и с записанными
+интервалами (--speed ускоряет подачу), а поддельный g4f отвечает на
+вызовы с записанными задержками, ошибками, формой и длиной ответа.
+Вызовы связываются с обновлениями по номеру, который replay вставляет в
+начало промпта. Отчет совпадает с отчетом bench.loadgen, а --baseline
+сравнивает его с отчетом другой сборки. Пример:
+
+    python -m bench.replay traffic.jsonl.gz --speed 4 --json new.json --baseline old.json
+    python -m bench.replay --compare old.json new.json
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import defaultdict, deque
+
+from bench import fake_g4f
+from bench.fake_bot_api import FakeBotApi
+from bench.loadgen import (
+    PATH_IMAGE, PATH_LONG, PATH_TEXT, REPO_ROOT, ThreadSampler, Tracker,
+    build_report, instrument, load_bot, make_update, print_report,
+)
+
+MODE_TEXT = "text"
+MODE_IMAGE = "image"
+BUTTONS = {MODE_TEXT: "🤖 GPT", MODE_IMAGE: "🎨 Изображение"}
+# Ответ длиннее этого считается длинным (как MAX_MESSAGE_LENGTH в tgbot.py)
+LONG_ANSWER_CHARS = 4000
+USER_ID_BASE = 20_000
+PROMPT_MARKER = re.compile(r"#(\d+)\b")
+
+
+class Recording:
+    """Журнал трафика: обновления по порядку и вызовы провайдеров по обновлениям"""
+
+    def __init__(self):
+        self.updates = []
+        self.calls = defaultdict(list)
+        self.unmatched = defaultdict(list)
+
+    @classmethod
+    def load(cls, path):
+        recording = cls()
+        opener = gzip.open if path.endswith(".gz") else open
+        # Каждый перезапуск бота начинает в журнале новый отрезок со своим отсчетом
+        segment = 0
+        base = end = 0.0
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                kind = event.get("ev")
+                if kind == "start":
+                    segment += 1
+                    base = end
+                    continue
+                event["t"] = base + event.get("t", 0.0)
+                end = max(end, event["t"])
+                if event.get("seq") is not None:
+                    event["seq"] = (segment, event["seq"])
+                if kind == "update":
+                    recording.updates.append(event)
+                elif kind == "call":
+                    if event.get("seq") is None:
+                        recording.unmatched[event["api"]].append(event)
+                    else:
+                        recording.calls[event["seq"]].append(event)
+        recording.updates.sort(key=lambda e: e["t"])
+        return recording
+
+    def answer_chars(self, seq):
+        """Самый длинный успешный текстовый ответ на обновление"""
+        return max((c.get("chars", 0) for c in self.calls.get(seq, ())
+                    if c["ok"] and c["api"] in ("client.chat", "chatcompletion")), default=0)
+
+
+class ReplayProfile(fake_g4f.Profile):
+    """Поддельный провайдер, повторяющий записанные вызовы"""
+
+    def __init__(self, recording, seed=1):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._index = {}
+        self._calls = {}
+        self._rng = random.Random(seed)
+        self._by_api = defaultdict(list)
+        for seq, calls in recording.calls.items():
+            self._calls[seq] = defaultdict(deque)
+            for call in calls:
+                self._calls[seq][call["api"]].append(call)
+                self._by_api[call["api"]].append(call)
+        for api, calls in recording.unmatched.items():
+            self._by_api[api].extend(calls)
+        self.missing = 0
+
+    def register(self, number, seq):
+        """Промпт с маркером #number относится к записанному обновлению seq"""
+        self._index[number] = seq
+
+    def _recorded(self, api, prompt):
+        match = PROMPT_MARKER.search(prompt or "")
+        seq = self._index.get(int(match.group(1))) if match else None
+        with self._lock:
+            queue = self._calls.get(seq, {}).get(api)
+            if queue:
+                return queue.popleft()
+            # Новая сборка вызывает провайдера иначе, чем записанная: берем похожий вызов
+            self.missing += 1
+            pool = self._by_api.get(api)
+            return self._rng.choice(pool) if pool else None
+
+    def plan(self, api, prompt):
+        event = self._recorded(api, prompt)
+        if event is None:
+            return super().plan(api, prompt)
+        call = fake_g4f.Call(event.get("first", 0.0), not event["ok"], event.get("chars", 0),
+                             event.get("shape", fake_g4f.SHAPE_OBJECT))
+        chunks = event.get("chunks")
+        if chunks:
+            call.chunk_chars = max(1, -(-call.chars // chunks))
+            call.chunk_delay = max(0.0, event.get("total", call.delay) - call.delay) / chunks
+        return call
+
+
+def synth_prompt(number, event):
+    """Промпт записанной длины и числа строк с маркером номера"""
+    chars = event.get("chars", 0)
+    if not chars:
+        return ""
+    head = f"#{number} "
+    lines = max(1, event.get("lines", 1))
+    body = "x" * max(0, chars - len(head))
+    if lines > 1 and len(body) >= lines:
+        step = len(body) // lines
+        body = "\n".join(body[i * step:(i + 1) * step] for i in range(lines))
+    return head + body
+
+
+def build_messages(recording, profile):
+    """Тексты сообщений для воспроизведения: (время, пользователь, текст, путь или None)"""
+    modes = {}
+    messages = []
+    for number, event in enumerate(recording.updates, 1):
+        profile.register(number, event["seq"])
+        user_id = USER_ID_BASE + event["user"]
+        prompt = synth_prompt(number, event)
+        command = event.get("cmd")
+        button = event.get("button")
+        path = None
+        if button:
+            modes[user_id] = button
+            text = BUTTONS.get(button, button)
+        elif command:
+            if command == "/start":
+                modes[user_id] = MODE_TEXT
+            text = command
+            if event.get("opts"):
+                text += " " + " ".join(event["opts"])
+            if event.get("count"):
+                text += f" {event['count']}"
+            if prompt:
+                text += " " + prompt
+                if command == "/gpt":
+                    path = PATH_TEXT
+                elif command == "/image":
+                    path = PATH_IMAGE
+        elif prompt:
+            mode = event.get("mode") or MODE_TEXT
+            if mode == modes.get(user_id, MODE_TEXT):
+                text = prompt
+            else:
+                # В записи пользователь был в другом режиме: передаем режим командой
+                text = ("/image " if mode == MODE_IMAGE else "/gpt ") + prompt
+            path = PATH_IMAGE if mode == MODE_IMAGE else PATH_TEXT
+        else:
+            continue
+        if path == PATH_TEXT and recording.answer_chars(event["seq"]) > LONG_ANSWER_CHARS:
+            path = PATH_LONG
+        messages.append((event["t"], user_id, text, path))
+    return messages
+
+
+def feed(api, tracker, messages, speed):
+    """Подать сообщения с записанными интервалами, ускоренными в speed раз"""
+    started = time.monotonic()
+    first = messages[0][0] if messages else 0.0
+    for at, user_id, text, path in messages:
+        delay = started + (at - first) / speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        message_id, update = make_update(api, user_id, text)
+        if path is not None:
+            tracker.start(message_id, path)
+        api.push_update(update)
+
+
+def _change(old, new):
+    if not old:
+        return ""
+    return f"{(new - old) / old * 100:+.0f}%"
+
+
+def compare_reports(old, new):
+    """Строки сравнения двух отчетов"""
+    lines = [
+        f"{'':<14}{'было':>10}{'стало':>10}{'изм.':>8}",
+        f"{'запр/с':<14}{old['throughput']:>10.2f}{new['throughput']:>10.2f}"
+        f"{_change(old['throughput'], new['throughput']):>8}",
+    ]
+    for path in new["paths"]:
+        before = old["paths"].get(path)
+        after = new["paths"][path]
+        if before is None or not (before["completed"] or after["completed"]):
+            continue
+        for field in ("completed", "rejected", "p50", "p99"):
+            fmt = ".2f" if field.startswith("p") else "d"
+            lines.append(f"{path + ' ' + field:<14}{before[field]:>10{fmt}}{after[field]:>10{fmt}}"
+                         f"{_change(before[field], after[field]):>8}")
+    old_calls = sum(old["provider_calls"].values())
+    new_calls = sum(new["provider_calls"].values())
+    lines.append(f"{'вызовы g4f':<14}{old_calls:>10d}{new_calls:>10d}{_change(old_calls, new_calls):>8}")
+    lines.append(f"{'потоки (пик)':<14}{old['threads_peak']:>10d}{new['threads_peak']:>10d}"
+                 f"{_change(old['threads_peak'], new['threads_peak']):>8}")
+    return lines
+
+
+def _load_report(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _repo_path(path):
+    return path if os.path.isabs(path) else os.path.join(REPO_ROOT, path)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Воспроизведение журнала трафика tgbot без сети")
+    parser.add_argument("recording", nargs="?", help="журнал traffic_log (.jsonl или .jsonl.gz)")
+    parser.add_argument("--speed", type=float, default=1.0, help="во сколько раз ускорить подачу обновлений")
+    parser.add_argument("--dispatcher-workers", type=int, default=4)
+    parser.add_argument("--rate-limit", action="store_true", help="не отключать лимиты пользователей")
+    parser.add_argument("--no-stream", action="store_true", help="отправлять ответ целиком, без редактирования")
+    parser.add_argument("--timeout", type=float, default=300.0, help="сколько ждать завершения всех запросов")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить отчет в JSON-файл")
+    parser.add_argument("--baseline", help="отчет другой сборки для сравнения")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="только сравнить два отчета")
+    args = parser.parse_args(argv)
+    if not args.compare and not args.recording:
+        parser.error("нужен журнал трафика или --compare")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        old, new = (_load_report(_repo_path(path)) for path in args.compare)
+        print("\n".join(compare_reports(old, new)))
+        return new
+
+    recording = Recording.load(_repo_path(args.recording))
+    profile = ReplayProfile(recording, args.seed)
+    messages = build_messages(recording, profile)
+    args.profile = f"replay:{os.path.basename(args.recording)}"
+    args.requests = sum(1 for message in messages if message[3] is not None)
+
+    api = FakeBotApi().start()
+    tgbot, updater = load_bot(api, args, profile)
+
+    tracker = Tracker()
+    tracker.expected = args.requests
+    instrument(tgbot, tracker)
+
+    sampler = ThreadSampler()
+    sampler.start()
+    updater.start_polling(poll_interval=0.0, timeout=1)
+    try:
+        feed(api, tracker, messages, args.speed)
+        tracker.all_done.wait(args.timeout)
+    finally:
+        sampler.stop()
+        updater.stop()
+        tgbot.shutdown()
+        api.stop()
+
+    elapsed = (tracker.last_done or time.monotonic()) - (tracker.first_start or time.monotonic())
+    report = build_report(tracker, sampler, api, elapsed, args)
+    report["speed"] = args.speed
+    report["unrecorded_calls"] = profile.missing
+    print_report(report)
+    print(f"Вызовы без записи (взяты похожие): {profile.missing}")
+    if args.json:
+        with open(_repo_path(args.json), "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        print("\n".join(compare_reports(_load_report(_repo_path(args.baseline)), report)))
+    return report
+
+
+if __name__ == "__main__":
+    main()
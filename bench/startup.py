@@ -0,0 +1,117 @@
+"""Время запуска бота.
+
+Запускает бота в отдельном процессе с -X importtime против поддельного
+Bot API, сразу отправляет /start и замеряет время до ответа. Отчет
+показывает самые тяжелые импорты верхнего уровня и проверяет, что g4f,
+PIL и requests не загружаются при запуске. Пример:
+
+    python -m bench.startup --runs 3
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench.fake_bot_api import FakeBotApi
+from bench.loadgen import BENCH_TOKEN, REPO_ROOT, make_update
+
+# Модули, которые должны загружаться только при первом использовании
+LAZY_MODULES = ("g4f", "PIL", "requests")
+
+BOT_SCRIPT = """
+import sys
+import tgbot
+updater = tgbot.build_updater({token!r}, base_url={base_url!r})
+updater.start_polling(poll_interval=0.0, timeout=1)
+sys.stdin.read()
+updater.stop()
+tgbot.shutdown()
+"""
+
+
+def parse_importtime(stderr):
+    """Импорты из вывода -X importtime: {имя: (глубина, суммарное время в секундах)}"""
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports[name.strip()] = (depth, int(cumulative) / 1e6)
+    return imports
+
+
+def measure(api, timeout):
+    """Один запуск: время до ответа на /start и импорты"""
+    user_id = 42
+    replied = threading.Event()
+
+    def listener(call):
+        if call.method == "sendMessage" and str(call.chat_id) == str(user_id):
+            replied.set()
+
+    api.listeners.append(listener)
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    script = BOT_SCRIPT.format(token=BENCH_TOKEN, base_url=api.base_url)
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, "-X", "importtime", "-c", script],
+        cwd=tempfile.mkdtemp(prefix="tgbot-startup-"), env=env,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+    )
+    # /start уже ждет в очереди, пока бот запускается
+    api.push_update(make_update(api, user_id, "/start")[1])
+    ok = replied.wait(timeout)
+    first_reply = time.monotonic() - started
+    _, stderr = process.communicate("", timeout=30)
+    api.listeners.remove(listener)
+    return {"first_reply": first_reply if ok else None, "imports": parse_importtime(stderr)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Время запуска tgbot")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10, help="сколько самых тяжелых импортов показать")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--json", help="сохранить отчет в JSON-файл")
+    args = parser.parse_args(argv)
+
+    api = FakeBotApi().start()
+    try:
+        runs = [measure(api, args.timeout) for _ in range(args.runs)]
+    finally:
+        api.stop()
+
+    replies = [run["first_reply"] for run in runs if run["first_reply"] is not None]
+    imports = runs[-1]["imports"]
+    # Модули, которые импортирует сам tgbot (глубина 1 под ним)
+    direct = {name: seconds for name, (depth, seconds) in imports.items() if depth == 1}
+    heavy = sorted(direct.items(), key=lambda item: item[1], reverse=True)[:args.top]
+    loaded_lazy = [name for name in LAZY_MODULES if any(m == name or m.startswith(name + ".") for m in imports)]
+    report = {
+        "runs": args.runs,
+        "first_reply": replies,
+        "imports_total": sum(seconds for depth, seconds in imports.values() if depth == 0),
+        "heavy_imports": dict(heavy),
+        "eager_lazy_modules": loaded_lazy,
+    }
+
+    print(f"Ответ на /start после запуска: {', '.join(f'{v:.2f} с' for v in replies) or 'нет ответа'}")
+    print(f"Импорты: {report['imports_total']:.2f} с, самые тяжелые из tgbot:")
+    for name, seconds in heavy:
+        print(f"  {name:<30}{seconds:>8.3f} с")
+    print(f"Загружены при запуске, хотя должны быть ленивыми: {', '.join(loaded_lazy) or 'нет'}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Кэш результатов генерации и объединение одинаковых одновременных запросов"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Изображения: храним file_id Telegram, а не сами файлы
+IMAGE_CACHE_TTL = 24 * 60 * 60
+IMAGE_CACHE_SIZE = 2000
+# Текстовые ответы на запросы без истории
+TEXT_CACHE_TTL = 60 * 60
+TEXT_CACHE_SIZE = 500
+
+
+def normalize_prompt(prompt):
+    """Привести запрос к каноническому виду: регистр и пробелы не важны"""
+    return " ".join(prompt.lower().split())
+
+
+def make_key(prompt, *parts):
+    """Ключ кэша по содержимому запроса и параметрам генерации"""
+    material = "\x1f".join([normalize_prompt(prompt)] + [str(part) for part in parts])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    """LRU-кэш, записи которого устаревают через ttl секунд"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[1] if entry else None
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {"entries": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+image_cache = TTLCache(IMAGE_CACHE_SIZE, IMAGE_CACHE_TTL)
+text_cache = TTLCache(TEXT_CACHE_SIZE, TEXT_CACHE_TTL)
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Объединение одинаковых запросов, выполняющихся одновременно.
+
+    Первый запрос с ключом (ведущий) выполняет работу, остальные ждут
+    его результата и получают тот же ответ или то же исключение.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """Вернуть (результат, True для ведущего / False для присоединившегося)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
+                leader = True
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, False
+
+        try:
+            flight.result = func(*args, **kwargs)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+            if flight.waiters:
+                logger.info(f"{self.name}: результат одного запроса получили еще {flight.waiters}")
+        return flight.result, True
+
+    def stats(self):
+        with self._lock:
+            return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": len(self._flights)}
+
+
+image_flight = SingleFlight("image")
+text_flight = SingleFlight("text")
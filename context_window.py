@@ -0,0 +1,280 @@
+"""Окно контекста беседы с ограничением по токенам"""
+import logging
+import sys
+import threading
+import zlib
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Бюджет токенов истории для каждой модели (без учета нового запроса)
+MODEL_CONTEXT_BUDGETS = {
+    "gpt-4o-mini": 12000,
+    "gpt-4o": 12000,
+    "gpt-4": 6000,
+    "gpt-3.5-turbo": 3000,
+}
+DEFAULT_CONTEXT_BUDGET = 4000
+
+# Накладные расходы на одно сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Сколько последних сообщений никогда не сворачиваются
+KEEP_RECENT_TURNS = 4
+# Максимальный размер сводки удаленных сообщений в токенах
+SUMMARY_MAX_TOKENS = 300
+# Сколько символов от каждого удаленного вопроса попадает в сводку
+SUMMARY_SNIPPET_CHARS = 120
+
+# Если даже последние сообщения не помещаются в бюджет, они сокращаются,
+# но не короче стольких токенов
+TRUNCATE_MIN_TOKENS = 32
+TRUNCATED_MARKER = "\n…[сообщение сокращено]"
+
+# Сообщения старше стольких последних хранятся сжатыми (0 - не сжимать)
+COMPRESS_AFTER_TURNS = 8
+# Короткие сообщения не сжимаются: выигрыш меньше накладных расходов zlib
+COMPRESS_MIN_BYTES = 512
+
+SUMMARY_PREFIX = "Краткое содержание предыдущей части беседы. Пользователь спрашивал о:"
+
+# Общая статистика по всем запросам
+context_stats = {"requests": 0, "tokens_sent": 0, "tokens_saved": 0}
+_stats_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    """Приблизительно оценить число токенов в тексте"""
+    if not text:
+        return MESSAGE_OVERHEAD_TOKENS
+    # ~4 байта UTF-8 на токен: для латиницы это ~4 символа, для кириллицы ~2
+    return MESSAGE_OVERHEAD_TOKENS + (len(text.encode('utf-8')) + 3) // 4
+
+
+def model_name(model):
+    """Получить строковое имя модели g4f"""
+    return getattr(model, 'name', None) or str(model)
+
+
+def budget_for_model(model):
+    """Бюджет токенов истории для модели"""
+    return MODEL_CONTEXT_BUDGETS.get(model_name(model), DEFAULT_CONTEXT_BUDGET)
+
+
+class Turn:
+    """Одно сообщение истории.
+
+    Роль хранится как общая интернированная строка, текст - строкой
+    или, для старых длинных сообщений, сжатыми zlib байтами.
+    """
+
+    __slots__ = ("role", "_content", "tokens")
+
+    def __init__(self, role, content, tokens):
+        self.role = sys.intern(role) if role else "user"
+        self._content = content
+        self.tokens = tokens
+
+    @property
+    def content(self):
+        content = self._content
+        if isinstance(content, bytes):
+            return zlib.decompress(content).decode("utf-8")
+        return content
+
+    def compress(self):
+        """Сжать текст, если это дает выигрыш"""
+        content = self._content
+        if not isinstance(content, str):
+            return
+        data = content.encode("utf-8")
+        if len(data) < COMPRESS_MIN_BYTES:
+            return
+        packed = zlib.compress(data)
+        if len(packed) < len(data):
+            self._content = packed
+
+    def truncate(self, tokens):
+        """Сократить текст примерно до tokens токенов и вернуть, на сколько уменьшилась оценка"""
+        tokens = max(tokens, TRUNCATE_MIN_TOKENS)
+        if tokens >= self.tokens:
+            return 0
+        limit = max(0, (tokens - MESSAGE_OVERHEAD_TOKENS) * 4 - len(TRUNCATED_MARKER.encode("utf-8")))
+        content = self.content.encode("utf-8")[:limit].decode("utf-8", "ignore") + TRUNCATED_MARKER
+        removed = self.tokens - estimate_tokens(content)
+        if removed <= 0:
+            return 0
+        self._content = content
+        self.tokens -= removed
+        return removed
+
+    def to_message(self):
+        return {"role": self.role, "content": self.content}
+
+
+class ConversationWindow:
+    """История сообщений пользователя с инкрементальным подсчетом токенов.
+
+    Каждое сообщение оценивается один раз при добавлении, сумма хранится
+    в счетчике. При превышении бюджета старые сообщения сворачиваются
+    в короткую сводку, а затем удаляются. Сообщения хранятся как Turn,
+    а словари для модели создаются только в messages().
+
+    Окно меняет поток генерации, а читает поток записи сессий, поэтому
+    изменения и снимки состояния выполняются под блокировкой окна.
+    on_change вызывается после каждого изменения (хранилище сессий
+    помечает по нему сессию для записи).
+    """
+
+    def __init__(self, model=None, budget=None):
+        self.budget = budget if budget is not None else budget_for_model(model)
+        self._lock = threading.RLock()
+        self.on_change = None
+        self._turns = deque()
+        self.tokens = 0
+        self._summary = []
+        self._summary_tokens = 0
+        # Сколько токенов было бы отправлено сверх окна без обрезки
+        self.saved_tokens = 0
+        self.trimmed_turns = 0
+
+    def __iter__(self):
+        return iter(self.messages())
+
+    def __len__(self):
+        return len(self._turns)
+
+    def __bool__(self):
+        return bool(self._turns) or bool(self._summary)
+
+    def append(self, message):
+        """Добавить сообщение и при необходимости обрезать окно"""
+        content = message.get("content") or ""
+        tokens = estimate_tokens(content)
+        with self._lock:
+            self._turns.append(Turn(message.get("role"), content, tokens))
+            self.tokens += tokens
+            self._trim()
+            if COMPRESS_AFTER_TURNS and len(self._turns) > COMPRESS_AFTER_TURNS:
+                # Сообщение только что вышло из числа последних - дальше оно нужно редко
+                self._turns[-COMPRESS_AFTER_TURNS - 1].compress()
+        self._changed()
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def clear(self):
+        """Очистить историю и статистику"""
+        with self._lock:
+            self._turns = deque()
+            self.tokens = 0
+            self._summary = []
+            self._summary_tokens = 0
+            self.saved_tokens = 0
+            self.trimmed_turns = 0
+        self._changed()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def to_state(self):
+        """Состояние окна для сохранения на диск"""
+        with self._lock:
+            return {
+                "turns": [turn.to_message() for turn in self._turns],
+                "summary": list(self._summary),
+                "saved_tokens": self.saved_tokens,
+                "trimmed_turns": self.trimmed_turns,
+            }
+
+    @classmethod
+    def from_state(cls, state, model=None):
+        """Восстановить окно из сохраненного состояния"""
+        window = cls(model)
+        window._summary = list(state.get("summary") or [])
+        window._summary_tokens = sum(estimate_tokens(snippet) for snippet in window._summary)
+        window.extend(state.get("turns") or [])
+        window.saved_tokens = state.get("saved_tokens", 0)
+        window.trimmed_turns = state.get("trimmed_turns", 0)
+        return window
+
+    def _trim(self):
+        while self.tokens + self._summary_tokens > self.budget and len(self._turns) > KEEP_RECENT_TURNS:
+            turn = self._turns.popleft()
+            self.tokens -= turn.tokens
+            self.saved_tokens += turn.tokens
+            self.trimmed_turns += 1
+            if turn.role == "user":
+                self._collapse(turn.content)
+
+        # Последние сообщения не сворачиваются, но сводку можно выбросить
+        if self.tokens + self._summary_tokens > self.budget and self._summary:
+            self._summary = []
+            self._summary_tokens = 0
+
+        if self.tokens > self.budget:
+            self._shrink()
+
+    def _shrink(self):
+        """Сократить последние сообщения, которые и без сводки не помещаются в бюджет.
+
+        Сначала сокращаются ответы модели, начиная со старых, и только
+        потом вопросы пользователя.
+        """
+        for assistant_only in (True, False):
+            for turn in self._turns:
+                excess = self.tokens - self.budget
+                if excess <= 0:
+                    return
+                if assistant_only and turn.role != "assistant":
+                    continue
+                removed = turn.truncate(turn.tokens - excess)
+                self.tokens -= removed
+                self.saved_tokens += removed
+
+    def _collapse(self, content):
+        snippet = " ".join(content.split())[:SUMMARY_SNIPPET_CHARS]
+        if not snippet:
+            return
+        self._summary.append(snippet)
+        self._summary_tokens += estimate_tokens(snippet)
+        # Сводка тоже ограничена: самые старые фрагменты выбрасываются
+        while self._summary_tokens > SUMMARY_MAX_TOKENS and len(self._summary) > 1:
+            self._summary_tokens -= estimate_tokens(self._summary.pop(0))
+
+    def messages(self):
+        """Сообщения для отправки модели"""
+        messages = []
+        with self._lock:
+            if self._summary:
+                messages.append({"role": "system", "content": SUMMARY_PREFIX + "\n- " + "\n- ".join(self._summary)})
+            messages.extend(turn.to_message() for turn in self._turns)
+        return messages
+
+    def sent_tokens(self):
+        """Сколько токенов истории уходит в запрос"""
+        return self.tokens + self._summary_tokens
+
+    def stats(self):
+        """Статистика окна"""
+        return {
+            "turns": len(self._turns),
+            "tokens": self.sent_tokens(),
+            "budget": self.budget,
+            "saved_tokens": self.saved_tokens,
+            "trimmed_turns": self.trimmed_turns,
+        }
+
+
+def record_request(window):
+    """Учесть запрос в общей статистике и вернуть число сэкономленных токенов"""
+    if not isinstance(window, ConversationWindow):
+        return 0
+    saved = max(0, window.saved_tokens - window._summary_tokens)
+    with _stats_lock:
+        context_stats["requests"] += 1
+        context_stats["tokens_sent"] += window.sent_tokens()
+        context_stats["tokens_saved"] += saved
+    return saved
@@ -0,0 +1,93 @@
+"""Общий срок выполнения запроса для всей цепочки попыток"""
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# Срок на текстовый ответ и на изображение (секунды)
+TEXT_DEADLINE = 30.0
+IMAGE_DEADLINE = 90.0
+# Потоки для вызовов без собственного таймаута
+DETACHED_WORKERS = 16
+
+# Сколько раз истек срок на каждом этапе
+timeout_counts = Counter()
+_counts_lock = threading.Lock()
+
+_detached_pool = ThreadPoolExecutor(max_workers=DETACHED_WORKERS, thread_name_prefix="deadline")
+
+
+class DeadlineExceeded(Exception):
+    """Срок выполнения запроса истек"""
+
+    def __init__(self, stage):
+        self.stage = stage
+        super().__init__(f"истек срок ожидания на этапе {stage}")
+
+
+def record_timeout(stage):
+    with _counts_lock:
+        timeout_counts[stage] += 1
+    logger.warning(f"Истек срок ожидания на этапе {stage}")
+
+
+class Deadline:
+    """Момент, к которому запрос должен быть выполнен"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.cancelled = False
+
+    def cancel(self):
+        """Истечь досрочно: результат запроса больше никому не нужен"""
+        self.cancelled = True
+        self.expires_at = min(self.expires_at, time.monotonic())
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def timeout(self, cap=None):
+        """Таймаут для очередного вызова: остаток срока, но не больше cap"""
+        remaining = self.remaining()
+        if cap is not None:
+            remaining = min(remaining, cap)
+        # Нулевой таймаут requests трактует как ошибку, поэтому оставляем минимум
+        return max(remaining, 0.1)
+
+    def check(self, stage):
+        """Бросить DeadlineExceeded, если срок уже истек"""
+        if self.expired():
+            if not self.cancelled:
+                record_timeout(stage)
+            raise DeadlineExceeded(stage)
+
+
+def run_with_deadline(deadline, stage, func, *args, **kwargs):
+    """Выполнить func не дольше остатка срока.
+
+    По истечении срока результат больше не ждем, а поток доработает в фоне
+    и вернется в пул. Уже начатый вызов так не прервать, поэтому func
+    должна получать остаток срока и в собственном таймауте.
+    """
+    deadline.check(stage)
+    future = _detached_pool.submit(func, *args, **kwargs)
+    try:
+        return future.result(timeout=deadline.remaining())
+    except FutureTimeoutError:
+        future.cancel()
+        if not deadline.cancelled:
+            record_timeout(stage)
+        raise DeadlineExceeded(stage)
+
+
+def timeout_stats():
+    """Число истекших сроков по этапам"""
+    with _counts_lock:
+        return dict(timeout_counts)
@@ -0,0 +1,271 @@
+"""Загрузка и подготовка изображений к отправке в Telegram"""
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+import threading
+import time
+
+from deadlines import DeadlineExceeded, record_timeout
+from metrics import IMAGE_DOWNLOAD_SECONDS, IMAGE_TRANSCODE_SECONDS
+from transport import get_session
+
+logger = logging.getLogger(__name__)
+
+# Максимальный размер загружаемого изображения
+MAX_IMAGE_BYTES = 15 * 1024 * 1024
+# Ограничения Telegram для фото
+MAX_PHOTO_BYTES = 10 * 1024 * 1024
+MAX_PHOTO_DIMENSIONS_SUM = 10000
+MAX_PHOTO_ASPECT_RATIO = 20
+# Число процессов для перекодирования (0 - перекодировать в текущем потоке)
+TRANSCODE_WORKERS = 2
+# Размер блока при загрузке
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Размеры, которые можно заказать у модели (/size, /image <размер> <описание>)
+IMAGE_SIZES = {
+    "preview": (512, 512),
+    "standard": (1024, 1024),
+    "wide": (1344, 768),
+    "tall": (768, 1344),
+}
+DEFAULT_IMAGE_SIZE = "standard"
+# Размер файла, к которому подбирается качество (None - без подбора, максимальное качество)
+TARGET_IMAGE_BYTES = {
+    "preview": 60 * 1024,
+    "standard": 300 * 1024,
+    "wide": 350 * 1024,
+    "tall": 350 * 1024,
+}
+# Границы подбора качества JPEG/WebP и число шагов двоичного поиска
+IMAGE_QUALITY_MIN = 40
+IMAGE_QUALITY_MAX = 90
+QUALITY_SEARCH_STEPS = 4
+
+# Как отправлять изображение: сжатым фото, файлом WebP или исходным файлом без перекодирования
+OUTPUT_PHOTO = "photo"
+OUTPUT_WEBP = "webp"
+OUTPUT_DOCUMENT = "document"
+OUTPUT_FORMATS = (OUTPUT_PHOTO, OUTPUT_WEBP, OUTPUT_DOCUMENT)
+DEFAULT_OUTPUT = OUTPUT_PHOTO
+
+# Сколько вариантов изображения можно заказать командой /image N <описание>
+MAX_IMAGE_VARIANTS = 4
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+PNG_MAGIC = b"\x89PNG"
+
+_pool_lock = threading.Lock()
+_transcode_pool = None
+
+
+def download_image(url, deadline, max_bytes=MAX_IMAGE_BYTES):
+    """Загрузить изображение потоком, не превышая размер и общий срок запроса"""
+    with IMAGE_DOWNLOAD_SECONDS.time():
+        return _download(url, deadline, max_bytes)
+
+
+def _download(url, deadline, max_bytes):
+    img_response = get_session().get(url, timeout=deadline.timeout(60), stream=True)
+    try:
+        if img_response.status_code != 200:
+            logger.error(f"Ошибка при загрузке изображения: {img_response.status_code}")
+            return None
+
+        declared = img_response.headers.get("Content-Length")
+        if declared and declared.isdigit() and int(declared) > max_bytes:
+            logger.error(f"Изображение слишком большое: {declared} байт")
+            return None
+
+        buffer = bytearray()
+        for chunk in img_response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            deadline.check("image.download")
+            buffer += chunk
+            if len(buffer) > max_bytes:
+                logger.error(f"Изображение превысило {max_bytes} байт, загрузка прервана")
+                return None
+        return bytes(buffer)
+    finally:
+        img_response.close()
+
+
+def image_extension(data):
+    """Расширение файла по первым байтам изображения"""
+    if data.startswith(JPEG_MAGIC):
+        return "jpg"
+    if data.startswith(PNG_MAGIC):
+        return "png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return "bin"
+
+
+def is_telegram_ready_jpeg(data, max_size=None, max_bytes=MAX_PHOTO_BYTES):
+    """JPEG, который Telegram примет как фото без перекодирования.
+
+    max_size - (ширина, высота), больше которых изображение нужно уменьшить.
+    Читается только заголовок файла, пиксели не декодируются.
+    """
+    if not data.startswith(JPEG_MAGIC) or len(data) > min(max_bytes, MAX_PHOTO_BYTES):
+        return False
+    from PIL import Image
+    try:
+        with Image.open(BytesIO(data)) as img:
+            width, height = img.size
+            if img.format != "JPEG" or img.mode not in ("RGB", "L"):
+                return False
+    except Exception:
+        return False
+    if width + height > MAX_PHOTO_DIMENSIONS_SUM:
+        return False
+    if max_size is not None and (width > max_size[0] or height > max_size[1]):
+        return False
+    return max(width, height) <= MAX_PHOTO_ASPECT_RATIO * min(width, height)
+
+
+def is_image(data):
+    """Данные - изображение, которое PIL может открыть (читается только заголовок)"""
+    from PIL import Image
+    try:
+        with Image.open(BytesIO(data)) as img:
+            img.size
+        return True
+    except Exception:
+        return False
+
+
+def encode_image(data, output=OUTPUT_PHOTO, max_size=None, target_bytes=None):
+    """Декодировать изображение, уменьшить до max_size и сохранить в JPEG
+    (или WebP) с наибольшим качеством, при котором файл не больше target_bytes.
+    Возвращает (данные, качество). Выполняется в процессе пула.
+    """
+    from PIL import Image
+    img = Image.open(BytesIO(data)).convert('RGB')
+    if max_size is not None and (img.width > max_size[0] or img.height > max_size[1]):
+        img.thumbnail(max_size, Image.LANCZOS)
+    image_format = 'WEBP' if output == OUTPUT_WEBP else 'JPEG'
+
+    def save(quality):
+        buffer = BytesIO()
+        img.save(buffer, format=image_format, quality=quality)
+        return buffer.getvalue()
+
+    encoded = save(IMAGE_QUALITY_MAX)
+    if target_bytes is None or len(encoded) <= target_bytes:
+        return encoded, IMAGE_QUALITY_MAX
+
+    # Двоичный поиск наибольшего качества, которое укладывается в target_bytes
+    best = None
+    low, high = IMAGE_QUALITY_MIN, IMAGE_QUALITY_MAX - 1
+    for _ in range(QUALITY_SEARCH_STEPS):
+        if low > high:
+            break
+        quality = (low + high) // 2
+        candidate = save(quality)
+        if len(candidate) <= target_bytes:
+            best = (candidate, quality)
+            low = quality + 1
+        else:
+            high = quality - 1
+    # Даже минимальное качество не укладывается - отправляем самый маленький вариант
+    return best or (save(IMAGE_QUALITY_MIN), IMAGE_QUALITY_MIN)
+
+
+def _get_transcode_pool():
+    global _transcode_pool
+    if TRANSCODE_WORKERS <= 0 or "fork" not in multiprocessing.get_all_start_methods():
+        # Без fork дочерний процесс заново импортировал бы модуль бота
+        return None
+    with _pool_lock:
+        if _transcode_pool is None:
+            _transcode_pool = ProcessPoolExecutor(
+                max_workers=TRANSCODE_WORKERS,
+                mp_context=multiprocessing.get_context("fork"),
+            )
+        return _transcode_pool
+
+
+def _reset_transcode_pool():
+    global _transcode_pool
+    with _pool_lock:
+        if _transcode_pool is not None:
+            _transcode_pool.shutdown(wait=False)
+        _transcode_pool = None
+
+
+def prepare_image(data, deadline, output=OUTPUT_PHOTO, size=DEFAULT_IMAGE_SIZE):
+    """Проверить, что данные - действительно изображение, и подготовить к отправке способом output"""
+    if output == OUTPUT_DOCUMENT:
+        # Исходный файл без потери качества, Telegram не пережимает документы
+        return data if is_image(data) else None
+
+    max_size = IMAGE_SIZES.get(size)
+    target_bytes = TARGET_IMAGE_BYTES.get(size)
+    if output == OUTPUT_PHOTO and is_telegram_ready_jpeg(data, max_size, target_bytes or MAX_PHOTO_BYTES):
+        # Уже подходящий JPEG - отправляем без перекодирования
+        return data
+
+    pool = _get_transcode_pool()
+    started = time.monotonic()
+    try:
+        if pool is None:
+            with IMAGE_TRANSCODE_SECONDS.time(output):
+                encoded, quality = encode_image(data, output, max_size, target_bytes)
+        else:
+            future = pool.submit(encode_image, data, output, max_size, target_bytes)
+            try:
+                with IMAGE_TRANSCODE_SECONDS.time(output):
+                    encoded, quality = future.result(timeout=deadline.remaining())
+            except FutureTimeoutError:
+                future.cancel()
+                record_timeout("image.transcode")
+                raise DeadlineExceeded("image.transcode")
+    except BrokenProcessPool as e:
+        logger.error(f"Пул перекодирования недоступен, перекодируем в текущем потоке: {e}")
+        _reset_transcode_pool()
+        encoded, quality = encode_image(data, output, max_size, target_bytes)
+    except DeadlineExceeded:
+        raise
+    except Exception as img_error:
+        logger.error(f"Ошибка при обработке изображения: {img_error}")
+        return None
+    logger.info(f"Изображение перекодировано в {output} ({size}, качество {quality}): "
+                f"{len(data) // 1024} -> {len(encoded) // 1024} КБ за {time.monotonic() - started:.2f} с")
+    return encoded
+
+
+def split_image_options(words):
+    """Параметры перед описанием в /image [размер] [формат] [N] <описание>.
+
+    Возвращает (размер или None, формат или None, N или None, оставшиеся слова).
+    Число считается количеством вариантов, только если оно от 1 до MAX_IMAGE_VARIANTS:
+    "/image 1984 style poster" - это описание, а не 1984 варианта.
+    """
+    size = output = count = None
+    while len(words) > 1:
+        option = words[0].lower()
+        if size is None and option in IMAGE_SIZES:
+            size = option
+        elif output is None and option in OUTPUT_FORMATS:
+            output = option
+        elif count is None and option.isdecimal() and 1 <= int(option) <= MAX_IMAGE_VARIANTS:
+            count = int(option)
+        else:
+            break
+        words = words[1:]
+    return size, output, count, words
+
+
+def fetch_image(url, deadline, output=OUTPUT_PHOTO, size=DEFAULT_IMAGE_SIZE):
+    """Загрузить изображение по URL и подготовить его к отправке"""
+    data = download_image(url, deadline)
+    if data is None:
+        return None
+    return prepare_image(data, deadline, output, size)
+
+
+def shutdown():
+    """Остановить процессы перекодирования"""
+    _reset_transcode_pool()
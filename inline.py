@@ -0,0 +1,188 @@
+"""Inline-режим (@bot вопрос): ожидание конца набора и отмена устаревших запросов.
+
+Telegram присылает новый InlineQuery почти на каждое нажатие клавиши.
+Генерация начинается, только когда пользователь перестал печатать на
+INLINE_DEBOUNCE секунд; новый запрос того же пользователя заменяет
+ожидающий и отменяет уже начатую генерацию (через Deadline.cancel).
+Одинаковый вопрос разных пользователей генерируется один раз со своим
+сроком, который отменяется, только когда ответа не ждет никто.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from cache import TTLCache, SingleFlight, normalize_prompt
+from deadlines import Deadline
+
+logger = logging.getLogger(__name__)
+
+# Пауза в наборе, после которой запрос отправляется модели (секунды)
+INLINE_DEBOUNCE = 0.7
+# Более короткие запросы не обрабатываются
+INLINE_MIN_CHARS = 3
+# Срок на ответ: Telegram перестает принимать ответ на старый запрос
+INLINE_DEADLINE = 10.0
+# Сколько хранить ответы у себя и сколько Telegram может кэшировать результат
+INLINE_CACHE_TTL = 5 * 60
+INLINE_CACHE_SIZE = 1000
+INLINE_CACHE_TIME = 60
+
+# Знаки в конце, которые не меняют вопрос ("погода в москве?" и "погода в москве")
+TRAILING_PUNCTUATION = " ?!.,;:…"
+
+inline_cache = TTLCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+inline_flight = SingleFlight("inline")
+
+
+def inline_key(text):
+    """Ключ кэша inline-ответа: регистр, пробелы и знаки в конце не важны"""
+    return normalize_prompt(text).rstrip(TRAILING_PUNCTUATION)
+
+
+class InlineRequest:
+    """Запрос пользователя, ожидающий конца набора или выполняющийся"""
+
+    __slots__ = ("user_id", "query", "text", "due", "deadline", "generation")
+
+    def __init__(self, user_id, query, text, due):
+        self.user_id = user_id
+        self.query = query
+        self.text = text
+        self.due = due
+        self.deadline = None
+        self.generation = None
+
+
+class _Generation:
+    """Общая генерация ответа на вопрос и запросы, которые ее ждут"""
+
+    __slots__ = ("key", "deadline", "requests")
+
+    def __init__(self, key, deadline):
+        self.key = key
+        self.deadline = deadline
+        self.requests = set()
+
+
+class InlineDebouncer:
+    """Последний запрос каждого пользователя передается start после паузы в наборе"""
+
+    def __init__(self, start, delay=INLINE_DEBOUNCE, deadline=INLINE_DEADLINE):
+        self.start = start
+        self.delay = delay
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        # Последний запрос пользователя: ожидающий или выполняющийся
+        self._current = {}
+        # Выполняющиеся генерации по ключу вопроса
+        self._generations = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self.received = 0
+        self.superseded = 0
+        self.cancelled = 0
+        self.started = 0
+        self._thread = threading.Thread(target=self._loop, name="inline-debounce", daemon=True)
+        self._thread.start()
+
+    def offer(self, user_id, query, text):
+        """Новый запрос пользователя заменяет его предыдущий"""
+        with self._lock:
+            self.received += 1
+            previous = self._current.get(user_id)
+            if previous is not None and inline_key(previous.text) == inline_key(text):
+                # Вопрос не изменился - ответ уйдет на последний запрос
+                previous.query = query
+                return previous
+            request = InlineRequest(user_id, query, text, time.monotonic() + self.delay)
+            self._supersede(user_id)
+            self._current[user_id] = request
+            heapq.heappush(self._heap, (request.due, next(self._seq), request))
+            self._cond.notify()
+        return request
+
+    def supersede(self, user_id):
+        """Отменить запрос пользователя (например, на новый уже ответили из кэша)"""
+        with self._lock:
+            self._supersede(user_id)
+            self._current.pop(user_id, None)
+
+    def _supersede(self, user_id):
+        previous = self._current.get(user_id)
+        if previous is None:
+            return
+        if previous.deadline is None:
+            self.superseded += 1
+        else:
+            # Генерация уже идет: обрываем ее, если ответа не ждут другие пользователи
+            previous.deadline.cancel()
+            self._leave(previous)
+            self.cancelled += 1
+
+    def join(self, request):
+        """Общая генерация вопроса request; запрос начинает ее ждать.
+
+        Отмененная генерация заменяется новой, поэтому ключом объединения
+        запросов служит сам объект генерации, а не текст вопроса.
+        """
+        key = inline_key(request.text)
+        with self._lock:
+            generation = self._generations.get(key)
+            if generation is None or generation.deadline.expired():
+                generation = self._generations[key] = _Generation(key, Deadline(request.deadline.remaining()))
+            if self._current.get(request.user_id) is request:
+                generation.requests.add(request)
+                request.generation = generation
+            return generation
+
+    def _leave(self, request):
+        generation = request.generation
+        if generation is None:
+            return
+        request.generation = None
+        generation.requests.discard(request)
+        if not generation.requests:
+            generation.deadline.cancel()
+            if self._generations.get(generation.key) is generation:
+                del self._generations[generation.key]
+
+    def is_current(self, request):
+        with self._lock:
+            return self._current.get(request.user_id) is request
+
+    def finish(self, request):
+        """Запрос выполнен (или отклонен)"""
+        with self._lock:
+            self._leave(request)
+            if self._current.get(request.user_id) is request:
+                del self._current[request.user_id]
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                request = heapq.heappop(self._heap)[2]
+                if self._current.get(request.user_id) is not request:
+                    continue
+                # Срок отсчитывается от прихода запроса, а не от конца паузы
+                request.deadline = Deadline(self.deadline - self.delay)
+                self.started += 1
+            try:
+                self.start(request)
+            except Exception as e:
+                logger.error(f"Ошибка при запуске inline-запроса пользователя {request.user_id}: {e}")
+                self.finish(request)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "received": self.received,
+                "superseded": self.superseded,
+                "cancelled": self.cancelled,
+                "started": self.started,
+                "pending": len(self._current),
+            }
@@ -0,0 +1,295 @@
+"""Очередь задач генерации и пулы рабочих потоков"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from admission import AdmissionController, MAX_QUEUE_AGES
+
+logger = logging.getLogger(__name__)
+
+# Типы задач
+JOB_TEXT = "text"
+JOB_IMAGE = "image"
+
+# Максимум одновременно выполняемых задач каждого типа
+POOL_SIZES = {
+    JOB_TEXT: 8,
+    JOB_IMAGE: 3,
+}
+# Максимальное число задач в очереди (ожидающих и выполняемых) для каждого типа
+QUEUE_LIMITS = {
+    JOB_TEXT: 100,
+    JOB_IMAGE: 20,
+}
+# Стоимость задач для справедливой очереди: текст дешевле изображения
+JOB_COSTS = {
+    JOB_TEXT: 1.0,
+    JOB_IMAGE: 4.0,
+}
+# Ожидание в очереди дольше этого времени попадает в лог
+SLOW_WAIT_LOG_SECONDS = 2.0
+
+
+class Job:
+    """Задача генерации одного пользователя"""
+
+    __slots__ = ("user_id", "kind", "func", "args", "kwargs", "submitted_at", "ready_at", "created_at",
+                 "on_stale", "start_tag", "finish_tag")
+
+    def __init__(self, user_id, kind, func, args, kwargs, created_at=None, on_stale=None):
+        self.user_id = user_id
+        self.kind = kind
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted_at = time.monotonic()
+        # Когда задача стала первой в очереди свободного пользователя и могла начаться
+        self.ready_at = self.submitted_at
+        # Когда пользователь отправил запрос (может быть раньше постановки в очередь)
+        self.created_at = self.submitted_at if created_at is None else min(created_at, self.submitted_at)
+        self.on_stale = on_stale
+        self.start_tag = 0.0
+        self.finish_tag = 0.0
+
+
+class QueueStats:
+    """Счетчики одной очереди"""
+
+    def __init__(self):
+        self.depth = 0
+        self.running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.shed = 0
+        self.stale = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.last_wait = 0.0
+
+    def as_dict(self):
+        started = self.completed + self.failed + self.running
+        return {
+            "depth": self.depth,
+            "running": self.running,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "shed": self.shed,
+            "stale": self.stale,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait": self.wait_total / started if started else 0.0,
+            "max_wait": self.wait_max,
+            "last_wait": self.last_wait,
+        }
+
+
+class GenerationExecutor:
+    """Выполняет генерацию вне потоков диспетчера telegram.
+
+    Задачи одного пользователя выполняются строго по очереди (FIFO), чтобы
+    два его сообщения не изменяли историю одновременно. Между пользователями
+    работает взвешенная справедливая очередь: каждой задаче назначается
+    виртуальное время окончания start + cost / weight, и свободный поток
+    берет задачу с наименьшим временем. Поэтому пользователь с длинной
+    очередью не задерживает остальных, а дешевый текст обгоняет изображения.
+    Одновременно выполняется не больше POOL_SIZES[kind] задач каждого типа.
+
+    Если задачи долго ждут начала работы, admission отклоняет новые задачи
+    (см. admission.py), а задачи старше max_ages[kind] не выполняются вовсе.
+    """
+
+    def __init__(self, pool_sizes=None, queue_limits=None, costs=None, admission=None, max_ages=None):
+        self.pool_sizes = pool_sizes or POOL_SIZES
+        self.queue_limits = queue_limits or QUEUE_LIMITS
+        self.costs = costs or JOB_COSTS
+        self.admission = admission or AdmissionController()
+        self.max_ages = max_ages or MAX_QUEUE_AGES
+        self._stats = {kind: QueueStats() for kind in self.pool_sizes}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._closed = False
+        # Задачи, ожидающие своей очереди, по пользователям
+        self._user_queues = {}
+        self._running_users = set()
+        # Куча (время окончания, номер, user_id) первых задач свободных пользователей
+        self._ready = []
+        self._virtual_time = 0.0
+        self._user_finish = {}
+        self._seq = itertools.count()
+        # Устаревшие задачи, о которых нужно сообщить вне блокировки
+        self._stale_jobs = []
+
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"gen-worker-{i}", daemon=True)
+            for i in range(sum(self.pool_sizes.values()))
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, user_id, kind, func, *args, weight=1.0, created_at=None, on_stale=None, **kwargs):
+        """Поставить задачу в очередь.
+
+        Возвращает False, если очередь заполнена или перегружена. created_at -
+        время отправки запроса по time.monotonic(), от него отсчитывается
+        возраст задачи; on_stale вызывается вместо func, если задача устарела.
+        """
+        job = Job(user_id, kind, func, args, kwargs, created_at, on_stale)
+        with self._lock:
+            stats = self._stats[kind]
+            if self._closed or stats.depth >= self.queue_limits[kind]:
+                stats.rejected += 1
+                logger.warning(f"Очередь {kind} заполнена ({stats.depth}), задача пользователя {user_id} отклонена")
+                return False
+            if not self.admission.admit(kind):
+                stats.shed += 1
+                logger.info(f"Очередь {kind} перегружена, задача пользователя {user_id} отклонена")
+                return False
+            stats.depth += 1
+            stats.submitted += 1
+
+            job.start_tag = max(self._virtual_time, self._user_finish.get(user_id, 0.0))
+            job.finish_tag = job.start_tag + self.costs.get(kind, 1.0) / weight
+            self._user_finish[user_id] = job.finish_tag
+
+            queue = self._user_queues.get(user_id)
+            if queue is None:
+                queue = self._user_queues[user_id] = deque()
+            queue.append(job)
+            if len(queue) == 1 and user_id not in self._running_users:
+                self._push_ready(job, job.submitted_at)
+            self._cond.notify()
+        return True
+
+    def _push_ready(self, job, now=None):
+        job.ready_at = time.monotonic() if now is None else now
+        heapq.heappush(self._ready, (job.finish_tag, next(self._seq), job.user_id))
+
+    def _pick(self):
+        """Взять задачу с наименьшим временем окончания, тип которой не исчерпал лимит"""
+        skipped = []
+        job = None
+        now = time.monotonic()
+        while self._ready:
+            entry = heapq.heappop(self._ready)
+            candidate = self._user_queues[entry[2]][0]
+            if now - candidate.created_at > self.max_ages.get(candidate.kind, float("inf")):
+                self._drop_stale(candidate, now)
+                continue
+            if self._stats[candidate.kind].running < self.pool_sizes[candidate.kind]:
+                job = candidate
+                break
+            skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self._ready, entry)
+        for kind, stats in self._stats.items():
+            if not self.admission.admit(kind) and not stats.depth - stats.running:
+                self.admission.drained(kind)
+        if job is None:
+            return None
+
+        self._user_queues[job.user_id].popleft()
+        self._running_users.add(job.user_id)
+        self._virtual_time = max(self._virtual_time, job.start_tag)
+
+        wait = now - job.submitted_at
+        # Перегрузку показывает только ожидание свободного потока: время за
+        # предыдущими задачами того же пользователя - его собственная очередь
+        self.admission.observe(job.kind, now - job.ready_at, now)
+        stats = self._stats[job.kind]
+        stats.running += 1
+        stats.wait_total += wait
+        stats.last_wait = wait
+        stats.wait_max = max(stats.wait_max, wait)
+        if wait >= SLOW_WAIT_LOG_SECONDS:
+            logger.info(f"Задача {job.kind} пользователя {job.user_id} ждала в очереди {wait:.1f} с (глубина очереди {stats.depth})")
+        return job
+
+    def _drop_stale(self, job, now):
+        """Убрать из очереди задачу, которую пользователь уже не ждет"""
+        queue = self._user_queues[job.user_id]
+        queue.popleft()
+        if queue:
+            self._push_ready(queue[0])
+        else:
+            del self._user_queues[job.user_id]
+            self._user_finish.pop(job.user_id, None)
+
+        self.admission.observe(job.kind, now - job.ready_at, now)
+        stats = self._stats[job.kind]
+        stats.depth -= 1
+        stats.stale += 1
+        self._stale_jobs.append(job)
+        logger.info(f"Задача {job.kind} пользователя {job.user_id} устарела за {now - job.created_at:.1f} с и не будет выполнена")
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                job = self._pick()
+                while job is None and not self._stale_jobs:
+                    if self._closed and not self._user_queues:
+                        return
+                    self._cond.wait()
+                    job = self._pick()
+                stale_jobs, self._stale_jobs = self._stale_jobs, []
+            for stale in stale_jobs:
+                self._notify_stale(stale)
+            if job is not None:
+                self._run(job)
+
+    def _notify_stale(self, job):
+        if job.on_stale is None:
+            return
+        try:
+            job.on_stale()
+        except Exception as e:
+            logger.error(f"Ошибка при отмене устаревшей задачи {job.kind} пользователя {job.user_id}: {e}")
+
+    def _run(self, job):
+        failed = False
+        try:
+            job.func(*job.args, **job.kwargs)
+        except Exception as e:
+            failed = True
+            logger.error(f"Ошибка при выполнении задачи {job.kind} пользователя {job.user_id}: {e}")
+        finally:
+            with self._lock:
+                stats = self._stats[job.kind]
+                stats.running -= 1
+                stats.depth -= 1
+                if failed:
+                    stats.failed += 1
+                else:
+                    stats.completed += 1
+
+                self._running_users.discard(job.user_id)
+                queue = self._user_queues[job.user_id]
+                if queue:
+                    self._push_ready(queue[0])
+                else:
+                    # Пользователь без задач не копит ни долга, ни запаса
+                    del self._user_queues[job.user_id]
+                    self._user_finish.pop(job.user_id, None)
+                # Освободился слот типа задачи и, возможно, появилась новая задача
+                self._cond.notify_all()
+
+    def stats(self):
+        """Глубина очередей и время ожидания для каждого типа задач"""
+        with self._lock:
+            return {
+                kind: dict(stats.as_dict(), admitting=self.admission.admit(kind))
+                for kind, stats in self._stats.items()
+            }
+
+    def shutdown(self, wait=True):
+        """Перестать принимать задачи и (по умолчанию) дождаться очередей пользователей"""
+        with self._lock:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
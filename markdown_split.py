@@ -0,0 +1,150 @@
+"""Разбиение длинного ответа на сообщения с сохранением разметки Markdown.
+
+Разметка Telegram Markdown (ParseMode.MARKDOWN): *жирный*, _курсив_,
+`код`, ```блок кода``` и [ссылка](url). Сущности не вкладываются друг
+в друга, внутри сущности разметка не разбирается, вне сущностей символы
+разметки экранируются обратной косой чертой.
+"""
+import re
+
+# Сколько символов в конце части оставить под закрывающий маркер
+CLOSING_RESERVE = len("\n```")
+# Самое длинное имя языка, которое переносится в продолжение блока кода
+MAX_LANGUAGE_LENGTH = 20
+
+PRE = "```"
+
+_TOKEN = re.compile(r"\\[_*`\[]|[_*`\[]")
+_LANGUAGE = re.compile(r"```([\w+#.-]{1,%d})\n" % MAX_LANGUAGE_LENGTH)
+
+
+def _entity_end(text, i, end):
+    """Позиция сразу за сущностью, которая начинается в text[i], или -1,
+    если сущность не закрывается раньше end"""
+    if text.startswith(PRE, i):
+        close = text.find(PRE, i + len(PRE), end)
+        return -1 if close == -1 else close + len(PRE)
+    marker = text[i]
+    if marker == "[":
+        close = text.find("]", i + 1, end)
+        if close == -1:
+            return -1
+        if not text.startswith("(", close + 1):
+            return close + 1
+        paren = text.find(")", close + 2, end)
+        return -1 if paren == -1 else paren + 1
+    close = text.find(marker, i + 1, end)
+    return -1 if close == -1 else close + 1
+
+
+def _marker_at(text, i):
+    return PRE if text.startswith(PRE, i) else text[i]
+
+
+def _open_entity(text, start, end):
+    """Незакрытая к позиции end сущность: (маркер, позиция начала) или None"""
+    pos = start
+    while True:
+        match = _TOKEN.search(text, pos, end)
+        if match is None:
+            return None
+        i = match.start()
+        if text[i] == "\\":
+            pos = match.end()
+            continue
+        entity_end = _entity_end(text, i, end)
+        if entity_end == -1:
+            return _marker_at(text, i), i
+        pos = entity_end
+
+
+def is_valid_markdown(text):
+    """Telegram примет текст с ParseMode.MARKDOWN: все сущности закрыты"""
+    return _open_entity(text, 0, len(text)) is None
+
+
+def _reopen_prefix(text, marker, i):
+    """Маркер, которым сущность продолжается в следующей части"""
+    if marker != PRE:
+        return marker
+    language = _LANGUAGE.match(text, i)
+    return f"{PRE}{language.group(1)}\n" if language else f"{PRE}\n"
+
+
+def _next_part(text, start, prefix, max_length):
+    """Следующая часть начиная с позиции start.
+
+    prefix - маркер сущности, незакрытой в предыдущей части. Возвращает
+    (часть, позиция начала следующей части, prefix следующей части).
+    """
+    if len(prefix) + len(text) - start <= max_length:
+        return prefix + text[start:], len(text), ""
+
+    budget = max(max_length - len(prefix) - CLOSING_RESERVE, 1)
+    limit = start + budget
+    lower = start + budget // 2
+
+    # Предпочтительно делим по переносу строки, затем по пробелу
+    cut = text.rfind("\n", lower, limit)
+    if cut != -1:
+        cut += 1
+    else:
+        cut = text.rfind(" ", lower, limit)
+        if cut == -1:
+            cut = limit
+            if text[cut - 1] == "\\" and cut - 1 > start:
+                # Не отделяем экранирующий символ от экранируемого
+                cut -= 1
+    # При бюджете в один символ пробел может найтись прямо в start -
+    # каждая часть должна продвигаться хотя бы на символ
+    cut = max(cut, start + 1)
+
+    # Продолжение сущности из предыдущей части открыто с позиции start
+    scan_from = start
+    open_entity = None
+    if prefix:
+        carried = PRE if prefix.startswith(PRE) else prefix
+        close = text.find(carried, start, cut)
+        if close == -1:
+            open_entity = (carried, start)
+        else:
+            scan_from = close + len(carried)
+    if open_entity is None:
+        open_entity = _open_entity(text, scan_from, cut)
+
+    body = prefix + text[start:cut]
+    if open_entity is None:
+        return body, cut, ""
+
+    marker, opened_at = open_entity
+    if opened_at > lower:
+        # Сущность началась близко к концу части - переносим ее целиком
+        return prefix + text[start:opened_at], opened_at, ""
+    if marker == "[":
+        # Ссылку нельзя закрыть и продолжить; такая часть уйдет без разметки
+        return body, cut, ""
+
+    next_prefix = prefix if opened_at == start and prefix else _reopen_prefix(text, marker, opened_at)
+    if marker == PRE:
+        return body + (PRE if body.endswith("\n") else "\n" + PRE), cut, next_prefix
+    return body + marker, cut, next_prefix
+
+
+def split_markdown(text, max_length):
+    """Разбить текст на части не длиннее max_length за один проход.
+
+    Блоки кода и выделение, попавшие на границу, закрываются в конце
+    части и открываются заново в начале следующей.
+    """
+    start, prefix = 0, ""
+    while start < len(text):
+        part, start, prefix = _next_part(text, start, prefix, max_length)
+        yield part
+    if not text:
+        yield text
+
+
+def split_first(text, max_length):
+    """Первая часть и остаток текста (с маркером продолжения сущности)"""
+    part, start, prefix = _next_part(text, 0, "", max_length)
+    return part, prefix + text[start:]
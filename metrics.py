@@ -0,0 +1,198 @@
+"""Метрики в текстовом формате Prometheus и HTTP-эндпоинт для их сбора"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм времени (секунды)
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Гистограмма распределения значений"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts = entry[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        """Замерить время выполнения блока"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, *labels)
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            items = [(labels, (list(entry[0]), entry[1], entry[2])) for labels, entry in self._values.items()]
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = ("le", _format_value(bound) if bound != float("inf") else "+Inf")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Текущее значение, которое вычисляется при каждом сборе метрик.
+
+    callback возвращает число или словарь {кортеж значений меток: число}.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def render(self):
+        lines = self._header()
+        if self.callback is None:
+            return lines
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.error(f"Ошибка при вычислении метрики {self.name}: {e}")
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(port, addr="0.0.0.0"):
+    """Запустить HTTP-эндпоинт /metrics в фоновом потоке"""
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Метрики доступны на http://{addr}:{port}/metrics")
+    return server
+
+
+# Метрики, общие для всех модулей бота
+PROVIDER_CALL_SECONDS = Histogram(
+    "tgbot_provider_call_seconds", "Время вызова провайдера g4f", ["route", "outcome"])
+PROVIDER_FIRST_CHUNK_SECONDS = Histogram(
+    "tgbot_provider_first_chunk_seconds", "Время до первой части потокового ответа провайдера", ["route"])
+IMAGE_DOWNLOAD_SECONDS = Histogram(
+    "tgbot_image_download_seconds", "Время загрузки сгенерированного изображения")
+IMAGE_TRANSCODE_SECONDS = Histogram(
+    "tgbot_image_transcode_seconds", "Время перекодирования изображения перед отправкой", ["output"])
+IMAGE_UPLOAD_BYTES = Histogram(
+    "tgbot_image_upload_bytes", "Размер изображения, загружаемого в Telegram", ["output"],
+    buckets=(16384, 65536, 131072, 262144, 524288, 1048576, 2097152, 5242880, 10485760))
+TELEGRAM_SEND_SECONDS = Histogram(
+    "tgbot_telegram_send_seconds", "Время вызова Bot API при отправке ответа", ["method"])
+TELEGRAM_QUEUED_SECONDS = Histogram(
+    "tgbot_telegram_queued_seconds", "Время ожидания вызова Bot API в очереди исходящих сообщений", ["method"])
+TELEGRAM_RETRY_AFTER = Counter(
+    "tgbot_telegram_retry_after_total", "Вызовы Bot API, отклоненные Telegram с RetryAfter", ["method"])
+FALLBACK_SUCCESS = Counter(
+    "tgbot_fallback_success_total", "Какая ветка цепочки запасных вариантов вернула ответ", ["branch"])
+MARKDOWN_FAILURES = Counter(
+    "tgbot_markdown_send_failures_total", "Отправки с Markdown, повторенные без форматирования")
+MARKDOWN_INVALID = Counter(
+    "tgbot_markdown_invalid_total", "Части ответа с незакрытой разметкой, сразу отправленные без форматирования")
+INLINE_QUERIES = Counter(
+    "tgbot_inline_queries_total", "Inline-запросы по исходу: answered, cached, superseded, cancelled, failed, rejected, stale",
+    ["outcome"])
@@ -0,0 +1,134 @@
+"""Список моделей g4f с кэшем в файле и ленивый импорт g4f.
+
+Импорт g4f занимает заметную часть запуска бота, поэтому модуль
+загружается при первом обращении, а список моделей для /models берется
+из файла и обновляется в фоне.
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Файл с кэшем списка моделей
+MODEL_CACHE_PATH = "models.json"
+# Через сколько секунд список считается устаревшим и обновляется в фоне
+MODEL_CACHE_TTL = 24 * 60 * 60
+# Список на случай, если g4f не сообщает модели и кэша еще нет
+FALLBACK_MODELS = ["gpt-3.5-turbo", "gpt-4", "gpt-4o", "gpt-4o-mini"]
+
+_lock = threading.Lock()
+_import_lock = threading.Lock()
+_g4f = None
+_models = None
+_updated = 0.0
+_refreshing = False
+_resolved = {}
+
+
+def get_g4f():
+    """Модуль g4f (импортируется при первом обращении)"""
+    global _g4f
+    if _g4f is None:
+        with _import_lock:
+            if _g4f is None:
+                started = time.monotonic()
+                import g4f
+                g4f.debug.logging = False  # Отключить дебаг логи
+                _g4f = g4f
+                logger.info(f"g4f загружен за {time.monotonic() - started:.2f} с")
+    return _g4f
+
+
+def resolve_model(name):
+    """Объект модели из g4f.models по имени, если он есть, иначе само имя"""
+    if not isinstance(name, str):
+        return name
+    model = _resolved.get(name)
+    if model is None:
+        try:
+            model = getattr(get_g4f().models, name.replace("-", "_").replace(".", "_"), name)
+        except Exception:
+            model = name
+        _resolved[name] = model
+    return model
+
+
+def discover_models():
+    """Запросить список моделей у g4f"""
+    g4f = get_g4f()
+    try:
+        # Пробуем получить модели из нового API
+        return list(g4f.models.__all__)
+    except Exception:
+        try:
+            # Альтернативный способ для новых версий
+            return [model.__name__ for model in g4f.models.list()]
+        except Exception:
+            return list(FALLBACK_MODELS)
+
+
+def _load_cache(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return list(data["models"]), float(data["updated"])
+    except FileNotFoundError:
+        return None, 0.0
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать кэш моделей {path}: {e}")
+        return None, 0.0
+
+
+def _save_cache(path, models, updated):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"updated": updated, "models": models}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def refresh(path=MODEL_CACHE_PATH):
+    """Обновить список моделей и записать его в кэш"""
+    global _models, _updated, _refreshing
+    try:
+        models = discover_models()
+        updated = time.time()
+        with _lock:
+            _models, _updated = models, updated
+        _save_cache(path, models, updated)
+        logger.info(f"Список моделей обновлен: {len(models)}")
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении списка моделей: {e}")
+    finally:
+        with _lock:
+            _refreshing = False
+
+
+def refresh_in_background(path=MODEL_CACHE_PATH, ttl=MODEL_CACHE_TTL):
+    """Обновить устаревший список моделей в фоновом потоке.
+
+    Заодно загружает g4f, чтобы первый запрос не ждал импорта.
+    """
+    global _refreshing
+    available_models(path)
+    with _lock:
+        if _refreshing or (_models is not None and time.time() - _updated < ttl):
+            stale = False
+        else:
+            stale = _refreshing = True
+    target = functools.partial(refresh, path) if stale else get_g4f
+    threading.Thread(target=target, name="model-catalog", daemon=True).start()
+
+
+def available_models(path=MODEL_CACHE_PATH):
+    """Список моделей из памяти или файла кэша (без обращения к g4f)"""
+    global _models, _updated
+    if _models is None:
+        models, updated = _load_cache(path)
+        with _lock:
+            if _models is None and models is not None:
+                _models, _updated = models, updated
+    return _models if _models is not None else list(FALLBACK_MODELS)
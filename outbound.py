@@ -0,0 +1,394 @@
+"""Очередь исходящих вызовов Bot API с учетом лимитов Telegram.
+
+Telegram разрешает боту около 30 сообщений в секунду всего, одно
+сообщение в секунду в личный чат и 20 в минуту в группу. Все вызовы,
+адресованные чату (отправка, редактирование, действие "печатает"),
+проходят через SendScheduler: в каждом чате строго по очереди, с общей
+корзиной токенов и корзиной чата, а ответ 429 (RetryAfter) приостанавливает
+чат на указанное время и повторяет вызов.
+
+Обработчики обновлений выполняются в потоке диспетчера, поэтому их ответы
+не ждут лимита на месте: внутри SendScheduler.detached вызов ставится в
+очередь чата, а выполняют его SENDER_THREADS общих потоков отправки в
+порядке готовности чатов. Так пользователь, засыпающий бота сообщениями,
+ждет своей очереди сам, но не задерживает прием обновлений остальных,
+а число потоков не растет вместе с числом чатов.
+
+Промежуточные редактирования потокового ответа выполняются внутри
+SendScheduler.nowait: если лимит чата исчерпан, вызов сразу завершается
+RetryAfter, и поток генерации пропускает редактирование, а не ждет.
+"""
+import contextlib
+import functools
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+from metrics import TELEGRAM_QUEUED_SECONDS, TELEGRAM_RETRY_AFTER
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Общий лимит бота (вызовов в секунду) и допустимый всплеск
+GLOBAL_SEND_RATE = 30.0
+GLOBAL_SEND_BURST = 30.0
+# Лимит личного чата
+CHAT_SEND_RATE = 1.0
+CHAT_SEND_BURST = 3.0
+# Лимит группы (id группы отрицательный)
+GROUP_SEND_RATE = 20.0 / 60
+GROUP_SEND_BURST = 3.0
+# Лимиты считаются в каждом процессе отдельно: в webhook.py с несколькими
+# процессами общий и групповой лимиты делятся между ними (SendScheduler.split).
+# Личный чат обслуживает один процесс, его лимит не делится
+# Сколько раз повторять вызов после RetryAfter
+MAX_RETRY_AFTER_ATTEMPTS = 3
+# Наименьшая пауза, которую nowait сообщает в RetryAfter (секунды)
+NOWAIT_MIN_RETRY = 0.2
+# Потоки, выполняющие отложенные вызовы всех чатов
+SENDER_THREADS = 4
+# Как часто (в вызовах) забывать простаивающие чаты
+PURGE_EVERY = 1000
+# Методы Bot API, которые отправляют в чат: sendMessage, sendChatAction,
+# editMessageText и т. п. Остальные вызовы с chat_id (getChat, getChatMember)
+# только читают и идут мимо очереди
+SCHEDULED_METHOD_PREFIXES = ("send", "edit", "forward", "copy")
+
+
+class _ChatQueue:
+    """Очередь вызовов одного чата"""
+
+    __slots__ = ("tickets", "bucket", "busy", "paused_until", "detached", "keys", "scheduled")
+
+    def __init__(self, bucket):
+        self.tickets = deque()
+        self.bucket = bucket
+        self.busy = False
+        self.paused_until = 0.0
+        # Отложенные вызовы из обработчиков, их ключи объединения и есть ли чат в куче готовности
+        self.detached = deque()
+        self.keys = set()
+        self.scheduled = False
+
+
+class SendScheduler:
+    """Планировщик исходящих вызовов: лимиты, порядок в чате и повтор после 429.
+
+    Вызов выполняется в потоке, который его сделал, - планировщик только
+    решает, когда ему можно начаться (кроме отложенных вызовов, см. detached).
+    В одном чате одновременно выполняется не больше одного вызова, поэтому
+    части ответа приходят в том порядке, в котором были отправлены.
+    """
+
+    def __init__(self, global_rate=GLOBAL_SEND_RATE, global_burst=GLOBAL_SEND_BURST,
+                 chat_rate=CHAT_SEND_RATE, chat_burst=CHAT_SEND_BURST,
+                 group_rate=GROUP_SEND_RATE, group_burst=GROUP_SEND_BURST):
+        self._global = TokenBucket(global_burst, global_rate)
+        self._chat_limits = (chat_burst, chat_rate)
+        self._group_limits = (group_burst, group_rate)
+        self._chats = {}
+        self._cond = threading.Condition()
+        self._calls = 0
+        self._local = threading.local()
+        # Куча (время готовности, номер, chat_id, чат) чатов с отложенными вызовами
+        self._ready = []
+        self._seq = itertools.count()
+        self._senders = []
+        self.waiting = 0
+        self.retried = 0
+        self.deferred = 0
+        self.coalesced = 0
+        self.skipped = 0
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            burst, rate = self._group_limits if str(chat_id).startswith("-") else self._chat_limits
+            chat = self._chats[chat_id] = _ChatQueue(TokenBucket(burst, rate))
+        return chat
+
+    def _ready_in(self, chat, ticket, now):
+        """Через сколько секунд вызов может начаться; None - впереди другой вызов чата"""
+        if chat.tickets[0] is not ticket or chat.busy:
+            return None
+        return max(
+            chat.paused_until - now,
+            chat.bucket.wait_time(1.0, now),
+            self._global.wait_time(1.0, now),
+        )
+
+    def _take(self, chat, now):
+        chat.bucket.consume(1.0, now)
+        self._global.consume(1.0, now)
+        chat.busy = True
+
+    def _acquire(self, chat, ticket):
+        """Дождаться очереди вызова в чате и свободных токенов (под self._cond)"""
+        while True:
+            now = time.monotonic()
+            timeout = self._ready_in(chat, ticket, now)
+            if timeout is not None and timeout <= 0:
+                self._take(chat, now)
+                return
+            self._cond.wait(timeout)
+
+    def _release(self, chat_id, chat, ticket):
+        with self._cond:
+            chat.tickets.remove(ticket)
+            chat.busy = False
+            if chat.detached and not chat.scheduled:
+                # Следующим в чате может быть отложенный вызов
+                self._push(chat_id, chat, time.monotonic())
+            self._calls += 1
+            if self._calls % PURGE_EVERY == 0:
+                # Чат без очереди и с полной корзиной ничем не отличается от нового
+                now = time.monotonic()
+                self._chats = {
+                    cid: c for cid, c in self._chats.items()
+                    if c.tickets or not c.bucket.is_full(now) or c.paused_until > now
+                }
+            self._cond.notify_all()
+
+    def call(self, chat_id, method, func, *args, **kwargs):
+        """Выполнить вызов func в очереди чата chat_id и вернуть его результат"""
+        if getattr(self._local, "nowait", False):
+            return self._call_nowait(chat_id, method, func, args, kwargs)
+        ticket = object()
+        queued_at = time.monotonic()
+        with self._cond:
+            chat = self._chat(chat_id)
+            chat.tickets.append(ticket)
+        return self._call(chat_id, chat, ticket, queued_at, method, func, args, kwargs)
+
+    def _call(self, chat_id, chat, ticket, queued_at, method, func, args, kwargs):
+        try:
+            for attempt in range(MAX_RETRY_AFTER_ATTEMPTS + 1):
+                with self._cond:
+                    self.waiting += 1
+                    try:
+                        self._acquire(chat, ticket)
+                    finally:
+                        self.waiting -= 1
+                TELEGRAM_QUEUED_SECONDS.observe(time.monotonic() - queued_at, method)
+                try:
+                    return func(*args, **kwargs)
+                except RetryAfter as e:
+                    self.retried += 1
+                    TELEGRAM_RETRY_AFTER.inc(method)
+                    logger.warning(f"{method} в чат {chat_id}: превышен лимит Telegram, ожидание {e.retry_after} с")
+                    if attempt == MAX_RETRY_AFTER_ATTEMPTS:
+                        raise
+                    # Вызов остается первым в очереди чата и повторяется после паузы
+                    queued_at = time.monotonic()
+                    with self._cond:
+                        chat.busy = False
+                        chat.paused_until = queued_at + e.retry_after
+        finally:
+            self._release(chat_id, chat, ticket)
+
+    def _call_nowait(self, chat_id, method, func, args, kwargs):
+        """Выполнить вызов, только если он может начаться сразу, иначе бросить RetryAfter"""
+        ticket = object()
+        with self._cond:
+            chat = self._chat(chat_id)
+            now = time.monotonic()
+            # Вызовы, уже ждущие в очереди чата, тоже спишут токены
+            wait = max(
+                chat.paused_until - now,
+                chat.bucket.wait_time(1.0 + len(chat.tickets), now),
+                self._global.wait_time(1.0, now),
+            )
+            if chat.tickets or wait > 0:
+                self.skipped += 1
+                raise RetryAfter(max(wait, NOWAIT_MIN_RETRY))
+            chat.tickets.append(ticket)
+            self._take(chat, now)
+        try:
+            return func(*args, **kwargs)
+        except RetryAfter as e:
+            # Не повторяем: вызывающий сам решает, нужен ли еще этот вызов
+            self.retried += 1
+            TELEGRAM_RETRY_AFTER.inc(method)
+            with self._cond:
+                chat.paused_until = time.monotonic() + e.retry_after
+            raise
+        finally:
+            self._release(chat_id, chat, ticket)
+
+    def split(self, processes):
+        """Оставить этому процессу 1/processes общего и группового лимита.
+
+        Участники группы попадают в разные процессы, поэтому делится и лимит группы.
+        Вызывается при запуске процесса, до первой отправки.
+        """
+        if processes <= 1:
+            return
+        with self._cond:
+            self._global = TokenBucket(max(1.0, self._global.capacity / processes), self._global.rate / processes)
+            burst, rate = self._group_limits
+            self._group_limits = (max(1.0, burst / processes), rate / processes)
+        logger.info(f"Лимиты Telegram поделены между {processes} процессами: "
+                    f"{self._global.rate:.1f} вызовов в секунду на процесс")
+
+    @contextlib.contextmanager
+    def detached(self, key=None):
+        """Вызовы из этого потока внутри блока не ждут очереди чата, а откладываются.
+
+        Если в очереди чата уже ждет отложенный вызов с тем же key (например,
+        уведомление о лимите), новый отбрасывается.
+        """
+        previous = getattr(self._local, "mode", None)
+        self._local.mode = (key,)
+        try:
+            yield
+        finally:
+            self._local.mode = previous
+
+    @contextlib.contextmanager
+    def nowait(self):
+        """Вызовы из этого потока внутри блока не ждут очереди и лимита чата.
+
+        Вызов, который не может начаться сразу, бросает RetryAfter с оценкой
+        ожидания; RetryAfter от Telegram не повторяется.
+        """
+        previous = getattr(self._local, "nowait", False)
+        self._local.nowait = True
+        try:
+            yield
+        finally:
+            self._local.nowait = previous
+
+    def detach_handler(self, handler):
+        """Обработчик обновлений, ответы которого не блокируют поток диспетчера"""
+        @functools.wraps(handler)
+        def detached_handler(*args, **kwargs):
+            with self.detached():
+                return handler(*args, **kwargs)
+        return detached_handler
+
+    def detached_mode(self):
+        """(key,) внутри detached, иначе None"""
+        return getattr(self._local, "mode", None)
+
+    def defer(self, chat_id, method, key, func, *args, **kwargs):
+        """Поставить вызов в очередь чата и сразу вернуться. False - вызов объединен с ожидающим"""
+        with self._cond:
+            chat = self._chat(chat_id)
+            if key is not None and key in chat.keys:
+                self.coalesced += 1
+                return False
+            ticket = object()
+            chat.tickets.append(ticket)
+            chat.detached.append((ticket, key, time.monotonic(), method, func, args, kwargs, 0))
+            chat.keys.add(key)
+            self.deferred += 1
+            if not chat.scheduled:
+                self._push(chat_id, chat, time.monotonic())
+            if not self._senders:
+                self._senders = [
+                    threading.Thread(target=self._send_loop, name=f"send-{i}", daemon=True)
+                    for i in range(SENDER_THREADS)
+                ]
+                for sender in self._senders:
+                    sender.start()
+        return True
+
+    def _push(self, chat_id, chat, ready_at):
+        """Поставить чат в кучу готовности (под self._cond)"""
+        chat.scheduled = True
+        heapq.heappush(self._ready, (ready_at, next(self._seq), chat_id, chat))
+        self._cond.notify_all()
+
+    def _next_deferred(self):
+        """Дождаться чата, отложенный вызов которого может начаться (под self._cond)"""
+        while True:
+            if not self._ready:
+                self._cond.wait()
+                continue
+            ready_at, _, chat_id, chat = self._ready[0]
+            now = time.monotonic()
+            if ready_at > now:
+                self._cond.wait(ready_at - now)
+                continue
+            heapq.heappop(self._ready)
+            chat.scheduled = False
+            if not chat.detached:
+                continue
+            wait = self._ready_in(chat, chat.detached[0][0], now)
+            if wait is None:
+                # Впереди вызов из другого потока - его _release вернет чат в кучу
+                continue
+            if wait > 0:
+                self._push(chat_id, chat, now + wait)
+                continue
+            self._take(chat, now)
+            entry = chat.detached.popleft()
+            chat.keys.discard(entry[1])
+            return chat_id, chat, entry
+
+    def _send_loop(self):
+        """Поток отправки: выполняет отложенные вызовы тех чатов, чья очередь подошла раньше"""
+        while True:
+            with self._cond:
+                chat_id, chat, entry = self._next_deferred()
+            self._run_deferred(chat_id, chat, entry)
+
+    def _run_deferred(self, chat_id, chat, entry):
+        ticket, key, queued_at, method, func, args, kwargs, attempt = entry
+        TELEGRAM_QUEUED_SECONDS.observe(time.monotonic() - queued_at, method)
+        try:
+            func(*args, **kwargs)
+        except RetryAfter as e:
+            self.retried += 1
+            TELEGRAM_RETRY_AFTER.inc(method)
+            logger.warning(f"{method} в чат {chat_id}: превышен лимит Telegram, ожидание {e.retry_after} с")
+            if attempt < MAX_RETRY_AFTER_ATTEMPTS:
+                # Вызов остается первым в очереди чата и повторяется после паузы
+                now = time.monotonic()
+                with self._cond:
+                    chat.busy = False
+                    chat.paused_until = now + e.retry_after
+                    chat.detached.appendleft((ticket, key, now, method, func, args, kwargs, attempt + 1))
+                    self._push(chat_id, chat, chat.paused_until)
+                return
+            logger.error(f"Отложенный вызов {method} в чат {chat_id} не выполнен: {e}")
+        except Exception as e:
+            logger.error(f"Отложенный вызов {method} в чат {chat_id} не выполнен: {e}")
+        self._release(chat_id, chat, ticket)
+
+    def stats(self):
+        with self._cond:
+            return {"waiting": self.waiting, "chats": len(self._chats), "retried": self.retried,
+                    "deferred": self.deferred, "coalesced": self.coalesced, "skipped": self.skipped}
+
+
+def is_scheduled(endpoint, data):
+    """Нужно ли вызову ждать очереди и лимита чата"""
+    return (data or {}).get("chat_id") is not None and endpoint.startswith(SCHEDULED_METHOD_PREFIXES)
+
+
+class ScheduledBot(ExtBot):
+    """Bot, у которого отправки в чат проходят через SendScheduler"""
+
+    __slots__ = ("scheduler",)
+
+    def __init__(self, *args, scheduler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler or SendScheduler()
+
+    def _post(self, endpoint, data=None, *args, **kwargs):
+        if not is_scheduled(endpoint, data):
+            return super()._post(endpoint, data, *args, **kwargs)
+        chat_id = data["chat_id"]
+        mode = self.scheduler.detached_mode()
+        if mode is not None:
+            # Ответ обработчика: отправит общий поток отправки, а вызов сразу возвращает True
+            self.scheduler.defer(chat_id, endpoint, mode[0], super()._post, endpoint, data, *args, **kwargs)
+            return True
+        return self.scheduler.call(chat_id, endpoint, super()._post, endpoint, data, *args, **kwargs)
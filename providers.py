@@ -0,0 +1,239 @@
+"""Выбор самого быстрого провайдера и дублирующие (hedged) запросы"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from deadlines import DeadlineExceeded, record_timeout
+from metrics import PROVIDER_CALL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних замеров задержки хранить для каждого провайдера
+LATENCY_WINDOW = 50
+# Предполагаемая задержка провайдера, для которого еще нет замеров
+DEFAULT_LATENCY = 8.0
+# Через сколько секунд без ответа запускать дублирующий запрос, пока нет замеров
+DEFAULT_HEDGE_DELAY = 10.0
+# Минимальная задержка перед дублирующим запросом
+MIN_HEDGE_DELAY = 1.0
+# Сколько ошибок подряд выключает провайдер
+FAILURE_THRESHOLD = 3
+# На сколько секунд выключается провайдер
+COOLDOWN_SECONDS = 60.0
+# Потоки для параллельных попыток (включая брошенные медленные)
+ROUTER_WORKERS = 16
+
+
+class AllProvidersFailed(Exception):
+    """Ни один провайдер не вернул ответ"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        details = "; ".join(f"{name}: {error}" for name, error in errors)
+        super().__init__(details or "нет доступных провайдеров")
+
+
+class RouteStats:
+    """Скользящая статистика задержек и ошибок одного провайдера"""
+
+    def __init__(self):
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        # Время до первой части потокового ответа: в задержку перед
+        # дублирующим запросом не входит, она считается по полному ответу
+        self.first_chunks = deque(maxlen=LATENCY_WINDOW)
+        self.outcomes = deque(maxlen=LATENCY_WINDOW)
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def percentile(self, fraction, samples=None):
+        if samples is None:
+            samples = self.latencies
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(fraction * len(ordered)))
+        return ordered[index]
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return 1.0 - sum(self.outcomes) / len(self.outcomes)
+
+    def score(self):
+        """Чем меньше, тем лучше: медиана задержки с поправкой на ошибки"""
+        p50 = self.percentile(0.5)
+        if p50 is None:
+            p50 = DEFAULT_LATENCY
+        return p50 * (1.0 + 2.0 * self.error_rate())
+
+    def hedge_delay(self):
+        p95 = self.percentile(0.95)
+        if p95 is None:
+            return DEFAULT_HEDGE_DELAY
+        return max(MIN_HEDGE_DELAY, p95)
+
+    def is_open(self, now):
+        return self.open_until > now
+
+
+class ProviderRouter:
+    """Отправляет запрос самому быстрому исправному провайдеру.
+
+    Если ответ не пришел за p95 задержки этого провайдера, параллельно
+    запускается следующий по рейтингу, и берется первый успешный ответ.
+    Провайдер, несколько раз подряд вернувший ошибку, выключается на
+    COOLDOWN_SECONDS, после чего получает одну пробную попытку.
+    """
+
+    def __init__(self, name="router", workers=ROUTER_WORKERS):
+        self.name = name
+        self._routes = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.hedges = 0
+
+    def add_route(self, name, func):
+        """Зарегистрировать провайдер: func(*args, **kwargs) возвращает ответ или бросает исключение"""
+        self._routes[name] = func
+        self._stats[name] = RouteStats()
+
+    def ranked(self):
+        """Провайдеры в порядке предпочтения; выключенные - только если других нет"""
+        now = time.monotonic()
+        with self._lock:
+            healthy = [name for name in self._routes if not self._stats[name].is_open(now)]
+            if not healthy:
+                # Все выключены - пробуем тот, что включится раньше остальных
+                return sorted(self._routes, key=lambda name: self._stats[name].open_until)
+            return sorted(healthy, key=lambda name: self._stats[name].score())
+
+    def _attempt(self, name, args, kwargs):
+        started = time.monotonic()
+        try:
+            result = self._routes[name](*args, **kwargs)
+            if not result:
+                raise ValueError("пустой ответ")
+        except Exception:
+            latency = time.monotonic() - started
+            PROVIDER_CALL_SECONDS.observe(latency, name, "error")
+            self._record(name, latency, ok=False)
+            raise
+        latency = time.monotonic() - started
+        PROVIDER_CALL_SECONDS.observe(latency, name, "ok")
+        self._record(name, latency, ok=True)
+        return result
+
+    def record(self, name, latency, ok, first_chunk=None):
+        """Учесть попытку, выполненную в обход call (например, потоковый ответ).
+
+        latency=None учитывает только исход попытки; first_chunk - время до
+        первой части потокового ответа, хранится отдельно от задержек.
+        """
+        if name in self._stats:
+            self._record(name, latency, ok, first_chunk)
+
+    def _record(self, name, latency, ok, first_chunk=None):
+        with self._lock:
+            stats = self._stats[name]
+            stats.outcomes.append(1 if ok else 0)
+            if first_chunk is not None:
+                stats.first_chunks.append(first_chunk)
+            if ok:
+                if latency is not None:
+                    stats.latencies.append(latency)
+                stats.successes += 1
+                stats.consecutive_failures = 0
+                stats.open_until = 0.0
+                return
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            if stats.consecutive_failures >= FAILURE_THRESHOLD:
+                stats.open_until = time.monotonic() + COOLDOWN_SECONDS
+                logger.warning(f"Провайдер {name} выключен на {COOLDOWN_SECONDS:.0f} с после {stats.consecutive_failures} ошибок подряд")
+
+    def call(self, *args, deadline=None, **kwargs):
+        """Выполнить запрос и вернуть (ответ, имя провайдера).
+
+        Срок deadline передается каждой попытке; когда он истекает,
+        незавершенные попытки бросаются и выбрасывается DeadlineExceeded.
+        """
+        if deadline is not None:
+            kwargs["deadline"] = deadline
+        order = self.ranked()
+        pending = {}
+        errors = []
+        next_index = 0
+        hedge_at = None
+
+        def launch():
+            nonlocal next_index, hedge_at
+            name = order[next_index]
+            next_index += 1
+            future = self._pool.submit(self._attempt, name, args, kwargs)
+            pending[future] = name
+            with self._lock:
+                delay = self._stats[name].hedge_delay()
+            hedge_at = time.monotonic() + delay
+
+        launch()
+        while pending:
+            timeout = None
+            if next_index < len(order):
+                timeout = max(0.0, hedge_at - time.monotonic())
+            if deadline is not None:
+                timeout = deadline.remaining() if timeout is None else min(timeout, deadline.remaining())
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done and deadline is not None and deadline.expired():
+                # Срок истек - ответы медленных попыток больше никому не нужны
+                for future in pending:
+                    future.cancel()
+                if not deadline.cancelled:
+                    record_timeout(f"{self.name}:{','.join(pending.values())}")
+                raise DeadlineExceeded(self.name)
+
+            if not done:
+                # Текущие попытки дольше своего p95 - запускаем дублирующий запрос
+                with self._lock:
+                    self.hedges += 1
+                logger.info(f"Дублирующий запрос к {order[next_index]}: нет ответа от {', '.join(pending.values())}")
+                launch()
+                continue
+
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    return future.result(), name
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Провайдер {name} вернул ошибку: {e}")
+                    errors.append((name, e))
+
+            # Ошибка - не ждем p95, сразу переходим к следующему провайдеру
+            if next_index < len(order):
+                launch()
+
+        raise AllProvidersFailed(errors)
+
+    def stats(self):
+        """Задержки, ошибки и состояние каждого провайдера"""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                name: {
+                    "p50": stats.percentile(0.5),
+                    "p95": stats.percentile(0.95),
+                    "first_chunk_p50": stats.percentile(0.5, stats.first_chunks),
+                    "error_rate": stats.error_rate(),
+                    "successes": stats.successes,
+                    "failures": stats.failures,
+                    "open": stats.is_open(now),
+                }
+                for name, stats in self._stats.items()
+            }
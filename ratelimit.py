@@ -0,0 +1,83 @@
+"""Ограничение частоты запросов (token bucket)"""
+import threading
+import time
+
+# Емкость корзины пользователя и скорость ее пополнения (токенов в секунду)
+USER_BUCKET_CAPACITY = 10.0
+USER_BUCKET_RATE = 10.0 / 60
+# Стоимость запросов в токенах
+REQUEST_COSTS = {
+    "text": 1.0,
+    "image": 4.0,
+}
+# Стоимость каждого дополнительного варианта изображения (/image N <описание>)
+IMAGE_VARIANT_COST = 2.0
+# Как часто (в вызовах) выбрасывать полностью пополненные корзины
+PURGE_EVERY = 1000
+
+
+class TokenBucket:
+    """Корзина токенов: пополняется с постоянной скоростью до capacity"""
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, cost=1.0, now=None):
+        """Списать cost токенов. Возвращает (разрешено, сколько секунд ждать)"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True, 0.0
+        return False, (cost - self.tokens) / self.rate
+
+    def wait_time(self, cost=1.0, now=None):
+        """Через сколько секунд можно будет списать cost токенов (без списания)"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class UserRateLimiter:
+    """Отдельная корзина токенов для каждого пользователя"""
+
+    def __init__(self, capacity=USER_BUCKET_CAPACITY, rate=USER_BUCKET_RATE, costs=None):
+        self.capacity = capacity
+        self.rate = rate
+        self.costs = costs or REQUEST_COSTS
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._calls = 0
+        self.throttled = 0
+
+    def consume(self, user_id, kind, cost=None):
+        """Списать стоимость запроса kind (или явно заданную cost).
+        Возвращает (разрешено, сколько секунд ждать)"""
+        if cost is None:
+            cost = self.costs.get(kind, 1.0)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = TokenBucket(self.capacity, self.rate)
+            allowed, retry_after = bucket.consume(cost, now)
+            if not allowed:
+                self.throttled += 1
+
+            self._calls += 1
+            if self._calls % PURGE_EVERY == 0:
+                # Полная корзина ничем не отличается от новой - ее можно забыть
+                self._buckets = {uid: b for uid, b in self._buckets.items() if not b.is_full(now)}
+            return allowed, retry_after
@@ -0,0 +1,271 @@
+"""Хранилище сессий пользователей в SQLite с отложенной записью"""
+import functools
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from context_window import ConversationWindow
+
+logger = logging.getLogger(__name__)
+
+# Файл базы данных сессий
+SESSION_DB_PATH = "sessions.db"
+# Сколько пользователей держать в памяти одновременно
+MAX_CACHED_USERS = 5000
+# Через сколько секунд бездействия пользователь выгружается из памяти
+IDLE_EVICT_SECONDS = 30 * 60
+# Интервал пакетной записи изменений на диск
+FLUSH_INTERVAL = 5.0
+
+
+class Session:
+    """Состояние одного пользователя в памяти"""
+
+    __slots__ = ("user_id", "history", "mode", "image", "last_access")
+
+    def __init__(self, user_id, history=None, mode=None, image=None):
+        self.user_id = user_id
+        self.history = history
+        self.mode = mode
+        # Настройки изображений пользователя: {"size": ..., "output": ...}
+        self.image = image
+        self.last_access = time.monotonic()
+
+    def to_row(self):
+        history = json.dumps(self.history.to_state(), ensure_ascii=False) if self.history is not None else None
+        image = json.dumps(self.image) if self.image is not None else None
+        return (self.user_id, self.mode, history, image, time.time())
+
+
+class SessionStore:
+    """Сессии пользователей: горячие в памяти (LRU), остальные в SQLite.
+
+    История пользователя загружается с диска при первом обращении.
+    Изменения копятся в памяти и записываются фоновым потоком одной
+    транзакцией раз в FLUSH_INTERVAL секунд, поэтому обработчик сообщения
+    никогда не ждет диск для уже загруженного пользователя.
+    """
+
+    def __init__(self, path=SESSION_DB_PATH, model=None, max_cached=MAX_CACHED_USERS,
+                 idle_seconds=IDLE_EVICT_SECONDS, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.model = model
+        self.max_cached = max_cached
+        self.idle_seconds = idle_seconds
+        self.flush_interval = flush_interval
+
+        self._lock = threading.RLock()
+        self._sessions = OrderedDict()
+        self._dirty = set()
+        # Строки выгруженных из памяти, но еще не записанных сессий
+        self._pending = {}
+
+        self._reader = self._connect()
+        self._reader.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, mode TEXT, history TEXT, image TEXT, updated REAL)"
+        )
+        # Базы, созданные до появления настроек изображений
+        columns = {row[1] for row in self._reader.execute("PRAGMA table_info(sessions)")}
+        if "image" not in columns:
+            self._reader.execute("ALTER TABLE sessions ADD COLUMN image TEXT")
+        self._reader.commit()
+        self._writer = self._connect()
+        self._reader_lock = threading.Lock()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name="session-flush", daemon=True)
+        self._thread.start()
+
+        self.history = _SessionField(self, "history")
+        self.mode = _SessionField(self, "mode")
+        self.image = _SessionField(self, "image")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def get(self, user_id):
+        """Сессия пользователя (загружается с диска при первом обращении)"""
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is not None:
+                self._sessions.move_to_end(user_id)
+                session.last_access = time.monotonic()
+                return session
+            row = self._pending.get(user_id)
+
+        if row is None:
+            row = self._load_row(user_id)
+        session = self._session_from_row(user_id, row)
+
+        with self._lock:
+            # Другой поток мог загрузить сессию, пока мы читали с диска
+            existing = self._sessions.get(user_id)
+            if existing is not None:
+                return existing
+            self._sessions[user_id] = session
+            self._evict_overflow()
+            return session
+
+    def mark_dirty(self, user_id):
+        with self._lock:
+            if user_id in self._sessions:
+                self._dirty.add(user_id)
+
+    def _load_row(self, user_id):
+        with self._reader_lock:
+            cursor = self._reader.execute(
+                "SELECT user_id, mode, history, image, updated FROM sessions WHERE user_id = ?", (user_id,)
+            )
+            return cursor.fetchone()
+
+    def _session_from_row(self, user_id, row):
+        if row is None:
+            return Session(user_id)
+        _, mode, history, image, _ = row
+        window = None
+        if history is not None:
+            try:
+                window = ConversationWindow.from_state(json.loads(history), self.model)
+            except Exception as e:
+                logger.error(f"Не удалось восстановить историю пользователя {user_id}: {e}")
+                window = ConversationWindow(self.model)
+        try:
+            image = json.loads(image) if image else None
+        except ValueError:
+            image = None
+        if window is not None:
+            self.watch(user_id, window)
+        return Session(user_id, window, mode, image)
+
+    def watch(self, user_id, window):
+        """Помечать сессию для записи после каждого изменения истории"""
+        window.on_change = functools.partial(self.mark_dirty, user_id)
+
+    def _evict(self, user_id):
+        session = self._sessions.pop(user_id)
+        if user_id in self._dirty:
+            self._dirty.discard(user_id)
+            self._pending[user_id] = session.to_row()
+
+    def _evict_overflow(self):
+        while len(self._sessions) > self.max_cached:
+            self._evict(next(iter(self._sessions)))
+
+    def _evict_idle(self):
+        deadline = time.monotonic() - self.idle_seconds
+        with self._lock:
+            # OrderedDict упорядочен по последнему обращению
+            while self._sessions:
+                user_id, session = next(iter(self._sessions.items()))
+                if session.last_access > deadline:
+                    break
+                self._evict(user_id)
+
+    def flush(self):
+        """Записать все накопленные изменения одной транзакцией"""
+        with self._lock:
+            rows = list(self._pending.values())
+            written = dict(self._pending)
+            sessions = [self._sessions[user_id] for user_id in self._dirty if user_id in self._sessions]
+            self._dirty.clear()
+        # Сериализация истории не держит блокировку хранилища: get() в потоках
+        # обработчиков не ждет записи. Изменение после снятия отметки снова
+        # пометит сессию и попадет в следующую запись
+        rows.extend(session.to_row() for session in sessions)
+        if not rows:
+            return 0
+
+        try:
+            with self._writer:
+                self._writer.executemany(
+                    "INSERT OR REPLACE INTO sessions (user_id, mode, history, image, updated) VALUES (?, ?, ?, ?, ?)", rows
+                )
+        except Exception as e:
+            logger.error(f"Ошибка при записи сессий в базу: {e}")
+            return 0
+
+        with self._lock:
+            # Строку можно забыть, только если ее не заменили новой
+            for user_id, row in written.items():
+                if self._pending.get(user_id) is row:
+                    del self._pending[user_id]
+        return len(rows)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self._evict_idle()
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой записи сессий: {e}")
+
+    def close(self):
+        """Остановить фоновый поток и записать оставшиеся изменения"""
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        self._reader.close()
+        self._writer.close()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def stats(self):
+        """Пользователи в памяти и суммарный размер их истории"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            pending = len(self._pending)
+        histories = [s.history for s in sessions if s.history is not None]
+        return {
+            "active_users": len(sessions),
+            "history_turns": sum(len(h) for h in histories),
+            "history_tokens": sum(h.sent_tokens() for h in histories),
+            "pending_writes": pending,
+        }
+
+
+class _SessionField(MutableMapping):
+    """Словарь user_id -> поле сессии поверх хранилища"""
+
+    def __init__(self, store, field):
+        self._store = store
+        self._field = field
+
+    def __getitem__(self, user_id):
+        value = getattr(self._store.get(user_id), self._field)
+        if value is None:
+            raise KeyError(user_id)
+        return value
+
+    def __setitem__(self, user_id, value):
+        if self._field == "history" and value is not None:
+            # Историю меняют на месте через append, сессия помечается после изменения
+            self._store.watch(user_id, value)
+        setattr(self._store.get(user_id), self._field, value)
+        self._store.mark_dirty(user_id)
+
+    def __delitem__(self, user_id):
+        session = self._store.get(user_id)
+        if getattr(session, self._field) is None:
+            raise KeyError(user_id)
+        setattr(session, self._field, None)
+        self._store.mark_dirty(user_id)
+
+    def __contains__(self, user_id):
+        return getattr(self._store.get(user_id), self._field) is not None
+
+    def __iter__(self):
+        with self._store._lock:
+            sessions = list(self._store._sessions.values())
+        return iter([s.user_id for s in sessions if getattr(s, self._field) is not None])
+
+    def __len__(self):
+        return sum(1 for _ in self)
@@ -0,0 +1,189 @@
+"""Приведение ответа g4f любой формы к потоку текстовых частей.
+
+Провайдеры возвращают объекты в стиле OpenAI (целиком или по частям),
+словари, строки, байты или "сырой" поток SSE вида data: {...}, причем
+строка SSE может быть разрезана между частями. iter_deltas превращает
+любой из этих вариантов в последовательность кусков текста, а
+collect_text собирает их за линейное время.
+"""
+import codecs
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+SSE_PREFIX = "data:"
+
+
+def content_of(item):
+    """Текст из одной части ответа: объекта OpenAI, словаря или строки"""
+    if item is None:
+        return None
+    if isinstance(item, str):
+        return item
+    if isinstance(item, dict):
+        if item.get("content"):
+            return item["content"]
+        message = item.get("message") or {}
+        if isinstance(message, dict) and message.get("content"):
+            return message["content"]
+        choices = item.get("choices")
+        if choices:
+            return content_of(choices[0].get("delta") or choices[0].get("message"))
+        return None
+    choices = getattr(item, "choices", None)
+    if choices:
+        choice = choices[0]
+        delta = getattr(choice, "delta", None)
+        content = getattr(delta, "content", None) if delta is not None else None
+        if content is None:
+            message = getattr(choice, "message", None)
+            content = getattr(message, "content", None)
+        return content
+    return getattr(item, "content", None)
+
+
+class SSEDecoder:
+    """Разбор потока строк data: {...}, которые могут приходить кусками"""
+
+    def __init__(self):
+        self._buffer = ""
+
+    def _line(self, line):
+        line = line.strip()
+        if not line.startswith(SSE_PREFIX):
+            return None
+        payload = line[len(SSE_PREFIX):].strip()
+        if not payload.startswith("{"):
+            return None
+        try:
+            return content_of(json.loads(payload))
+        except Exception as json_error:
+            logger.error(f"Ошибка при разборе JSON из потокового ответа: {json_error}")
+            return None
+
+    def feed(self, text):
+        """Части текста из завершенных строк"""
+        self._buffer += text
+        if "\n" not in text:
+            return
+        *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            content = self._line(line)
+            if content:
+                yield content
+
+    def flush(self):
+        """Части текста из последней строки без перевода строки"""
+        line, self._buffer = self._buffer, ""
+        content = self._line(line)
+        if content:
+            yield content
+
+
+def is_sse(text):
+    """Строка - это поток SSE в текстовом виде (начинается с data:).
+
+    Обычный ответ, в котором пример SSE встречается где-то в середине, потоком не считается.
+    """
+    return text.lstrip().startswith(SSE_PREFIX)
+
+
+def _undecoded(text):
+    """Текст, из которого SSE не дал ни одной части: обычный ответ, если в нем
+    есть строки не data: (пустой поток вроде data: [DONE] остается пустым)"""
+    if all(line.lstrip().startswith(SSE_PREFIX) for line in text.splitlines() if line.strip()):
+        return []
+    return [text]
+
+
+def _decode_sse(text):
+    decoder = SSEDecoder()
+    parts = [*decoder.feed(text), *decoder.flush()]
+    return parts or _undecoded(text)
+
+
+def _iter_stream(chunks, deadline, stage):
+    utf8 = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    decoder = None  # SSEDecoder, если строковый поток оказался SSE
+    raw = []  # Исходный текст SSE, пока из него не получено ни одной части
+    head = ""  # Начало строкового потока, пока неясно, SSE это или обычный текст
+    sniffing = True
+    for chunk in chunks:
+        if deadline is not None:
+            deadline.check(stage)
+        if isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk)
+        if not isinstance(chunk, str):
+            content = content_of(chunk)
+            if content:
+                yield content
+        elif decoder is not None:
+            parts = list(decoder.feed(chunk))
+            if raw is not None:
+                raw.append(chunk)
+                if parts:
+                    raw = None
+            yield from parts
+        elif not sniffing:
+            if chunk:
+                yield chunk
+        else:
+            head += chunk
+            stripped = head.lstrip()
+            if len(stripped) < len(SSE_PREFIX) and SSE_PREFIX.startswith(stripped):
+                continue
+            sniffing = False
+            if stripped.startswith(SSE_PREFIX):
+                decoder = SSEDecoder()
+                parts = list(decoder.feed(head))
+                raw = None if parts else [head]
+                yield from parts
+            elif head:
+                yield head
+
+    tail = utf8.decode(b"", final=True)
+    if sniffing:
+        # Поток закончился раньше, чем стало ясно, SSE ли это
+        tail = head + tail
+        if tail.lstrip().startswith(SSE_PREFIX):
+            decoder = SSEDecoder()
+    if decoder is not None:
+        parts = [*decoder.feed(tail), *decoder.flush()]
+        if not parts and raw is not None:
+            # Ни одна строка data: не дала текста - отдаем ответ как есть
+            raw.append(tail)
+            parts = _undecoded("".join(raw))
+        yield from parts
+    elif tail:
+        yield tail
+
+
+def iter_deltas(response, deadline=None, stage="text"):
+    """Части текста из ответа любой формы.
+
+    deadline проверяется перед каждой частью потока.
+    """
+    if response is None:
+        return
+    if isinstance(response, bytes):
+        response = response.decode("utf-8", "replace")
+    if isinstance(response, str):
+        if is_sse(response):
+            logger.warning("Обнаружен потоковый ответ в текстовом формате")
+            yield from _decode_sse(response)
+        elif response:
+            yield response
+        return
+    if isinstance(response, dict) or getattr(response, "choices", None) is not None:
+        content = content_of(response)
+        if content:
+            # Содержимое целого ответа тоже может оказаться потоком SSE
+            yield from iter_deltas(content, deadline, stage)
+        return
+    yield from _iter_stream(iter(response), deadline, stage)
+
+
+def collect_text(response, deadline=None, stage="text"):
+    """Весь текст ответа любой формы"""
+    return "".join(iter_deltas(response, deadline, stage))
@@ -0,0 +1,159 @@
+"""Потоковая отправка ответа с постепенным редактированием сообщения"""
+import contextlib
+import logging
+import time
+
+from telegram import ParseMode
+from telegram.error import BadRequest, RetryAfter
+
+from markdown_split import is_valid_markdown
+from metrics import TELEGRAM_SEND_SECONDS, MARKDOWN_FAILURES, MARKDOWN_INVALID
+
+logger = logging.getLogger(__name__)
+
+# Минимальный интервал между редактированиями одного сообщения (секунды)
+STREAM_EDIT_INTERVAL = 1.0
+# Текст сообщения-заглушки до прихода первых данных
+STREAM_PLACEHOLDER = "⏳ Генерирую ответ..."
+# Маркер, который показывается в конце текста, пока ответ еще генерируется
+STREAM_CURSOR = " ▌"
+
+
+class LiveReply:
+    """Ответ, который редактируется по мере поступления текста.
+
+    Все части, пришедшие между двумя редактированиями, объединяются
+    в одно редактирование. Когда текст не помещается в сообщение,
+    оно закрывается и ответ продолжается в новом сообщении.
+
+    Если у бота есть очередь отправки (outbound.ScheduledBot), промежуточные
+    редактирования не ждут лимита чата, а пропускаются до следующего раза.
+    """
+
+    def __init__(self, bot, chat_id, reply_to_message_id=None, max_length=4000,
+                 interval=STREAM_EDIT_INTERVAL, splitter=None):
+        # splitter(text, max_length) -> (первая часть, остаток)
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.max_length = max_length
+        self.interval = interval
+        self.splitter = splitter
+        self._scheduler = getattr(bot, "scheduler", None)
+        self.edits = 0
+        self._message = None
+        self._chunks = []
+        self._current = ""
+        self._shown = None
+        self._formatted = False
+        self._next_edit_at = 0.0
+        self._full = []
+
+    def start(self):
+        """Отправить сообщение-заглушку"""
+        with TELEGRAM_SEND_SECONDS.time("sendMessage"):
+            self._message = self.bot.send_message(
+                chat_id=self.chat_id,
+                text=STREAM_PLACEHOLDER,
+                reply_to_message_id=self.reply_to_message_id,
+            )
+        self._shown = STREAM_PLACEHOLDER
+        self._next_edit_at = time.monotonic() + self.interval
+
+    def feed(self, delta):
+        """Добавить часть текста; редактирование происходит не чаще interval"""
+        if not delta:
+            return
+        self._chunks.append(delta)
+        self._full.append(delta)
+        if time.monotonic() >= self._next_edit_at:
+            self._flush(final=False)
+
+    def finish(self):
+        """Показать итоговый текст и вернуть ответ целиком"""
+        self._flush(final=True)
+        return "".join(self._full)
+
+    def stream(self, deltas):
+        """Отправить весь поток частей и вернуть полный текст"""
+        self.start()
+        for delta in deltas:
+            self.feed(delta)
+        return self.finish()
+
+    def _flush(self, final):
+        if self._chunks:
+            self._current += "".join(self._chunks)
+            self._chunks = []
+
+        # Текст не помещается - закрываем текущее сообщение и продолжаем в новом
+        while len(self._current) > self.max_length:
+            if self.splitter:
+                head, self._current = self.splitter(self._current, self.max_length)
+            else:
+                head, self._current = self._current[:self.max_length], self._current[self.max_length:]
+            self._edit(head, markdown=True)
+            self._message = self._send(self._current[:self.max_length] or STREAM_PLACEHOLDER)
+
+        if final:
+            self._edit(self._current or "Не удалось получить ответ от модели.", markdown=True)
+        elif self._current and self._current != self._shown:
+            self._edit(self._current + STREAM_CURSOR, markdown=False)
+
+    def _send(self, text):
+        with TELEGRAM_SEND_SECONDS.time("sendMessage"):
+            message = self.bot.send_message(chat_id=self.chat_id, text=text)
+        self._shown = text
+        self._formatted = False
+        self._next_edit_at = time.monotonic() + self.interval
+        return message
+
+    def _sending(self, final):
+        """Промежуточное редактирование не ждет лимита чата в очереди отправки"""
+        if final or self._scheduler is None:
+            return contextlib.nullcontext()
+        return self._scheduler.nowait()
+
+    def _edit(self, text, markdown):
+        final = markdown
+        if markdown and not is_valid_markdown(text):
+            # Telegram отклонит такую разметку - не тратим на нее запрос
+            MARKDOWN_INVALID.inc()
+            markdown = False
+        if text == self._shown and (self._formatted or not markdown):
+            return
+        while True:
+            try:
+                with self._sending(final), TELEGRAM_SEND_SECONDS.time("editMessageText"):
+                    if markdown:
+                        try:
+                            self._message.edit_text(text, parse_mode=ParseMode.MARKDOWN)
+                        except BadRequest as e:
+                            if "not modified" in str(e).lower():
+                                raise
+                            # Если не удалось отправить с Markdown, пробуем без форматирования
+                            logger.warning(f"Ошибка при редактировании с Markdown: {e}")
+                            MARKDOWN_FAILURES.inc()
+                            self._message.edit_text(text)
+                    else:
+                        self._message.edit_text(text)
+                break
+            except RetryAfter as e:
+                # Промежуточное редактирование пропускаем, повторяем только итоговое
+                self._next_edit_at = time.monotonic() + e.retry_after
+                if not final:
+                    logger.debug(f"Редактирование пропущено из-за лимита, следующее через {e.retry_after:.1f} с")
+                    return
+                logger.warning(f"Превышен лимит редактирования, ожидание {e.retry_after} с")
+                if self._scheduler is not None:
+                    # Очередь отправки уже повторила вызов MAX_RETRY_AFTER_ATTEMPTS раз
+                    return
+                time.sleep(e.retry_after)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    logger.warning(f"Ошибка при редактировании сообщения: {e}")
+                break
+        self.edits += 1
+        self._shown = text
+        self._formatted = markdown
+        self._next_edit_at = max(self._next_edit_at, time.monotonic() + self.interval)
@@ -0,0 +1,75 @@
+from admission import AdmissionController
+
+TARGETS = {"text": 2.0, "image": 10.0}
+INTERVAL = 5.0
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def tick(self, seconds=1.0):
+        self.now += seconds
+        return self.now
+
+
+def make_controller():
+    return AdmissionController(targets=TARGETS, interval=INTERVAL)
+
+
+def run(controller, clock, waits, seconds):
+    """Каждую секунду начинают выполняться задачи с ожиданием waits[kind]"""
+    for _ in range(int(seconds)):
+        now = clock.tick()
+        for kind, wait in waits.items():
+            controller.observe(kind, wait, now)
+
+
+def test_image_only_overload_sheds_images():
+    controller, clock = make_controller(), FakeClock()
+    run(controller, clock, {"image": 30.0}, 10)
+    assert not controller.admit("image")
+    assert controller.admit("text")
+
+
+def test_mixed_load_sheds_images_while_text_is_fast():
+    controller, clock = make_controller(), FakeClock()
+    # Быстрый текст не сбрасывает таймер перегрузки изображений
+    run(controller, clock, {"text": 0.1, "image": 30.0}, 10)
+    assert not controller.admit("image")
+    assert controller.admit("text")
+    assert controller.shedding() == ["image"]
+
+
+def test_text_only_overload_sheds_text_and_keeps_images():
+    controller, clock = make_controller(), FakeClock()
+    run(controller, clock, {"text": 5.0}, 10)
+    assert not controller.admit("text")
+    assert controller.admit("image")
+
+
+def test_short_spike_does_not_shed():
+    controller, clock = make_controller(), FakeClock()
+    run(controller, clock, {"image": 30.0}, 3)
+    run(controller, clock, {"image": 1.0}, 1)
+    run(controller, clock, {"image": 30.0}, 3)
+    assert controller.admit("image")
+
+
+def test_recovers_after_waits_drop_below_target():
+    controller, clock = make_controller(), FakeClock()
+    run(controller, clock, {"image": 30.0}, 10)
+    assert not controller.admit("image")
+    run(controller, clock, {"image": 1.0}, 3)
+    assert not controller.admit("image")
+    run(controller, clock, {"image": 1.0}, 5)
+    assert controller.admit("image")
+
+
+def test_drained_queue_restores_only_its_kind():
+    controller, clock = make_controller(), FakeClock()
+    run(controller, clock, {"text": 5.0, "image": 30.0}, 10)
+    assert controller.shedding() == ["text", "image"]
+    controller.drained("image")
+    assert controller.admit("image")
+    assert not controller.admit("text")
@@ -0,0 +1,35 @@
+from context_window import ConversationWindow, KEEP_RECENT_TURNS, TRUNCATED_MARKER
+
+
+def long_text(words):
+    return " ".join(f"слово{i}" for i in range(words))
+
+
+def test_large_turns_fit_the_model_budget():
+    window = ConversationWindow("gpt-3.5-turbo")
+    for i in range(6):
+        window.append({"role": "user", "content": f"вопрос {i}"})
+        window.append({"role": "assistant", "content": long_text(1500)})
+
+    assert window.sent_tokens() <= window.budget
+    assert len(window) == KEEP_RECENT_TURNS
+    # Вопросы пользователя не сокращаются, пока хватает сокращения ответов
+    messages = [m for m in window.messages() if m["role"] != "system"]
+    assert messages[-2] == {"role": "user", "content": "вопрос 5"}
+    assert messages[-1]["content"].endswith(TRUNCATED_MARKER)
+
+
+def test_single_huge_user_turn_is_truncated():
+    window = ConversationWindow(budget=500)
+    window.append({"role": "user", "content": long_text(5000)})
+
+    assert window.sent_tokens() <= window.budget
+    assert window.saved_tokens > 0
+
+
+def test_window_within_budget_is_unchanged():
+    window = ConversationWindow(budget=1000)
+    window.append({"role": "user", "content": "привет"})
+    window.append({"role": "assistant", "content": "здравствуйте"})
+
+    assert [m["content"] for m in window.messages()] == ["привет", "здравствуйте"]
@@ -0,0 +1,77 @@
+import threading
+
+from cache import SingleFlight
+from inline import InlineDebouncer
+
+
+def started_debouncer():
+    started = []
+    ready = threading.Event()
+
+    def start(request):
+        started.append(request)
+        ready.set()
+
+    return InlineDebouncer(start, delay=0.01), started, ready
+
+
+def offer_and_start(debouncer, ready, user_id, text):
+    ready.clear()
+    request = debouncer.offer(user_id, f"query-{user_id}", text)
+    assert ready.wait(2)
+    return request
+
+
+def test_leader_typing_on_does_not_cancel_shared_generation():
+    debouncer, _, ready = started_debouncer()
+    leader = offer_and_start(debouncer, ready, 1, "погода в москве")
+    follower = offer_and_start(debouncer, ready, 2, "Погода в Москве?")
+    generation = debouncer.join(leader)
+    assert debouncer.join(follower) is generation
+
+    debouncer.offer(1, "query-1b", "погода в москве завтра")
+    assert not generation.deadline.cancelled
+
+    debouncer.supersede(2)
+    assert generation.deadline.cancelled
+
+
+def test_request_after_cancel_gets_its_own_flight():
+    debouncer, _, ready = started_debouncer()
+    flight = SingleFlight("inline")
+    first = offer_and_start(debouncer, ready, 1, "курс доллара")
+    cancelled = debouncer.join(first)
+
+    # Ведущий еще не вернулся из отмененной генерации
+    leader_inside = threading.Event()
+    release = threading.Event()
+
+    def cancelled_generation():
+        leader_inside.set()
+        release.wait(2)
+        return None
+
+    thread = threading.Thread(target=flight.do, args=(cancelled, cancelled_generation))
+    thread.start()
+    assert leader_inside.wait(2)
+    debouncer.supersede(1)
+    assert cancelled.deadline.cancelled
+
+    second = offer_and_start(debouncer, ready, 2, "Курс доллара")
+    generation = debouncer.join(second)
+    assert generation is not cancelled
+    assert not generation.deadline.expired()
+    assert flight.do(generation, lambda: "ответ") == ("ответ", True)
+
+    release.set()
+    thread.join()
+
+
+def test_finished_request_can_be_retyped():
+    debouncer, started, ready = started_debouncer()
+    request = offer_and_start(debouncer, ready, 1, "что такое python")
+    # Задача устарела в очереди - запрос освобождается (drop_stale_inline)
+    debouncer.finish(request)
+    retyped = offer_and_start(debouncer, ready, 1, "что такое python")
+    assert retyped is not request
+    assert started[-1] is retyped
@@ -0,0 +1,31 @@
+import itertools
+
+from markdown_split import split_markdown, is_valid_markdown
+
+
+def parts(text, max_length):
+    # Ограничение числа частей ловит зацикливание вместо зависания теста
+    return list(itertools.islice(split_markdown(text, max_length), len(text) + 10))
+
+
+def test_tiny_budget_with_long_fence_language_makes_progress():
+    text = "```javascript\n" + "a b c d e f g h " * 20 + "\n```"
+    result = parts(text, 8)
+    assert len(result) <= len(text)
+    assert result[-1].endswith("```")
+
+
+def test_tiny_budgets_always_finish():
+    texts = ["слово " * 50, "*жирный текст " * 20 + "*", "```py\n" + "x = 1\n" * 30 + "```"]
+    for text in texts:
+        for max_length in range(1, 12):
+            assert len(parts(text, max_length)) <= len(text)
+
+
+def test_code_block_is_reopened_in_each_part():
+    text = "```python\n" + "print(1)\n" * 100 + "```"
+    result = parts(text, 200)
+    assert len(result) > 1
+    assert all(len(part) <= 200 for part in result)
+    assert all(is_valid_markdown(part) for part in result)
+    assert all(part.startswith("```python\n") for part in result)
@@ -0,0 +1,105 @@
+import threading
+import time
+
+from telegram.error import RetryAfter
+
+from outbound import SENDER_THREADS, SendScheduler
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def fast_scheduler():
+    return SendScheduler(global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000)
+
+
+def test_deferred_calls_use_a_fixed_number_of_threads():
+    scheduler = fast_scheduler()
+    sent = []
+    lock = threading.Lock()
+
+    def send(chat_id, n):
+        with lock:
+            sent.append((chat_id, n))
+
+    threads_before = threading.active_count()
+    for chat_id in range(200):
+        for n in range(3):
+            scheduler.defer(chat_id, "sendMessage", None, send, chat_id, n)
+    assert threading.active_count() - threads_before <= SENDER_THREADS
+
+    wait_for(lambda: len(sent) == 600)
+    for chat_id in range(200):
+        assert [n for c, n in sent if c == chat_id] == [0, 1, 2]
+
+
+def test_deferred_call_with_same_key_is_coalesced():
+    scheduler = SendScheduler(chat_rate=0.001, chat_burst=1.0)
+    sent = []
+    scheduler.defer(1, "sendMessage", None, sent.append, "first")
+    assert scheduler.defer(1, "sendMessage", "busy", sent.append, "busy")
+    assert not scheduler.defer(1, "sendMessage", "busy", sent.append, "busy again")
+    wait_for(lambda: sent == ["first"])
+
+
+def test_deferred_call_is_retried_after_retry_after():
+    scheduler = fast_scheduler()
+    attempts = []
+
+    def flaky():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RetryAfter(0.1)
+
+    scheduler.defer(1, "sendMessage", None, flaky)
+    wait_for(lambda: len(attempts) == 2)
+    assert attempts[1] - attempts[0] >= 0.1
+
+
+def test_deferred_call_waits_for_synchronous_call_in_the_same_chat():
+    scheduler = fast_scheduler()
+    order = []
+    inside = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        inside.set()
+        release.wait(2)
+        order.append("sync")
+
+    thread = threading.Thread(target=scheduler.call, args=(1, "sendMessage", slow))
+    thread.start()
+    assert inside.wait(2)
+    scheduler.defer(1, "sendMessage", None, order.append, "deferred")
+    time.sleep(0.1)
+    assert order == []
+    release.set()
+    thread.join()
+    wait_for(lambda: order == ["sync", "deferred"])
+
+
+def test_nowait_call_skips_instead_of_waiting_for_the_chat_bucket():
+    scheduler = SendScheduler(chat_rate=0.1, chat_burst=1.0)
+    sent = []
+    scheduler.call(100, "editMessageText", sent.append, 1)
+
+    started = time.monotonic()
+    with scheduler.nowait():
+        try:
+            scheduler.call(100, "editMessageText", sent.append, 2)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+    assert time.monotonic() - started < 0.5
+    assert sent == [1]
+    assert retry_after > 5
+    assert scheduler.stats()["skipped"] == 1
+
+
+def test_nowait_call_runs_when_the_chat_is_free():
+    scheduler = fast_scheduler()
+    with scheduler.nowait():
+        assert scheduler.call(1, "editMessageText", lambda: "ok") == "ok"
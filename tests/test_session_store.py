@@ -0,0 +1,34 @@
+from context_window import ConversationWindow
+from session_store import SessionStore
+
+
+def test_change_after_flush_is_written(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = SessionStore(path, flush_interval=3600)
+    store.history[1] = ConversationWindow()
+    store.flush()
+
+    # Фоновая запись между чтением истории и ее изменением
+    history = store.history[1]
+    store.flush()
+    history.append({"role": "user", "content": "привет"})
+    store.close()
+
+    store = SessionStore(path, flush_interval=3600)
+    try:
+        assert len(store.history[1]) == 1
+    finally:
+        store.close()
+
+
+def test_reading_fields_does_not_mark_dirty(tmp_path):
+    store = SessionStore(str(tmp_path / "sessions.db"), flush_interval=3600)
+    try:
+        store.mode[1] = "text"
+        store.history[1] = ConversationWindow()
+        store.flush()
+        assert store.mode[1] == "text"
+        assert not store.history[1]
+        assert store.flush() == 0
+    finally:
+        store.close()
@@ -0,0 +1,68 @@
+import http.client
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import webhook
+
+
+class FakePool:
+    def __init__(self):
+        self.routed = []
+
+    def route(self, data, user_id):
+        self.routed.append(user_id)
+        return True
+
+
+@pytest.fixture
+def server():
+    pool = FakePool()
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), webhook.make_handler(pool))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd, pool
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(httpd, body, headers=None):
+    conn = http.client.HTTPConnection(*httpd.server_address, timeout=5)
+    conn.putrequest("POST", "/" + webhook.WEBHOOK_PATH)
+    for name, value in (headers or {}).items():
+        conn.putheader(name, value)
+    conn.endheaders()
+    if body:
+        conn.send(body)
+    status = conn.getresponse().status
+    conn.close()
+    return status
+
+
+def test_update_is_routed_by_user(server):
+    httpd, pool = server
+    body = json.dumps({"update_id": 1, "message": {"from": {"id": 42}, "chat": {"id": 42}}}).encode()
+    assert post(httpd, body, {"Content-Length": str(len(body))}) == 200
+    assert pool.routed == [42]
+
+
+@pytest.mark.parametrize("body, length", [
+    (b"{}", None),
+    (b"{}", "abc"),
+    (b"[1, 2]", "6"),
+    (b"\"text\"", "6"),
+    (b"{not json", "9"),
+])
+def test_malformed_requests_get_400(server, body, length):
+    httpd, pool = server
+    headers = {} if length is None else {"Content-Length": length}
+    assert post(httpd, body, headers) == 400
+    assert pool.routed == []
+
+
+def test_unexpected_field_types_do_not_fail(server):
+    httpd, pool = server
+    body = json.dumps({"message": 5, "callback_query": {"from": "x", "chat": {"id": -7}}}).encode()
+    assert post(httpd, body, {"Content-Length": str(len(body))}) == 200
+    assert pool.routed == [-7]
@@ -1,14 +1,36 @@
+import time
+_import_started = time.monotonic()  # Начало импорта - для отчета о времени запуска
+
+import functools
 import logging
+import math
 import os
-from g4f.client import Client
-import g4f
-import requests
-from telegram import Update, ParseMode, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler, ConversationHandler
-from PIL import Image
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update, ParseMode, InputMediaPhoto, InputMediaDocument, InlineQueryResultArticle, InputTextMessageContent, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram.utils.request import Request
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler, ConversationHandler, InlineQueryHandler, TypeHandler
 from io import BytesIO
-import tempfile
 import re
+from context_window import ConversationWindow, record_request, model_name, context_stats
+from session_store import SessionStore
+from jobs import GenerationExecutor, JOB_TEXT, JOB_IMAGE, POOL_SIZES
+from ratelimit import UserRateLimiter, REQUEST_COSTS, IMAGE_VARIANT_COST
+from streaming import LiveReply
+from outbound import ScheduledBot, SendScheduler
+from stream_text import iter_deltas, collect_text
+from markdown_split import split_markdown, split_first, is_valid_markdown
+from providers import ProviderRouter, AllProvidersFailed
+from transport import get_client, close as close_transport
+import webhook
+import traffic_log
+from model_catalog import get_g4f, resolve_model, available_models, refresh_in_background
+from images import (fetch_image, image_extension, split_image_options, shutdown as shutdown_images, IMAGE_SIZES,
+                    DEFAULT_IMAGE_SIZE, OUTPUT_FORMATS, OUTPUT_PHOTO, DEFAULT_OUTPUT, MAX_IMAGE_VARIANTS)
+from inline import InlineDebouncer, inline_cache, inline_flight, inline_key, INLINE_MIN_CHARS, INLINE_CACHE_TIME
+from metrics import Gauge, PROVIDER_CALL_SECONDS, PROVIDER_FIRST_CHUNK_SECONDS, INLINE_QUERIES, IMAGE_UPLOAD_BYTES, FALLBACK_SUCCESS, MARKDOWN_FAILURES, MARKDOWN_INVALID, TELEGRAM_SEND_SECONDS, start_server as start_metrics_server
+from cache import image_cache, text_cache, image_flight, text_flight, make_key
+from deadlines import Deadline, DeadlineExceeded, run_with_deadline, timeout_stats, TEXT_DEADLINE, IMAGE_DEADLINE
 
 # Настройка логирования
 logging.basicConfig(
@@ -22,45 +44,49 @@ TOKEN = ""
 # Максимальная длина сообщения в Telegram
 MAX_MESSAGE_LENGTH = 4000  # Оставляем небольшой запас от лимита в 4096
 
+# Ответ, когда очередь генерации заполнена
+BUSY_MESSAGE = "Сейчас бот перегружен запросами. Пожалуйста, повторите попытку через минуту."
+# Ответ, когда запрос ждал в очереди так долго, что его выполнение отменено
+STALE_MESSAGE = "Запрос ждал в очереди слишком долго и был отменен. Если ответ еще нужен, отправьте его снова."
+# Ответ, когда пользователь превысил свой лимит запросов
+THROTTLED_MESSAGE = "Слишком много запросов. Попробуйте снова через {seconds} с."
+
+# Провайдеры g4f для текстовых ответов (имена из g4f.Provider, None - автоматический выбор g4f)
+TEXT_PROVIDERS = [None]
+
+# Показывать ответ GPT по мере генерации, редактируя сообщение
+STREAM_REPLIES = True
+
+# Порт HTTP-эндпоинта /metrics для Prometheus (None - метрики не публикуются)
+METRICS_PORT = None
+
 # Режимы работы бота
 MODE_TEXT = "text"
 MODE_IMAGE = "image"
 
-# Инициализация g4f провайдеров
-g4f.debug.logging = False  # Отключить дебаг логи
-# Получаем доступные модели
-try:
-    # Пробуем получить модели из нового API
-    available_models = list(g4f.models.__all__)
-except:
-    try:
-        # Альтернативный способ для новых версий
-        available_models = [model.__name__ for model in g4f.models.list()]
-    except:
-        # Запасной вариант
-        available_models = ["gpt-3.5-turbo", "gpt-4", "gpt-4o", "gpt-4o-mini"]
-
-# Устанавливаем модели по умолчанию
-try:
-    # Модель для текстовых ответов
-    if hasattr(g4f.models, "gpt_4o_mini"):
-        text_model = g4f.models.gpt_4o_mini
-    else:
-        text_model = "gpt-4o-mini"  # Используем строковое имя модели
-    
-    # Модель для генерации изображений
-    if hasattr(g4f.models, "flux"):
-        image_model = g4f.models.flux
-    else:
-        image_model = "flux"  # Используем строковое имя модели
-except:
-    text_model = "gpt-4o-mini"
-    image_model = "flux"
+# Модели по умолчанию. Имена превращаются в объекты g4f.models при первом
+# запросе, чтобы не импортировать g4f при запуске (см. model_catalog.py)
+text_model = "gpt-4o-mini"  # Модель для текстовых ответов
+image_model = "flux"  # Модель для генерации изображений
 
-# История сообщений для каждого пользователя
-user_history = {}
+# Сессии пользователей хранятся в SQLite, активные пользователи - в памяти
+session_store = SessionStore(model=text_model)
+# История сообщений для каждого пользователя (окно с ограничением по токенам)
+user_history = session_store.history
 # Режим работы для каждого пользователя (по умолчанию - текст)
-user_mode = {}
+user_mode = session_store.mode
+# Размер и способ отправки изображений для каждого пользователя (/size, /format)
+user_image_settings = session_store.image
+
+# Пулы потоков для генерации текста и изображений
+generation_executor = GenerationExecutor()
+# Лимиты запросов пользователей (изображения дороже текста)
+rate_limiter = UserRateLimiter()
+# Очередь исходящих сообщений с лимитами Telegram
+send_scheduler = SendScheduler()
+# Потоки для одновременной генерации вариантов изображения
+variant_pool = ThreadPoolExecutor(max_workers=MAX_IMAGE_VARIANTS * POOL_SIZES[JOB_IMAGE],
+                                  thread_name_prefix="image-variant")
 
 def start(update: Update, context: CallbackContext) -> None:
     """Обработчик команды /start"""
@@ -68,7 +94,7 @@ def start(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
     # Инициализируем историю пользователя без системного сообщения о разметке
-    user_history[user_id] = []
+    user_history[user_id] = ConversationWindow(text_model)
     # Устанавливаем режим по умолчанию - текст
     user_mode[user_id] = MODE_TEXT
     
@@ -89,205 +115,255 @@ def start(update: Update, context: CallbackContext) -> None:
         reply_markup=reply_markup
     )
 
-def get_gpt_response(prompt, model=text_model, history=None):
+def provider_kwargs(provider, deadline=None):
+    """Аргументы provider и timeout для g4f"""
+    kwargs = {}
+    if provider is not None:
+        kwargs["provider"] = provider
+    if deadline is not None:
+        # Провайдер не должен ждать дольше, чем осталось до общего срока
+        kwargs["timeout"] = max(1, int(deadline.remaining()))
+    return kwargs
+
+def count_branch(branch, text):
+    """Учесть в метриках ветку цепочки, вернувшую непустой ответ"""
+    if text:
+        FALLBACK_SUCCESS.inc(branch)
+    return text
+
+def client_completion(messages, model, provider=None, deadline=None):
+    """Ответ через g4f Client: без стриминга, при ошибке - со стримингом"""
+    client = get_client()
+    model = resolve_model(model)
+    
+    try:
+        # Сначала пробуем получить полный ответ без стриминга
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=False,  # Явно указываем, что не хотим стриминг
+            **provider_kwargs(provider, deadline)
+        )
+        
+        # Проверяем, не является ли ответ потоковым, несмотря на наши настройки
+        if hasattr(response, 'choices') and hasattr(response.choices[0], 'message'):
+            return count_branch("client", collect_text(response, deadline, "text.client"))
+        
+        # Если ответ все-таки потоковый, собираем его вручную
+        logger.warning("Получен потоковый ответ, несмотря на stream=False")
+        if hasattr(response, '__iter__') or hasattr(response, '__next__'):
+            return count_branch("client_unexpected_stream", collect_text(response, deadline, "text.client"))
+        return ""
+    
+    except DeadlineExceeded:
+        raise
+    except Exception as stream_error:
+        # Если произошла ошибка при попытке получить ответ без стриминга,
+        # попробуем явно использовать стриминг и собрать ответ вручную
+        logger.warning(f"Ошибка при получении ответа без стриминга: {stream_error}. Пробуем со стримингом.")
+        if deadline is not None:
+            deadline.check("text.client")
+        
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,  # Явно запрашиваем стриминг
+            **provider_kwargs(provider, deadline)
+        )
+        return count_branch("client_stream", collect_text(response, deadline, "text.client"))
+
+def chat_completion(messages, model, provider=None, deadline=None):
+    """Ответ через g4f.ChatCompletion: без стриминга, при ошибке - со стримингом"""
+    branch = "chatcompletion"
+    g4f = get_g4f()
+    model = resolve_model(model)
+    try:
+        # Пробуем сначала без стриминга
+        response_text = g4f.ChatCompletion.create(
+            model=model,
+            messages=messages,
+            stream=False,
+            **provider_kwargs(provider, deadline)
+        )
+    except Exception as g4f_error:
+        logger.warning(f"Ошибка при использовании g4f.ChatCompletion: {g4f_error}. Пробуем со стримингом.")
+        if deadline is not None:
+            deadline.check("text.chatcompletion")
+        branch = "chatcompletion_stream"
+        response_text = g4f.ChatCompletion.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            **provider_kwargs(provider, deadline)
+        )
+    return count_branch(branch, collect_text(response_text, deadline, "text.chatcompletion"))
+
+# Провайдеры маршрутов через g4f Client: ими же получается потоковый ответ
+stream_providers = {}
+
+def build_text_router():
+    """Маршрутизатор текстовых запросов по провайдерам из TEXT_PROVIDERS"""
+    router = ProviderRouter("text-router")
+    for provider_name in TEXT_PROVIDERS:
+        provider = None
+        if provider_name:
+            provider = getattr(get_g4f().Provider, provider_name, None)
+            if provider is None:
+                logger.warning(f"Провайдер {provider_name} не найден в g4f.Provider")
+                continue
+        label = provider_name or "auto"
+        router.add_route(f"client/{label}", functools.partial(client_completion, provider=provider))
+        stream_providers[f"client/{label}"] = provider
+        router.add_route(f"chatcompletion/{label}", functools.partial(chat_completion, provider=provider))
+    return router
+
+text_router = build_text_router()
+
+def log_context(history):
+    """Учесть запрос в статистике окна контекста и записать в лог сэкономленные токены"""
+    saved_tokens = record_request(history)
+    if saved_tokens:
+        logger.info(f"Окно контекста: отправлено {history.sent_tokens()} токенов истории, сэкономлено {saved_tokens}")
+
+def get_gpt_response(prompt, model=text_model, history=None, deadline=None):
     """Получить ответ от GPT4free"""
+    if deadline is None:
+        deadline = Deadline(TEXT_DEADLINE)
     try:
         messages = []
         if history:
             messages.extend(history)
+            log_context(history)
         
         messages.append({"role": "user", "content": prompt})
         
-        # Флаг для отслеживания, получили ли мы потоковый ответ
-        received_streaming_response = False
-        
         try:
-            # Пробуем использовать клиент API
-            client = Client()
-            
-            try:
-                # Сначала пробуем получить полный ответ без стриминга
-                response = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    stream=False,  # Явно указываем, что не хотим стриминг
-                )
-                
-                # Проверяем, не является ли ответ потоковым, несмотря на наши настройки
-                if hasattr(response, 'choices') and hasattr(response.choices[0], 'message'):
-                    response_text = response.choices[0].message.content
-                else:
-                    # Если ответ все-таки потоковый, собираем его вручную
-                    logger.warning("Получен потоковый ответ, несмотря на stream=False")
-                    received_streaming_response = True
-                    full_response = ""
-                    
-                    # Если response - это генератор или итератор
-                    if hasattr(response, '__iter__') or hasattr(response, '__next__'):
-                        for chunk in response:
-                            if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                                if hasattr(chunk.choices[0], 'delta') and hasattr(chunk.choices[0].delta, 'content'):
-                                    content = chunk.choices[0].delta.content
-                                    if content:
-                                        full_response += content
-                                elif hasattr(chunk.choices[0], 'message') and hasattr(chunk.choices[0].message, 'content'):
-                                    content = chunk.choices[0].message.content
-                                    if content:
-                                        full_response += content
-                    
-                    response_text = full_response if full_response else "Не удалось получить ответ от модели."
-            
-            except Exception as stream_error:
-                # Если произошла ошибка при попытке получить ответ без стриминга,
-                # попробуем явно использовать стриминг и собрать ответ вручную
-                logger.warning(f"Ошибка при получении ответа без стриминга: {stream_error}. Пробуем со стримингом.")
-                received_streaming_response = True
-                
-                response = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    stream=True,  # Явно запрашиваем стриминг
-                )
-                
-                full_response = ""
-                for chunk in response:
-                    if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                        if hasattr(chunk.choices[0], 'delta') and hasattr(chunk.choices[0].delta, 'content'):
-                            content = chunk.choices[0].delta.content
-                            if content:
-                                full_response += content
-                
-                response_text = full_response if full_response else "Не удалось получить ответ от модели."
-                
-        except Exception as client_error:
-            logger.warning(f"Ошибка при использовании клиента: {client_error}")
-            # Если клиент не работает, используем старый метод
-            try:
-                # Пробуем сначала без стриминга
-                response_text = g4f.ChatCompletion.create(
-                    model=model,
-                    messages=messages,
-                    stream=False,
-                )
-                
-                # Проверяем, не является ли ответ потоковым или словарем с данными
-                if isinstance(response_text, (list, tuple, set)) or hasattr(response_text, '__iter__') or isinstance(response_text, dict):
-                    logger.warning("g4f.ChatCompletion вернул не строку. Обрабатываем специальным образом.")
-                    received_streaming_response = True
-                    
-                    full_response = ""
-                    
-                    # Если это итерируемый объект
-                    if hasattr(response_text, '__iter__') and not isinstance(response_text, (str, dict)):
-                        for chunk in response_text:
-                            if isinstance(chunk, str):
-                                full_response += chunk
-                            elif isinstance(chunk, dict) and 'content' in chunk:
-                                full_response += chunk['content']
-                    # Если это словарь
-                    elif isinstance(response_text, dict):
-                        if 'content' in response_text:
-                            full_response = response_text['content']
-                        elif 'message' in response_text and 'content' in response_text['message']:
-                            full_response = response_text['message']['content']
-                    
-                    response_text = full_response if full_response else "Не удалось получить ответ от модели."
-                
-                # Если ответ содержит "data: {" - это признак потокового ответа в текстовом формате
-                elif isinstance(response_text, str) and "data: {" in response_text:
-                    logger.warning("Обнаружен потоковый ответ в текстовом формате")
-                    received_streaming_response = True
-                    
-                    # Извлекаем содержимое из строк вида "data: {"content":"текст"}"
-                    full_response = ""
-                    for line in response_text.split('\n'):
-                        if line.startswith('data: {'):
-                            try:
-                                # Пытаемся извлечь JSON из строки
-                                import json
-                                data_str = line.replace('data: ', '')
-                                data = json.loads(data_str)
-                                if 'content' in data and data['content']:
-                                    full_response += data['content']
-                            except Exception as json_error:
-                                logger.error(f"Ошибка при разборе JSON из потокового ответа: {json_error}")
-                    
-                    response_text = full_response if full_response else "Не удалось получить ответ от модели."
-                
-            except Exception as g4f_error:
-                logger.error(f"Ошибка при использовании g4f.ChatCompletion: {g4f_error}")
-                
-                # Последняя попытка - явно запросить стриминг и собрать ответ
-                try:
-                    logger.info("Пробуем явно запросить стриминг через g4f.ChatCompletion")
-                    received_streaming_response = True
-                    
-                    response_stream = g4f.ChatCompletion.create(
-                        model=model,
-                        messages=messages,
-                        stream=True,
-                    )
-                    
-                    full_response = ""
-                    for chunk in response_stream:
-                        if isinstance(chunk, str):
-                            full_response += chunk
-                        elif isinstance(chunk, dict) and 'content' in chunk:
-                            full_response += chunk['content']
-                    
-                    response_text = full_response if full_response else "Не удалось получить ответ от модели."
-                except Exception as stream_error:
-                    logger.error(f"Ошибка при использовании стриминга через g4f.ChatCompletion: {stream_error}")
-                    response_text = f"Произошла ошибка при получении ответа: {str(g4f_error)}"
-        
-        # Финальная проверка на потоковый формат в текстовом ответе
-        if isinstance(response_text, str) and "data: {" in response_text:
-            logger.warning("Финальная проверка: обнаружен потоковый ответ в текстовом формате")
-            received_streaming_response = True
-            
-            # Извлекаем содержимое из строк вида "data: {"content":"текст"}"
-            full_response = ""
-            for line in response_text.split('\n'):
-                if line.startswith('data: {'):
-                    try:
-                        # Пытаемся извлечь JSON из строки
-                        import json
-                        data_str = line.replace('data: ', '')
-                        data = json.loads(data_str)
-                        if 'content' in data and data['content']:
-                            full_response += data['content']
-                    except Exception as json_error:
-                        logger.error(f"Ошибка при разборе JSON из потокового ответа: {json_error}")
-            
-            if full_response:
-                response_text = full_response
-        
-        # Логируем информацию о типе полученного ответа
-        if received_streaming_response:
-            logger.info("Был получен и обработан потоковый ответ")
+            # Запрос уходит самому быстрому исправному провайдеру, медленный дублируется следующим
+            response_text, route = text_router.call(messages, model, deadline=deadline)
+            logger.info(f"Ответ получен через {route}")
+        except DeadlineExceeded:
+            logger.error(f"Ответ не получен за {deadline.seconds:.0f} с")
+            return "Модель не ответила вовремя. Попробуйте повторить запрос позже.", None
+        except AllProvidersFailed as e:
+            logger.error(f"Ни один провайдер не вернул ответ: {e}")
+            return f"Произошла ошибка при получении ответа: {str(e)}", None
         
         return response_text, {"role": "assistant", "content": response_text}
     except Exception as e:
         logger.error(f"Ошибка при получении ответа от GPT: {e}")
         return f"Произошла ошибка: {str(e)}", None
 
-def generate_image(prompt):
-    """Генерировать изображение по описанию"""
+def stream_route():
+    """Маршрут для потокового ответа: лучший по рейтингу маршрут через g4f Client"""
+    for route in text_router.ranked():
+        if route in stream_providers:
+            return route, stream_providers[route]
+    return None, None
+
+def record_stream(route, started, first_chunk, ok):
+    """Учесть потоковую попытку в статистике маршрута и в метриках.
+
+    В метриках поток помечается stream/<провайдер>, чтобы его полное время
+    не смешивалось со временем обычных запросов маршрута client/<провайдер>.
+    """
+    total = time.monotonic() - started
+    label = "stream/" + (route or "client/auto").split("/", 1)[1]
+    PROVIDER_CALL_SECONDS.observe(total, label, "ok" if ok else "error")
+    if first_chunk is not None:
+        PROVIDER_FIRST_CHUNK_SECONDS.observe(first_chunk, label)
+    if ok:
+        FALLBACK_SUCCESS.inc("stream")
+    # Время до первой части не сравнимо с полным ответом и не должно
+    # занижать задержку перед дублирующим запросом, поэтому хранится отдельно
+    text_router.record(route, None, ok, first_chunk=first_chunk)
+
+def stream_gpt_response(prompt, model=text_model, history=None, deadline=None, result=None):
+    """Получать ответ от GPT4free по частям по мере генерации.
+
+    В словарь result записывается ok=True, если получен ответ модели, а не текст ошибки.
+    """
+    if result is None:
+        result = {}
+    result["ok"] = False
+    if deadline is None:
+        deadline = Deadline(TEXT_DEADLINE)
+    messages = []
+    if history:
+        messages.extend(history)
+    messages.append({"role": "user", "content": prompt})
+    
+    # Провайдер выбирается по рейтингу маршрутизатора, а время до первой части
+    # и ошибки учитываются в статистике его маршрута (record_stream)
+    route, provider = stream_route()
+    started = time.monotonic()
+    first_chunk = None
+    received = False
+    try:
+        client = get_client()
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            **provider_kwargs(provider, deadline)
+        )
+        
+        for content in iter_deltas(response, deadline, "text.stream"):
+            if not received:
+                received = True
+                first_chunk = time.monotonic() - started
+            yield content
+        if received:
+            record_stream(route, started, first_chunk, ok=True)
+            log_context(history)
+            result["ok"] = True
+            return
+        record_stream(route, started, first_chunk, ok=False)
+        logger.warning(f"Пустой потоковый ответ от {route}. Пробуем обычный запрос.")
+    except DeadlineExceeded:
+        if not deadline.cancelled:
+            record_stream(route, started, first_chunk, ok=False)
+        if not received:
+            yield "Модель не ответила вовремя. Попробуйте повторить запрос позже."
+        return
+    except Exception as e:
+        record_stream(route, started, first_chunk, ok=False)
+        if received:
+            # Часть ответа уже показана пользователю - повторять запрос нельзя
+            logger.error(f"Поток ответа прервался: {e}")
+            return
+        logger.warning(f"Ошибка при потоковом получении ответа: {e}. Пробуем обычный запрос.")
+    
+    # Стриминг не сработал - получаем ответ целиком через обычную цепочку в пределах того же срока
+    response_text, assistant_message = get_gpt_response(prompt, model=model, history=history, deadline=deadline)
+    result["ok"] = assistant_message is not None
+    yield response_text
+
+def generate_image(prompt, deadline=None, size=DEFAULT_IMAGE_SIZE, output=DEFAULT_OUTPUT):
+    """Генерировать изображение по описанию.
+
+    size - имя размера из IMAGE_SIZES, output - способ отправки (фото, WebP или исходный файл)
+    """
+    if deadline is None:
+        deadline = Deadline(IMAGE_DEADLINE)
+    width, height = IMAGE_SIZES.get(size, IMAGE_SIZES[DEFAULT_IMAGE_SIZE])
     try:
         # Логируем запрос
-        logger.info(f"Запрос на генерацию изображения: {prompt}")
+        logger.info(f"Запрос на генерацию изображения {width}x{height}: {prompt}")
         
-        # Создаем клиент
-        client = Client()
+        # Общий для процесса клиент g4f
+        client = get_client()
         
         try:
-            # Генерируем изображение
-            response = client.images.generate(
+            # Генерируем изображение не дольше срока; остаток срока передается и
+            # провайдеру, чтобы зависший вызов освободил поток пула
+            response = run_with_deadline(
+                deadline, "image.generate", client.images.generate,
                 model="flux",
                 prompt=prompt,
                 response_format="url",
-                width=1024,  # Уменьшаем размер для большей надежности
-                height=1024
+                width=width,
+                height=height,
+                **provider_kwargs(None, deadline)
             )
             
             # Получаем URL изображения
@@ -296,69 +372,297 @@ def generate_image(prompt):
                 logger.info(f"Получен URL изображения: {image_url}")
                 
                 # Загружаем изображение
-                img_response = requests.get(image_url, timeout=60)
-                
-                if img_response.status_code == 200:
-                    # Проверяем, что полученные данные - действительно изображение
-                    try:
-                        img = Image.open(BytesIO(img_response.content))
-                        # Преобразуем изображение в JPEG для гарантии совместимости с Telegram
-                        buffer = BytesIO()
-                        img.convert('RGB').save(buffer, format='JPEG')
-                        buffer.seek(0)
-                        
-                        return buffer.getvalue()
-                    except Exception as img_error:
-                        logger.error(f"Ошибка при обработке изображения: {img_error}")
-                        return None
-                else:
-                    logger.error(f"Ошибка при загрузке изображения: {img_response.status_code}")
-                    return None
+                return count_branch("images.generate", fetch_image(image_url, deadline, output, size))
             else:
                 logger.error("Не удалось получить URL изображения из ответа API")
                 return None
-                
+        
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             logger.error(f"Ошибка при генерации изображения через client.images.generate: {e}")
             
-            # Пробуем альтернативный метод
+            # Пробуем альтернативный метод в пределах оставшегося срока
             try:
                 logger.info("Пробуем альтернативный метод g4f.images.create")
-                img_url = g4f.images.create(
+                img_url = run_with_deadline(
+                    deadline, "image.fallback", get_g4f().images.create,
                     prompt=prompt,
-                    model="flux"
+                    model="flux",
+                    **provider_kwargs(None, deadline)
                 )
                 
                 if img_url:
-                    img_response = requests.get(img_url, timeout=60)
-                    
-                    if img_response.status_code == 200:
-                        # Проверяем, что полученные данные - действительно изображение
-                        try:
-                            img = Image.open(BytesIO(img_response.content))
-                            # Преобразуем изображение в JPEG
-                            buffer = BytesIO()
-                            img.convert('RGB').save(buffer, format='JPEG')
-                            buffer.seek(0)
-                            
-                            return buffer.getvalue()
-                        except Exception as img_error:
-                            logger.error(f"Ошибка при обработке изображения: {img_error}")
-                            return None
-                    else:
-                        logger.error(f"Ошибка при загрузке изображения: {img_response.status_code}")
-                        return None
+                    return count_branch("images.create", fetch_image(img_url, deadline, output, size))
                 else:
                     logger.error("Не удалось получить URL изображения из g4f.images.create")
                     return None
+            except DeadlineExceeded:
+                raise
             except Exception as alt_error:
                 logger.error(f"Ошибка при использовании альтернативного метода: {alt_error}")
                 return None
-                
+    
+    except DeadlineExceeded as e:
+        logger.error(f"Изображение не получено за {deadline.seconds:.0f} с: {e}")
+        return None
     except Exception as e:
         logger.error(f"Общая ошибка при генерации изображения: {e}")
         return None
 
+def send_long_message(update: Update, text):
+    """Разбить длинный ответ на части и отправить"""
+    message_parts = list(split_long_message(text))
+    for i, part in enumerate(message_parts):
+        try:
+            # Добавляем индикатор части для длинных сообщений
+            if len(message_parts) > 1:
+                part_indicator = f"[Часть {i+1}/{len(message_parts)}]\n"
+                if i > 0:  # Для всех частей, кроме первой, добавляем индикатор в начало
+                    part = part_indicator + part
+                else:  # Для первой части добавляем индикатор только если он поместится
+                    if len(part) + len(part_indicator) <= MAX_MESSAGE_LENGTH:
+                        part = part_indicator + part
+            
+            if not is_valid_markdown(part):
+                # Telegram отклонит такую разметку - сразу отправляем без форматирования
+                MARKDOWN_INVALID.inc()
+                with TELEGRAM_SEND_SECONDS.time("sendMessage"):
+                    update.message.reply_text(part)
+                continue
+            with TELEGRAM_SEND_SECONDS.time("sendMessage"):
+                update.message.reply_text(part, parse_mode=ParseMode.MARKDOWN)
+        except Exception as e:
+            # Если не удалось отправить с Markdown, пробуем без форматирования
+            logger.warning(f"Ошибка при отправке с Markdown: {e}")
+            MARKDOWN_FAILURES.inc()
+            with TELEGRAM_SEND_SECONDS.time("sendMessage"):
+                update.message.reply_text(part)
+
+def text_cache_key(prompt, model=text_model):
+    """Ключ кэша текстового ответа на запрос без истории"""
+    return make_key(prompt, model_name(model))
+
+def image_cache_key(prompt, size=DEFAULT_IMAGE_SIZE, output=DEFAULT_OUTPUT):
+    """Ключ кэша изображения: запрос, модель, размер и способ отправки"""
+    width, height = IMAGE_SIZES.get(size, IMAGE_SIZES[DEFAULT_IMAGE_SIZE])
+    return make_key(prompt, "flux", f"{width}x{height}", output)
+
+def image_settings(user_id):
+    """Размер и способ отправки изображений, выбранные пользователем"""
+    settings = user_image_settings.get(user_id) or {}
+    return settings.get("size", DEFAULT_IMAGE_SIZE), settings.get("output", DEFAULT_OUTPUT)
+
+def send_image(update: Update, img_data, caption, output, file_id=None):
+    """Отправить изображение фото или файлом и вернуть file_id, под которым его сохранил Telegram"""
+    source = file_id or BytesIO(img_data)
+    if output == OUTPUT_PHOTO:
+        with TELEGRAM_SEND_SECONDS.time("sendPhoto"):
+            message = update.message.reply_photo(photo=source, caption=caption)
+        sent = message.photo[-1] if message and message.photo else None
+    else:
+        # Документ Telegram не пережимает: WebP или исходный файл доходят как есть
+        with TELEGRAM_SEND_SECONDS.time("sendDocument"):
+            message = update.message.reply_document(
+                document=source, filename=f"image.{image_extension(img_data or b'')}", caption=caption
+            )
+        sent = message.document if message else None
+    if file_id is None:
+        IMAGE_UPLOAD_BYTES.observe(len(img_data), output)
+    return sent.file_id if sent else None
+
+def process_text_request(update: Update, context: CallbackContext, user_id, prompt) -> None:
+    """Сгенерировать текстовый ответ и отправить его (выполняется в пуле генерации)"""
+    # Ответ на запрос без истории не зависит от пользователя и может быть взят из кэша
+    cache_key = None if user_history[user_id] else text_cache_key(prompt)
+    if cache_key:
+        response = text_cache.get(cache_key)
+        if response is not None:
+            logger.info("Текстовый ответ взят из кэша")
+            user_history[user_id].append({"role": "user", "content": prompt})
+            user_history[user_id].append({"role": "assistant", "content": response})
+            send_long_message(update, response)
+            return
+    
+    # Отправка "печатает..."
+    context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
+    
+    # Показал ли ведущий запрос ответ по мере генерации
+    shown = False
+    
+    def produce():
+        nonlocal shown
+        if STREAM_REPLIES:
+            # Показываем ответ по мере генерации
+            reply = LiveReply(
+                context.bot,
+                update.effective_chat.id,
+                reply_to_message_id=update.message.message_id,
+                max_length=MAX_MESSAGE_LENGTH,
+                splitter=split_first,
+            )
+            result = {}
+            deltas = stream_gpt_response(prompt, history=user_history[user_id], result=result)
+            parts = []
+            
+            def collected():
+                for delta in deltas:
+                    parts.append(delta)
+                    yield delta
+            
+            try:
+                reply.stream(collected())
+                shown = True
+            except Exception as e:
+                # Ошибка отправки касается только этого чата: ответ нужен
+                # присоединившимся запросам, поэтому дочитываем поток
+                logger.warning(f"Не удалось показать ответ по мере генерации: {e}")
+                parts.extend(deltas)
+            response = "".join(parts)
+            assistant_message = {"role": "assistant", "content": response} if result["ok"] and response else None
+            return response, assistant_message
+        # Получение ответа от GPT
+        return get_gpt_response(prompt, history=user_history[user_id])
+    
+    if cache_key:
+        # Такой же запрос уже выполняется для другого пользователя - ждем его ответа.
+        # Из общего запроса возвращается только текст, отправляет его каждый сам
+        (response, assistant_message), leader = text_flight.do(cache_key, produce)
+    else:
+        (response, assistant_message), leader = produce(), True
+    
+    # Добавление сообщений в историю
+    user_history[user_id].append({"role": "user", "content": prompt})
+    if assistant_message:
+        user_history[user_id].append(assistant_message)
+        if cache_key and leader:
+            text_cache.set(cache_key, assistant_message["content"])
+    
+    # Ответ, уже показанный по мере генерации, повторно не отправляется
+    if not shown:
+        # Разбиваем длинное сообщение на части и отправляем
+        send_long_message(update, response)
+
+def process_image_request(update: Update, context: CallbackContext, prompt,
+                          size=DEFAULT_IMAGE_SIZE, output=DEFAULT_OUTPUT) -> None:
+    """Сгенерировать изображение и отправить его (выполняется в пуле генерации)"""
+    caption = f"Сгенерировано по запросу: {prompt}"
+    
+    # Такое изображение уже отправлялось - повторно отправляем файл, уже лежащий в Telegram
+    cache_key = image_cache_key(prompt, size, output)
+    if send_cached_image(update, cache_key, caption, output):
+        logger.info("Изображение взято из кэша")
+        return
+    
+    # Отправка "отправляет фото..."
+    context.bot.send_chat_action(chat_id=update.effective_chat.id, action='upload_photo')
+    
+    # Одинаковые одновременные запросы генерируются один раз. Из общего запроса
+    # возвращаются только байты: ошибка отправки в один чат не должна доставаться остальным
+    img_data, leader = image_flight.do(cache_key, generate_image, prompt, size=size, output=output)
+    if not img_data:
+        update.message.reply_text('Не удалось сгенерировать изображение. Попробуйте другой запрос.')
+        return
+    
+    # Ведущий мог уже загрузить изображение в Telegram - тогда отправляем по file_id
+    if not leader and send_cached_image(update, cache_key, caption, output):
+        return
+    
+    # Отправка изображения прямо из памяти, без временного файла.
+    # Запоминаем file_id (для фото - самого большого варианта)
+    file_id = send_image(update, img_data, caption, output)
+    if file_id:
+        image_cache.set(cache_key, file_id)
+
+def send_cached_image(update: Update, cache_key, caption, output) -> bool:
+    """Отправить изображение по file_id из кэша; False, если в кэше его нет или отправка не удалась"""
+    file_id = image_cache.get(cache_key)
+    if not file_id:
+        return False
+    try:
+        send_image(update, None, caption, output, file_id=file_id)
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось отправить изображение из кэша: {e}")
+        image_cache.pop(cache_key)
+        return False
+
+def process_image_variants(update: Update, context: CallbackContext, prompt, count,
+                           size=DEFAULT_IMAGE_SIZE, output=DEFAULT_OUTPUT) -> None:
+    """Сгенерировать несколько вариантов изображения одновременно и отправить одним альбомом"""
+    context.bot.send_chat_action(chat_id=update.effective_chat.id, action='upload_photo')
+    
+    # Варианты генерируются параллельно с общим сроком, поэтому ждать приходится как одно изображение
+    deadline = Deadline(IMAGE_DEADLINE)
+    futures = [variant_pool.submit(generate_image, prompt, deadline, size, output) for _ in range(count)]
+    images = []
+    for future in futures:
+        try:
+            img_data = future.result()
+        except Exception as e:
+            logger.error(f"Ошибка при генерации варианта изображения: {e}")
+            continue
+        if img_data:
+            images.append(img_data)
+    
+    if not images:
+        update.message.reply_text('Не удалось сгенерировать изображение. Попробуйте другой запрос.')
+        return
+    
+    caption = f"Сгенерировано по запросу: {prompt}"
+    if len(images) == 1:
+        send_image(update, images[0], caption, output)
+    else:
+        if output == OUTPUT_PHOTO:
+            media = [
+                InputMediaPhoto(BytesIO(img_data), caption=caption if i == 0 else None)
+                for i, img_data in enumerate(images)
+            ]
+        else:
+            media = [
+                InputMediaDocument(BytesIO(img_data), filename=f"image-{i + 1}.{image_extension(img_data)}",
+                                   caption=caption if i == len(images) - 1 else None)
+                for i, img_data in enumerate(images)
+            ]
+        with TELEGRAM_SEND_SECONDS.time("sendMediaGroup"):
+            update.message.reply_media_group(media=media)
+        for img_data in images:
+            IMAGE_UPLOAD_BYTES.observe(len(img_data), output)
+    
+    if len(images) < count:
+        # Отправляем то, что получилось, и сообщаем о неудачных вариантах
+        update.message.reply_text(f'Удалось сгенерировать {len(images)} из {count} вариантов.')
+
+def notify_stale(update: Update) -> None:
+    """Сообщить, что запрос устарел в очереди и не будет выполнен"""
+    update.message.reply_text(STALE_MESSAGE)
+
+def submit_generation(update: Update, kind, func, *args, cost=None) -> bool:
+    """Поставить генерацию в очередь или сообщить пользователю о перегрузке.
+
+    cost - стоимость запроса, если она отличается от обычной для kind
+    """
+    user_id = update.effective_user.id
+    allowed, retry_after = rate_limiter.consume(user_id, kind, cost)
+    if not allowed:
+        logger.info(f"Пользователь {user_id} превысил лимит запросов ({kind})")
+        # Пока прошлое уведомление о лимите не отправлено, новые не копятся в очереди чата
+        with send_scheduler.detached("throttled"):
+            update.message.reply_text(THROTTLED_MESSAGE.format(seconds=math.ceil(retry_after)))
+        return False
+    # Дорогой запрос в справедливой очереди весит как несколько обычных
+    weight = REQUEST_COSTS.get(kind, 1.0) / cost if cost else 1.0
+    # Возраст запроса считается с момента отправки: после простоя бота
+    # сообщения могут прийти уже устаревшими
+    age = max(0.0, time.time() - update.message.date.timestamp())
+    if not generation_executor.submit(user_id, kind, func, *args, weight=weight,
+                                      created_at=time.monotonic() - age,
+                                      on_stale=functools.partial(notify_stale, update)):
+        with send_scheduler.detached("busy"):
+            update.message.reply_text(BUSY_MESSAGE)
+        return False
+    return True
+
 def handle_message(update: Update, context: CallbackContext) -> None:
     """Обработчик обычных сообщений"""
     user_id = update.effective_user.id
@@ -383,7 +687,7 @@ def handle_message(update: Update, context: CallbackContext) -> None:
     
     # Инициализация истории пользователя, если её нет
     if user_id not in user_history:
-        user_history[user_id] = []
+        user_history[user_id] = ConversationWindow(text_model)
     
     # Если пользователь не имеет режима, устанавливаем по умолчанию
     if user_id not in user_mode:
@@ -392,60 +696,12 @@ def handle_message(update: Update, context: CallbackContext) -> None:
     # Обработка сообщения в зависимости от текущего режима
     if user_mode[user_id] == MODE_TEXT:
         # Режим генерации текста
-        # Отправка "печатает..."
-        context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
-        
-        # Получение ответа от GPT
-        response, assistant_message = get_gpt_response(prompt, history=user_history[user_id])
-        
-        # Добавление сообщений в историю
-        user_history[user_id].append({"role": "user", "content": prompt})
-        if assistant_message:
-            user_history[user_id].append(assistant_message)
-        
-        # Разбиваем длинное сообщение на части и отправляем
-        message_parts = split_long_message(response)
-        for i, part in enumerate(message_parts):
-            try:
-                # Добавляем индикатор части для длинных сообщений
-                if len(message_parts) > 1:
-                    part_indicator = f"[Часть {i+1}/{len(message_parts)}]\n"
-                    if i > 0:  # Для всех частей, кроме первой, добавляем индикатор в начало
-                        part = part_indicator + part
-                    else:  # Для первой части добавляем индикатор только если он поместится
-                        if len(part) + len(part_indicator) <= MAX_MESSAGE_LENGTH:
-                            part = part_indicator + part
-                
-                update.message.reply_text(part, parse_mode=ParseMode.MARKDOWN)
-            except Exception as e:
-                # Если не удалось отправить с Markdown, пробуем без форматирования
-                logger.warning(f"Ошибка при отправке с Markdown: {e}")
-                update.message.reply_text(part)
+        submit_generation(update, JOB_TEXT, process_text_request, update, context, user_id, prompt)
     
     elif user_mode[user_id] == MODE_IMAGE:
         # Режим генерации изображений
-        # Отправка "отправляет фото..."
-        context.bot.send_chat_action(chat_id=update.effective_chat.id, action='upload_photo')
-        
-        # Генерация изображения
-        img_data = generate_image(prompt)
-        
-        if img_data:
-            # Отправка изображения
-            with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp_file:
-                tmp_file.write(img_data)
-                tmp_file_path = tmp_file.name
-            
-            with open(tmp_file_path, 'rb') as f:
-                update.message.reply_photo(
-                    photo=f, 
-                    caption=f"Сгенерировано по запросу: {prompt}"
-                )
-            
-            # Удаление временного файла
-            os.unlink(tmp_file_path)
-        else:
-            update.message.reply_text('Не удалось сгенерировать изображение. Попробуйте другой запрос.')
+        size, output = image_settings(user_id)
+        submit_generation(update, JOB_IMAGE, process_image_request, update, context, prompt, size, output)
 
 def cancel(update: Update, context: CallbackContext) -> int:
     """Отмена текущего диалога"""
@@ -466,37 +722,9 @@ def handle_gpt_command(update: Update, context: CallbackContext) -> None:
     
     # Инициализация истории пользователя, если её нет
     if user_id not in user_history:
-        user_history[user_id] = []
-    
-    # Отправка "печатает..."
-    context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
-    
-    # Получение ответа от GPT
-    response, assistant_message = get_gpt_response(prompt, history=user_history[user_id])
+        user_history[user_id] = ConversationWindow(text_model)
     
-    # Добавление сообщений в историю
-    user_history[user_id].append({"role": "user", "content": prompt})
-    if assistant_message:
-        user_history[user_id].append(assistant_message)
-    
-    # Разбиваем длинное сообщение на части и отправляем
-    message_parts = split_long_message(response)
-    for i, part in enumerate(message_parts):
-        try:
-            # Добавляем индикатор части для длинных сообщений
-            if len(message_parts) > 1:
-                part_indicator = f"[Часть {i+1}/{len(message_parts)}]\n"
-                if i > 0:  # Для всех частей, кроме первой, добавляем индикатор в начало
-                    part = part_indicator + part
-                else:  # Для первой части добавляем индикатор только если он поместится
-                    if len(part) + len(part_indicator) <= MAX_MESSAGE_LENGTH:
-                        part = part_indicator + part
-            
-            update.message.reply_text(part, parse_mode=ParseMode.MARKDOWN)
-        except Exception as e:
-            # Если не удалось отправить с Markdown, пробуем без форматирования
-            logger.warning(f"Ошибка при отправке с Markdown: {e}")
-            update.message.reply_text(part)
+    submit_generation(update, JOB_TEXT, process_text_request, update, context, user_id, prompt)
 
 def handle_image_command(update: Update, context: CallbackContext) -> None:
     """Обработчик команды /image"""
@@ -504,97 +732,304 @@ def handle_image_command(update: Update, context: CallbackContext) -> None:
         update.message.reply_text('Пожалуйста, добавьте описание изображения после команды /image')
         return
     
-    prompt = ' '.join(context.args)
+    # /image [размер] [формат] [N] <описание>: размер и формат команды важнее настроек
+    # пользователя, N - несколько вариантов одним альбомом
+    size, output = image_settings(update.effective_user.id)
+    option_size, option_output, count, args = split_image_options(context.args)
+    size = option_size or size
+    output = option_output or output
+    count = count or 1
     
-    # Отправка "отправляет фото..."
-    context.bot.send_chat_action(chat_id=update.effective_chat.id, action='upload_photo')
+    prompt = ' '.join(args)
     
-    # Генерация изображения
-    img_data = generate_image(prompt)
+    if count == 1:
+        submit_generation(update, JOB_IMAGE, process_image_request, update, context, prompt, size, output)
+    else:
+        cost = REQUEST_COSTS[JOB_IMAGE] + (count - 1) * IMAGE_VARIANT_COST
+        submit_generation(update, JOB_IMAGE, process_image_variants, update, context, prompt, count, size, output,
+                          cost=cost)
+
+def update_image_setting(update: Update, context: CallbackContext, field, choices, labels) -> None:
+    """Показать или изменить одну настройку изображений пользователя"""
+    user_id = update.effective_user.id
+    if not context.args:
+        current = image_settings(user_id)[0 if field == "size" else 1]
+        update.message.reply_text(f'Сейчас: {current}. Доступно: {", ".join(labels)}')
+        return
+    value = context.args[0].lower()
+    if value not in choices:
+        update.message.reply_text(f'Неизвестное значение "{value}". Доступно: {", ".join(labels)}')
+        return
+    settings = dict(user_image_settings.get(user_id) or {})
+    settings[field] = value
+    user_image_settings[user_id] = settings
+    update.message.reply_text(f'Готово: {value}.')
+
+def set_image_size(update: Update, context: CallbackContext) -> None:
+    """Обработчик команды /size: размер изображений по умолчанию"""
+    labels = [f"{name} ({width}x{height})" for name, (width, height) in IMAGE_SIZES.items()]
+    update_image_setting(update, context, "size", IMAGE_SIZES, labels)
+
+def set_image_format(update: Update, context: CallbackContext) -> None:
+    """Обработчик команды /format: отправлять изображения фото, файлом WebP или исходным файлом"""
+    update_image_setting(update, context, "output", OUTPUT_FORMATS, OUTPUT_FORMATS)
+
+def inline_result(prompt, answer):
+    """Результат inline-запроса: сообщение с вопросом и ответом"""
+    text, _ = split_first(f"{prompt}\n\n{answer}", MAX_MESSAGE_LENGTH)
+    return InlineQueryResultArticle(
+        id=make_key(prompt)[:32],
+        title=prompt[:100],
+        description=answer[:200],
+        input_message_content=InputTextMessageContent(
+            text, parse_mode=ParseMode.MARKDOWN if is_valid_markdown(text) else None
+        ),
+    )
+
+def answer_inline(query, prompt, answer):
+    """Отправить ответ на inline-запрос (Telegram тоже кэширует его на INLINE_CACHE_TIME)"""
+    try:
+        with TELEGRAM_SEND_SECONDS.time("answerInlineQuery"):
+            query.answer([inline_result(prompt, answer)], cache_time=INLINE_CACHE_TIME)
+    except Exception as e:
+        # Пользователь успел изменить запрос, и Telegram больше не ждет ответа
+        logger.warning(f"Не удалось ответить на inline-запрос: {e}")
+
+def handle_inline_query(update: Update, context: CallbackContext) -> None:
+    """Обработчик inline-запросов @bot <вопрос>"""
+    query = update.inline_query
+    prompt = query.query.strip()
+    if len(prompt) < INLINE_MIN_CHARS:
+        return
+    
+    # Тот же вопрос недавно задавали - отвечаем сразу, без ожидания конца набора
+    answer = inline_cache.get(inline_key(prompt))
+    if answer is not None:
+        inline_debouncer.supersede(query.from_user.id)
+        INLINE_QUERIES.inc("cached")
+        answer_inline(query, prompt, answer)
+        return
     
-    if img_data:
-        # Отправка изображения
-        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp_file:
-            tmp_file.write(img_data)
-            tmp_file_path = tmp_file.name
+    inline_debouncer.offer(query.from_user.id, query, prompt)
+
+def start_inline_generation(request) -> None:
+    """Пользователь перестал печатать - ставим inline-запрос в очередь генерации"""
+    allowed, _ = rate_limiter.consume(request.user_id, JOB_TEXT)
+    if not allowed or not generation_executor.submit(request.user_id, JOB_TEXT, process_inline_query, request,
+                                                     on_stale=functools.partial(drop_stale_inline, request)):
+        INLINE_QUERIES.inc("rejected")
+        inline_debouncer.finish(request)
+
+def drop_stale_inline(request) -> None:
+    """Inline-запрос устарел в очереди: освобождаем его, чтобы повторный набор запустил новый"""
+    INLINE_QUERIES.inc("stale")
+    inline_debouncer.finish(request)
+
+def inline_completion(prompt, deadline):
+    """Ответ модели на inline-запрос без истории (None, если ответа нет)"""
+    result = {}
+    answer = "".join(stream_gpt_response(prompt, deadline=deadline, result=result))
+    return answer if result["ok"] and answer else None
+
+def process_inline_query(request) -> None:
+    """Сгенерировать ответ на inline-запрос (выполняется в пуле генерации)"""
+    try:
+        # Пока задача ждала в очереди, пользователь продолжил печатать
+        if not inline_debouncer.is_current(request):
+            INLINE_QUERIES.inc("superseded")
+            return
         
-        with open(tmp_file_path, 'rb') as f:
-            update.message.reply_photo(
-                photo=f, 
-                caption=f"Сгенерировано по запросу: {prompt}"
-            )
+        key = inline_key(request.text)
+        answer = inline_cache.get(key)
+        if answer is None:
+            # Одинаковые вопросы разных пользователей генерируются один раз. Срок у
+            # генерации свой: продолжение набора одним пользователем не обрывает ее для остальных
+            generation = inline_debouncer.join(request)
+            answer, leader = inline_flight.do(generation, inline_completion, request.text, generation.deadline)
+            if answer and leader:
+                inline_cache.set(key, answer)
         
-        # Удаление временного файла
-        os.unlink(tmp_file_path)
-    else:
-        update.message.reply_text('Не удалось сгенерировать изображение. Попробуйте другой запрос.')
+        if not inline_debouncer.is_current(request):
+            INLINE_QUERIES.inc("cancelled")
+        elif answer is None:
+            INLINE_QUERIES.inc("failed")
+        else:
+            INLINE_QUERIES.inc("answered")
+            answer_inline(request.query, request.text, answer)
+    finally:
+        inline_debouncer.finish(request)
+
+inline_debouncer = InlineDebouncer(start_inline_generation)
 
 def clear_history(update: Update, context: CallbackContext) -> None:
     """Очистить историю сообщений пользователя"""
     user_id = update.effective_user.id
     if user_id in user_history:
-        user_history[user_id] = []
+        user_history[user_id].clear()
     update.message.reply_text('История сообщений очищена.')
 
 def list_models(update: Update, context: CallbackContext) -> None:
     """Показать список доступных моделей"""
-    models_list = "\n".join(available_models)
+    models_list = "\n".join(available_models())
     update.message.reply_text(f'Доступные модели:\n{models_list}')
 
 def split_long_message(text, max_length=MAX_MESSAGE_LENGTH):
-    """Разбивает длинное сообщение на части подходящей длины"""
-    if len(text) <= max_length:
-        return [text]
-    
-    parts = []
-    while text:
-        # Находим подходящее место для разделения (предпочтительно на переносе строки или пробеле)
-        if len(text) <= max_length:
-            parts.append(text)
-            break
-        
-        # Ищем последний перенос строки в пределах max_length
-        split_point = text[:max_length].rfind('\n')
-        if split_point == -1 or split_point < max_length // 2:
-            # Если перенос строки не найден или слишком близко к началу,
-            # ищем последний пробел
-            split_point = text[:max_length].rfind(' ')
-            if split_point == -1 or split_point < max_length // 2:
-                # Если и пробел не найден, просто разделяем по максимальной длине
-                split_point = max_length
-        else:
-            # Если нашли перенос строки, включаем его в текущую часть
-            split_point += 1
-        
-        parts.append(text[:split_point])
-        text = text[split_point:]
-    
-    return parts
+    """Разбивает длинное сообщение на части подходящей длины, не разрывая разметку"""
+    return split_markdown(text, max_length)
 
-def main() -> None:
-    """Основная функция для запуска бота"""
-    # Создание Updater и передача токена бота
-    updater = Updater(TOKEN)
+def record_update(update: Update, context: CallbackContext) -> None:
+    """Записать входящее сообщение в журнал трафика (без текста, см. traffic_log.py)"""
+    recorder = traffic_log.get_recorder()
+    message = update.message
+    if recorder is None or message is None or not message.text:
+        return
+    user_id = update.effective_user.id
+    button = {"🤖 GPT": MODE_TEXT, "🎨 Изображение": MODE_IMAGE}.get(message.text)
+    recorder.record_update(user_id, message.text, mode=user_mode.get(user_id, MODE_TEXT),
+                           button=button, chat_type=message.chat.type)
+
+def build_updater(token=TOKEN, **updater_kwargs) -> Updater:
+    """Создать Updater и зарегистрировать обработчики"""
+    # Все вызовы Bot API, адресованные чатам, проходят через очередь с лимитами Telegram
+    workers = updater_kwargs.pop("workers", 4)
+    request = Request(con_pool_size=workers + 4 + sum(POOL_SIZES.values()))
+    bot = ScheduledBot(token, base_url=updater_kwargs.pop("base_url", None), request=request,
+                       scheduler=send_scheduler)
+
+    # Создание Updater
+    updater = Updater(bot=bot, workers=workers, **updater_kwargs)
 
     # Получение диспетчера для регистрации обработчиков
     dispatcher = updater.dispatcher
 
+    # Журнал трафика записывает обновления раньше всех обработчиков
+    if traffic_log.get_recorder() is not None:
+        dispatcher.add_handler(TypeHandler(Update, record_update), group=-1)
+
+    # Обработчики выполняются в потоке диспетчера: их ответы отправляет поток
+    # чата, чтобы лимит одного чата не останавливал прием обновлений
+    detached = send_scheduler.detach_handler
+
     # Регистрация обработчиков команд
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("gpt", handle_gpt_command))
-    dispatcher.add_handler(CommandHandler("image", handle_image_command))
-    dispatcher.add_handler(CommandHandler("clear", clear_history))
-    dispatcher.add_handler(CommandHandler("models", list_models))
+    dispatcher.add_handler(CommandHandler("start", detached(start)))
+    dispatcher.add_handler(CommandHandler("gpt", detached(handle_gpt_command)))
+    dispatcher.add_handler(CommandHandler("image", detached(handle_image_command)))
+    dispatcher.add_handler(CommandHandler("clear", detached(clear_history)))
+    dispatcher.add_handler(CommandHandler("models", detached(list_models)))
+    dispatcher.add_handler(CommandHandler("size", detached(set_image_size)))
+    dispatcher.add_handler(CommandHandler("format", detached(set_image_format)))
     
     # Регистрация обработчика обычных сообщений
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, detached(handle_message)))
     
     # Регистрация обработчика callback-запросов для кнопок
-    dispatcher.add_handler(CallbackQueryHandler(cancel))
+    dispatcher.add_handler(CallbackQueryHandler(detached(cancel)))
+    
+    # Inline-режим: @bot <вопрос> в любом чате
+    dispatcher.add_handler(InlineQueryHandler(detached(handle_inline_query)))
+    return updater
+
+def shutdown() -> None:
+    """Дождаться начатых генераций и записать несохраненные сессии"""
+    generation_executor.shutdown()
+    variant_pool.shutdown()
+    session_store.close()
+    close_transport()
+    shutdown_images()
+    traffic_log.stop()
+
+def register_gauges() -> None:
+    """Метрики состояния бота, вычисляемые при каждом сборе"""
+    Gauge("tgbot_active_users", "Пользователи, сессии которых загружены в память",
+          callback=lambda: session_store.stats()["active_users"])
+    Gauge("tgbot_history_turns", "Сообщения в истории пользователей в памяти",
+          callback=lambda: session_store.stats()["history_turns"])
+    Gauge("tgbot_history_tokens", "Оценка токенов в истории пользователей в памяти",
+          callback=lambda: session_store.stats()["history_tokens"])
+    Gauge("tgbot_context_requests", "Запросы с историей, прошедшие через окно контекста",
+          callback=lambda: context_stats["requests"])
+    Gauge("tgbot_context_tokens", "Токены истории: отправленные модели (sent) и отброшенные окном (saved)", ["kind"],
+          callback=lambda: {("sent",): context_stats["tokens_sent"], ("saved",): context_stats["tokens_saved"]})
+    caches = {"image": image_cache, "text": text_cache, "inline": inline_cache}
+    flights = {"image": image_flight, "text": text_flight, "inline": inline_flight}
+    Gauge("tgbot_cache_entries", "Записи в кэше результатов", ["cache"],
+          callback=lambda: {(name,): cache.stats()["entries"] for name, cache in caches.items()})
+    Gauge("tgbot_cache_requests", "Обращения к кэшу результатов: попадания (hit) и промахи (miss)", ["cache", "result"],
+          callback=lambda: {key: value for name, cache in caches.items() for key, value in (
+              ((name, "hit"), cache.stats()["hits"]), ((name, "miss"), cache.stats()["misses"]))})
+    Gauge("tgbot_singleflight_requests", "Запросы, выполненные сами (leader) и получившие чужой результат (coalesced)",
+          ["flight", "role"],
+          callback=lambda: {key: value for name, flight in flights.items() for key, value in (
+              ((name, "leader"), flight.stats()["leaders"]), ((name, "coalesced"), flight.stats()["coalesced"]))})
+    Gauge("tgbot_singleflight_in_flight", "Выполняющиеся запросы, к которым могут присоединиться одинаковые", ["flight"],
+          callback=lambda: {(name,): flight.stats()["in_flight"] for name, flight in flights.items()})
+    Gauge("tgbot_queue_depth", "Задачи генерации в очереди и в работе", ["kind"],
+          callback=lambda: {(kind,): s["depth"] for kind, s in generation_executor.stats().items()})
+    Gauge("tgbot_jobs_running", "Выполняемые задачи генерации", ["kind"],
+          callback=lambda: {(kind,): s["running"] for kind, s in generation_executor.stats().items()})
+    Gauge("tgbot_jobs_shed", "Задачи, отклоненные из-за долгого ожидания в очереди", ["kind"],
+          callback=lambda: {(kind,): s["shed"] for kind, s in generation_executor.stats().items()})
+    Gauge("tgbot_jobs_stale", "Устаревшие задачи, снятые с очереди без выполнения", ["kind"],
+          callback=lambda: {(kind,): s["stale"] for kind, s in generation_executor.stats().items()})
+    Gauge("tgbot_jobs_admitting", "Принимаются ли новые задачи (0 - сброс нагрузки)", ["kind"],
+          callback=lambda: {(kind,): int(s["admitting"]) for kind, s in generation_executor.stats().items()})
+    Gauge("tgbot_inline_pending", "Inline-запросы, ожидающие конца набора или ответа",
+          callback=lambda: inline_debouncer.stats()["pending"])
+    Gauge("tgbot_outbound_waiting", "Вызовы Bot API, ожидающие очереди или лимита",
+          callback=lambda: send_scheduler.stats()["waiting"])
+    Gauge("tgbot_timeouts", "Истекшие сроки ожидания по этапам", ["stage"],
+          callback=lambda: {(stage,): count for stage, count in timeout_stats().items()})
+
+def start_bot(receive, metrics_port=METRICS_PORT, record_path=None) -> Updater:
+    """Запустить процесс бота: метрики, запись трафика, Updater и прием обновлений.
+
+    Общий для python tgbot.py и рабочих процессов webhook.py; receive(updater)
+    начинает получать обновления.
+    """
+    if metrics_port:
+        register_gauges()
+        start_metrics_server(metrics_port)
+    
+    record_path = record_path or traffic_log.RECORD_PATH
+    if record_path:
+        # Запись перехватывает вызовы g4f, поэтому он импортируется сразу
+        traffic_log.start(record_path, get_g4f(), get_client())
+    
+    updater = build_updater(TOKEN)
+    receive(updater)
+    logger.info(f"Бот запущен за {time.monotonic() - _import_started:.2f} с")
+
+    # g4f и список моделей загружаются в фоне, когда бот уже принимает сообщения
+    refresh_in_background()
+    return updater
 
-    # Запуск бота
-    updater.start_polling()
+def start_receiving(updater: Updater) -> None:
+    """Получать обновления через webhook, если задан публичный адрес, иначе через long polling"""
+    if webhook.WEBHOOK_URL:
+        updater.start_webhook(
+            listen=webhook.WEBHOOK_LISTEN,
+            port=webhook.WEBHOOK_PORT,
+            url_path=webhook.WEBHOOK_PATH,
+            webhook_url=f"{webhook.WEBHOOK_URL.rstrip('/')}/{webhook.WEBHOOK_PATH}",
+        )
+    else:
+        updater.start_polling()
+
+def main() -> None:
+    """Основная функция для запуска бота"""
+    if webhook.WEBHOOK_URL and webhook.WEBHOOK_SECRET is not None:
+        # Webhook PTB 13 не проверяет X-Telegram-Bot-Api-Secret-Token: с секретом
+        # обновления принимает webhook.py, а бот работает в одном рабочем процессе.
+        # Процесс заменяется на webhook.py, иначе рабочий процесс, импортируя бота,
+        # повторно создал бы хранилище сессий, пулы и очереди этого модуля
+        os.execv(sys.executable, [sys.executable, webhook.__file__, "--shards", "1"])
+
+    # Для нескольких процессов используется webhook.py
+    updater = start_bot(start_receiving)
     updater.idle()
 
+    # Дожидаемся начатых генераций и записываем несохраненные сессии перед выходом
+    shutdown()
+
 if __name__ == '__main__':
     main()
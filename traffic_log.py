@@ -0,0 +1,242 @@
+"""Запись потока обновлений и вызовов провайдеров для воспроизведения.
+
+Журнал - строки JSON (или JSONL, сжатый gzip, если путь оканчивается на
+.gz). Тексты сообщений в журнал не попадают: вместо них записываются
+команда, длина и число строк, а пользователи заменяются порядковыми
+номерами. Для каждого вызова g4f записываются задержка до ответа, время
+чтения потока, форма и длина ответа. Вызов связывается с обновлением по
+хэшу промпта, который хранится только в памяти.
+
+Журнал воспроизводится командой python -m bench.replay.
+"""
+import collections
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from images import split_image_options
+from stream_text import collect_text, content_of, is_sse
+
+logger = logging.getLogger(__name__)
+
+# Файл журнала (None - запись выключена). Запись импортирует g4f при запуске
+RECORD_PATH = None
+# Сколько последних промптов помнить для связи вызовов провайдера с обновлениями
+RECENT_PROMPTS = 10000
+
+FORMAT_VERSION = 1
+
+_recorder = None
+
+
+def prompt_key(salt, text):
+    """Хэш промпта без учета пробелов (совпадает для текста сообщения и аргументов команды)"""
+    return hashlib.blake2b(" ".join(text.split()).encode("utf-8"), digest_size=16, key=salt).digest()
+
+
+def response_shape(response):
+    """Форма ответа g4f: object, stream, dict, sse, text или url"""
+    if isinstance(response, (str, bytes)):
+        text = response.decode("utf-8", "replace") if isinstance(response, bytes) else response
+        if is_sse(text):
+            return "sse"
+        return "url" if text.startswith(("http://", "https://")) else "text"
+    if isinstance(response, dict):
+        return "dict"
+    if getattr(response, "choices", None) is not None:
+        return "object"
+    if getattr(response, "data", None) is not None:
+        return "url"
+    if hasattr(response, "__iter__") or hasattr(response, "__next__"):
+        return "stream"
+    return type(response).__name__
+
+
+def _response_chars(response, shape):
+    if shape in ("object", "dict"):
+        return len(content_of(response) or "")
+    if shape == "sse":
+        return len(collect_text(response))
+    if shape == "text":
+        return len(response)
+    return 0
+
+
+class TrafficRecorder:
+    """Пишет обновления и вызовы провайдеров в журнал"""
+
+    def __init__(self, path):
+        self.path = path
+        opener = gzip.open if path.endswith(".gz") else open
+        self._file = opener(path, "at", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._salt = os.urandom(16)
+        self._users = {}
+        self._prompts = collections.OrderedDict()
+        self._seq = 0
+        self._write({"ev": "start", "v": FORMAT_VERSION, "time": int(time.time())})
+        logger.info(f"Запись трафика в {path}")
+
+    def _write(self, event):
+        line = json.dumps(event, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+
+    def _offset(self, now=None):
+        return round((time.monotonic() if now is None else now) - self._started, 4)
+
+    def record_update(self, user_id, text, mode=None, button=None, chat_type=None):
+        """Записать входящее сообщение без его текста"""
+        command, prompt, count, options = None, text, None, []
+        if text.startswith("/"):
+            command, _, prompt = text.partition(" ")
+            command = command.split("@", 1)[0]
+            if command == "/image":
+                # Параметры перед описанием (размер, формат, число вариантов) - не часть промпта,
+                # разбираются так же, как в самом боте
+                words = prompt.split()
+                size, output, count, rest = split_image_options(words)
+                options = [option for option in (size, output) if option]
+                if len(rest) < len(words):
+                    prompt = prompt.split(None, len(words) - len(rest))[-1]
+
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            user = self._users.setdefault(user_id, len(self._users) + 1)
+            if prompt:
+                self._prompts[prompt_key(self._salt, prompt)] = seq
+                if len(self._prompts) > RECENT_PROMPTS:
+                    self._prompts.popitem(last=False)
+
+        event = {"ev": "update", "t": self._offset(), "seq": seq, "user": user, "mode": mode,
+                 "chars": len(prompt), "lines": prompt.count("\n") + 1 if prompt else 0}
+        if command:
+            event["cmd"] = command
+        if button:
+            event["button"] = button
+        if count:
+            event["count"] = count
+        if options:
+            event["opts"] = options
+        if chat_type and chat_type != "private":
+            event["chat"] = chat_type
+        self._write(event)
+        return seq
+
+    def _seq_for(self, kwargs):
+        prompt = kwargs.get("prompt")
+        if prompt is None:
+            messages = kwargs.get("messages") or []
+            prompt = messages[-1].get("content") if messages else None
+        if not isinstance(prompt, str):
+            return None
+        with self._lock:
+            return self._prompts.get(prompt_key(self._salt, prompt))
+
+    def record_call(self, api, seq, started, first, ok, shape=None, chars=0, chunks=None, stream=False):
+        """Записать один вызов провайдера"""
+        event = {"ev": "call", "t": self._offset(started), "seq": seq, "api": api,
+                 "first": round(first, 4), "ok": ok}
+        if stream:
+            event["stream"] = True
+        if shape:
+            event["shape"] = shape
+        if chars:
+            event["chars"] = chars
+        if chunks is not None:
+            event["chunks"] = chunks
+            event["total"] = round(time.monotonic() - started, 4)
+        self._write(event)
+
+    def _recorded_stream(self, chunks, api, seq, started, stream):
+        # Ленивый поток g4f начинает запрос только при чтении первой части
+        first = None
+        count = chars = 0
+        ok = False
+        try:
+            for chunk in chunks:
+                if first is None:
+                    first = time.monotonic() - started
+                count += 1
+                if isinstance(chunk, (str, bytes)):
+                    chars += len(chunk)
+                else:
+                    chars += len(content_of(chunk) or "")
+                yield chunk
+            ok = True
+        finally:
+            if first is None:
+                first = time.monotonic() - started
+            self.record_call(api, seq, started, first, ok, "stream", chars, count, stream)
+
+    def wrap(self, owner, name, api):
+        """Записывать вызовы owner.name как вызовы api"""
+        func = getattr(owner, name, None)
+        if func is None:
+            return
+
+        @functools.wraps(func)
+        def recorded(*args, **kwargs):
+            seq = self._seq_for(kwargs)
+            stream = bool(kwargs.get("stream"))
+            started = time.monotonic()
+            try:
+                response = func(*args, **kwargs)
+            except Exception:
+                self.record_call(api, seq, started, time.monotonic() - started, False, stream=stream)
+                raise
+            first = time.monotonic() - started
+            shape = response_shape(response)
+            if shape == "stream":
+                return self._recorded_stream(response, api, seq, started, stream)
+            self.record_call(api, seq, started, first, True, shape, _response_chars(response, shape),
+                             stream=stream)
+            return response
+
+        setattr(owner, name, staticmethod(recorded) if isinstance(owner, type) else recorded)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def shard_path(path, shard):
+    """Журнал рабочего процесса shard: traffic.jsonl.gz -> traffic.shard0.jsonl.gz"""
+    directory, name = os.path.split(path)
+    base, dot, extensions = name.partition(".")
+    return os.path.join(directory, f"{base}.shard{shard}{dot}{extensions}")
+
+
+def start(path, g4f, client):
+    """Начать запись в path и перехватывать вызовы g4f и его клиента"""
+    global _recorder
+    recorder = TrafficRecorder(path)
+    recorder.wrap(client.chat.completions, "create", "client.chat")
+    recorder.wrap(client.images, "generate", "client.images")
+    recorder.wrap(g4f.ChatCompletion, "create", "chatcompletion")
+    recorder.wrap(getattr(g4f, "images", None), "create", "images")
+    _recorder = recorder
+    return recorder
+
+
+def get_recorder():
+    """Активный журнал или None"""
+    return _recorder
+
+
+def stop():
+    """Закрыть журнал"""
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
@@ -0,0 +1,82 @@
+"""Общие для всего процесса HTTP-сессия и клиент g4f"""
+import logging
+import threading
+
+from model_catalog import get_g4f
+
+logger = logging.getLogger(__name__)
+
+# Сколько разных хостов держать в пуле соединений
+POOL_CONNECTIONS = 10
+# Максимум одновременных соединений к одному хосту
+POOL_MAXSIZE = 16
+# Повторы при временных ошибках (обрыв соединения, 429, 5xx)
+RETRY_TOTAL = 2
+RETRY_BACKOFF = 0.3
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_lock = threading.Lock()
+_session = None
+_client = None
+
+
+def build_session():
+    """Сессия requests с пулом keep-alive соединений и повторами"""
+    # requests импортируется при первой загрузке изображения, а не при запуске бота
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=RETRY_TOTAL,
+        connect=RETRY_TOTAL,
+        read=RETRY_TOTAL,
+        status=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+    )
+    # pool_block: при исчерпании пула запрос ждет свободное соединение,
+    # а не открывает лишнее - так соблюдается лимит на хост
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        max_retries=retry,
+        pool_block=True,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """Общая HTTP-сессия процесса"""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = build_session()
+    return _session
+
+
+def get_client():
+    """Общий клиент g4f (создается один раз при первом обращении)"""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                get_g4f()
+                from g4f.client import Client
+                _client = Client()
+    return _client
+
+
+def close():
+    """Закрыть соединения пула"""
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
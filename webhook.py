@@ -0,0 +1,279 @@
+"""Прием обновлений через webhook и распределение по процессам.
+
+Один процесс-прием слушает HTTP, определяет пользователя в обновлении
+и по согласованному хэшу user_id передает обновление одному из
+WEBHOOK_SHARDS рабочих процессов. Каждый рабочий процесс - полноценный
+бот со своей памятью, поэтому история пользователя всегда живет в одном
+процессе и не требует межпроцессных блокировок.
+
+Запуск: python webhook.py [--shards N]
+Модуль намеренно не импортирует tgbot на верхнем уровне: процесс-прием
+легкий, а рабочие процессы импортируют бота сами после запуска.
+"""
+import argparse
+import bisect
+import hashlib
+import hmac
+import json
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Публичный HTTPS-адрес, который сообщается Telegram (None - режим webhook выключен)
+WEBHOOK_URL = None
+# Где слушать входящие запросы
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token (None - не проверяется)
+WEBHOOK_SECRET = None
+# Число рабочих процессов
+WEBHOOK_SHARDS = 4
+# Сколько обновлений может ждать в очереди одного процесса
+SHARD_QUEUE_SIZE = 1000
+# Сколько ждать готовности рабочего процесса при запуске (секунды)
+SHARD_START_TIMEOUT = 120.0
+# Виртуальных точек на процесс в кольце хэшей
+HASH_RING_REPLICAS = 100
+
+# Поля обновления, в которых может находиться пользователь
+USER_FIELDS = (
+    "message", "edited_message", "channel_post", "edited_channel_post",
+    "callback_query", "inline_query",
+    "chosen_inline_result", "shipping_query", "pre_checkout_query",
+    "my_chat_member", "chat_member", "chat_join_request", "poll_answer",
+)
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Согласованный хэш: при изменении числа процессов переезжает
+    только часть пользователей"""
+
+    def __init__(self, nodes, replicas=HASH_RING_REPLICAS):
+        self._points = sorted(
+            (_hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas)
+        )
+        self._keys = [point for point, _ in self._points]
+
+    def node_for(self, key):
+        index = bisect.bisect(self._keys, _hash(str(key))) % len(self._keys)
+        return self._points[index][1]
+
+
+def update_user_id(update):
+    """user_id отправителя обновления (или id чата, если пользователя нет)"""
+    for field in USER_FIELDS:
+        payload = update.get(field)
+        if not isinstance(payload, dict):
+            continue
+        user = payload.get("from") or payload.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+        chat = payload.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return 0
+
+
+def run_shard(shard, updates, ready, shards=WEBHOOK_SHARDS):
+    """Рабочий процесс: бот, который получает обновления из своей очереди"""
+    # Сигналы обрабатывает процесс-прием, он же останавливает рабочие процессы
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import tgbot
+    import traffic_log
+    from telegram import Update
+
+    def receive(updater):
+        threading.Thread(target=updater.dispatcher.start, name=f"dispatcher-{shard}", daemon=True).start()
+        if shard == 0 and WEBHOOK_URL:
+            updater.bot.set_webhook(url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+            logger.info(f"Webhook установлен: {WEBHOOK_URL}")
+
+    # Лимиты Telegram общие для бота, а очередь отправки у каждого процесса своя
+    tgbot.send_scheduler.split(shards)
+
+    # Тот же запуск, что и у python tgbot.py, но метрики и журнал трафика у каждого процесса свои
+    record_path = traffic_log.RECORD_PATH and traffic_log.shard_path(traffic_log.RECORD_PATH, shard)
+    updater = tgbot.start_bot(receive, tgbot.METRICS_PORT and tgbot.METRICS_PORT + shard, record_path)
+    dispatcher = updater.dispatcher
+    ready.set()
+    logger.info(f"Процесс {shard} готов принимать обновления")
+
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        try:
+            dispatcher.update_queue.put(Update.de_json(json.loads(data), updater.bot))
+        except Exception as e:
+            logger.error(f"Процесс {shard}: не удалось разобрать обновление: {e}")
+
+    dispatcher.stop()
+    tgbot.shutdown()
+
+
+class ShardPool:
+    """Рабочие процессы, их очереди и перезапуск упавших"""
+
+    def __init__(self, shards=WEBHOOK_SHARDS):
+        self._context = multiprocessing.get_context("spawn")
+        self.queues = [self._context.Queue(maxsize=SHARD_QUEUE_SIZE) for _ in range(shards)]
+        self.processes = [None] * shards
+        self.ring = HashRing(range(shards))
+        self.routed = [0] * shards
+        self.rejected = 0
+
+    def _start(self, shard):
+        ready = self._context.Event()
+        process = self._context.Process(
+            target=run_shard, args=(shard, self.queues[shard], ready, len(self.queues)), name=f"tgbot-shard-{shard}"
+        )
+        process.start()
+        self.processes[shard] = process
+        return ready
+
+    def start(self, timeout=SHARD_START_TIMEOUT):
+        """Запустить все процессы и дождаться их готовности.
+
+        RuntimeError, если процесс завершился или не стал готов за timeout секунд.
+        """
+        events = [self._start(shard) for shard in range(len(self.queues))]
+        deadline = time.monotonic() + timeout
+        for shard, ready in enumerate(events):
+            process = self.processes[shard]
+            while not ready.wait(min(1.0, max(0.0, deadline - time.monotonic()))):
+                if not process.is_alive():
+                    self.terminate()
+                    raise RuntimeError(f"Процесс {shard} завершился при запуске с кодом {process.exitcode}")
+                if time.monotonic() >= deadline:
+                    self.terminate()
+                    raise RuntimeError(f"Процесс {shard} не запустился за {timeout:.0f} с")
+
+    def route(self, data, user_id):
+        """Передать обновление процессу пользователя. False - очередь переполнена"""
+        shard = self.ring.node_for(user_id)
+        try:
+            self.queues[shard].put_nowait(data)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.routed[shard] += 1
+        return True
+
+    def supervise(self, stop):
+        while not stop.wait(1.0):
+            for shard, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    logger.error(f"Процесс {shard} завершился с кодом {process.exitcode}, перезапускаем")
+                    self._start(shard)
+
+    def terminate(self):
+        """Остановить процессы без ожидания очередей (при неудачном запуске)"""
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+                process.join(timeout=10)
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout=60)
+
+
+def make_handler(pool):
+    path = "/" + WEBHOOK_PATH.strip("/")
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            if self.path.split("?")[0] != path:
+                self._reply(404)
+                return
+            if WEBHOOK_SECRET is not None:
+                secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+                if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+                    self._reply(403)
+                    return
+
+            try:
+                length = int(self.headers["Content-Length"])
+            except (TypeError, ValueError):
+                length = -1
+            if length < 0:
+                # Заголовка нет или он не число
+                self._reply(400)
+                return
+            try:
+                data = self.rfile.read(length).decode("utf-8")
+                update = json.loads(data)
+            except ValueError:
+                self._reply(400)
+                return
+            if not isinstance(update, dict):
+                self._reply(400)
+                return
+            user_id = update_user_id(update)
+            # 503 - Telegram повторит доставку позже
+            self._reply(200 if pool.route(data, user_id) else 503)
+
+    return WebhookHandler
+
+
+def main(shards=WEBHOOK_SHARDS):
+    """Запустить процесс-прием и рабочие процессы"""
+    logging.basicConfig(
+        format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+    )
+    pool = ShardPool(shards)
+    try:
+        pool.start()
+    except RuntimeError as e:
+        logger.error(f"Не удалось запустить рабочие процессы: {e}")
+        raise SystemExit(1)
+
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), make_handler(pool))
+    server.daemon_threads = True
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        stop.set()
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    threading.Thread(target=pool.supervise, args=(stop,), name="supervisor", daemon=True).start()
+
+    logger.info(f"Прием webhook на {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}, процессов: {shards}")
+    started = time.monotonic()
+    server.serve_forever()
+
+    logger.info(f"Остановка: распределено {sum(pool.routed)} обновлений за {time.monotonic() - started:.0f} с "
+                f"({', '.join(map(str, pool.routed))}), отклонено {pool.rejected}")
+    pool.stop()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Прием обновлений через webhook и рабочие процессы бота")
+    parser.add_argument("--shards", type=int, default=WEBHOOK_SHARDS, help="число рабочих процессов")
+    main(parser.parse_args().shards)